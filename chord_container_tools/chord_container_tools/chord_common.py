@@ -3,11 +3,17 @@ import random
 import os
 import subprocess
 import sys
+import threading
+import time
 import uuid
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
 from jsonschema import validate
-from typing import Dict, List, Iterable, Tuple
+from typing import Callable, Dict, List, Iterable, NamedTuple, Optional, Tuple
+
+from .timing import span
 
 
 __all__ = [
@@ -24,16 +30,25 @@ __all__ = [
     "CHORD_ENVIRONMENT_PATH",
 
     "ConfigVars",
+    "ChordConfig",
     "Service",
     "ServiceList",
+    "TaskResults",
+    "CommandResult",
 
     "json_load_dict_or_empty",
     "load_services",
+    "get_cpu_count",
+    "get_memory_mb",
+    "run_task_graph",
     "generate_secret_key",
     "get_config_vars",
     "get_runtime_common_chord_environment",
     "get_runtime_config_vars",
     "get_service_command_preamble",
+    "print_prefixed",
+    "run_with_prefixed_output",
+    "run_runtime_commands",
     "execute_runtime_command",
     "execute_runtime_commands",
     "bash_escape_single_quotes",
@@ -72,9 +87,24 @@ INSTANCE_CONFIG_DEFAULTS = {
 }
 
 
+# Seconds to keep relaying a command's output after it exits, in case it started a background process which keeps
+# its output open.
+OUTPUT_DRAIN_TIMEOUT = 1
+
+# Maximum number of services to run hook commands for at once. Defaults to running hooks one service at a time.
+HOOK_WORKERS = int(os.environ.get("CHORD_HOOK_WORKERS", "1"))
+
+# Configuration files are read, updated and re-written as a whole, so this must not happen concurrently.
+_config_lock = threading.Lock()
+
+# Prevents lines of output from concurrently-running jobs from being interleaved.
+_output_lock = threading.Lock()
+
+
 ConfigVars = Dict[str, str]
 Service = Dict
 ServiceList = List[Service]
+TaskResults = Dict[str, Optional[BaseException]]
 
 
 def json_load_dict_or_empty(path: str) -> Dict:
@@ -84,9 +114,14 @@ def json_load_dict_or_empty(path: str) -> Dict:
     return {}
 
 
-def json_save(obj, path: str) -> None:
-    with open(path, "w") as f:
+def json_save(obj, path: str, mode: int = 0o644) -> None:
+    # Write to a temporary file with the final permissions first, then atomically move it into place, so that
+    # readers never see a partially-written file and secrets are never readable with the wrong permissions.
+    tmp_path = f"{path}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "w") as f:
+        os.chmod(tmp_path, mode)  # In case the file already existed or the umask changed the mode
         json.dump(obj, f)
+    os.replace(tmp_path, path)
 
 
 def load_services() -> ServiceList:
@@ -94,43 +129,125 @@ def load_services() -> ServiceList:
         return [s for s in json.load(f) if not s.get("disabled", False)]
 
 
-def generate_secret_key() -> str:
-    return "".join(random.choice(SECRET_CHARACTERS) for _ in range(SECRET_LENGTH))
+def get_cpu_count() -> int:
+    try:
+        # Respects any CPU affinity restrictions placed on the container
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
 
-def get_config_vars(s: Dict) -> ConfigVars:
-    config = json_load_dict_or_empty(CHORD_SERVICES_CONFIG_PATH)
+def get_memory_mb() -> int:
+    """
+    Gets the amount of memory available to the container, respecting any cgroup (v2 or v1) memory limit.
+    """
 
-    s_artifact = s["type"]["artifact"]
+    limits = []
 
-    if s_artifact not in config:
-        # This should only happen when the image is being built.
+    for limit_path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(limit_path) as lf:
+                limits.append(int(lf.read().strip()) // (1024 * 1024))  # "max" (no limit) is skipped by ValueError
+        except (OSError, ValueError):
+            pass
 
-        config[s_artifact] = {
-            "REDIS_SOCKET": "/chord/tmp/redis.sock",
+    try:
+        with open("/proc/meminfo") as mf:
+            for line in mf:
+                if line.startswith("MemTotal:"):
+                    limits.append(int(line.split()[1]) // 1024)
+                    break
+    except (OSError, ValueError):
+        pass
 
-            "POSTGRES_SOCKET": "/chord/tmp/postgresql/.s.PGSQL.5432",
-            "POSTGRES_SOCKET_DIR": "/chord/tmp/postgresql",
-            "POSTGRES_PORT": "5432",
-            "POSTGRES_DATABASE": f"{s_artifact}_db",
-            "POSTGRES_USER": f"{s_artifact}_acct",
+    return min(limits) if limits else 0
 
-            "SERVICE_ARTIFACT": s_artifact,
-            "SERVICE_SOCKET": f"/chord/tmp/{s_artifact}.sock",
-            "SERVICE_VENV": f"/chord/services/{s_artifact}/env",
-            "SERVICE_URL_BASE_PATH": f"/api/{s_artifact}",
 
-            "SERVICE_DATA": f"/chord/data/{s_artifact}",
-            "SERVICE_LOGS": f"/chord/tmp/logs/{s_artifact}",
-            "SERVICE_TEMP": f"/chord/tmp/data/{s_artifact}",
+def run_task_graph(tasks: Dict[str, Callable[[], None]], dependencies: Optional[Dict[str, Iterable[str]]] = None,
+                   max_workers: Optional[int] = None, fail_fast: bool = True) -> TaskResults:
+    """
+    Runs a set of named tasks on a bounded thread pool, starting each task as soon as all of its dependencies have
+    finished successfully.
+    :param tasks: Mapping of task names to callables which take no arguments
+    :param dependencies: Mapping of task names to the names of tasks which must finish first; names which are not
+                         present in tasks are ignored
+    :param max_workers: Maximum number of tasks to run at once; defaults to the number of available CPUs
+    :param fail_fast: Whether to stop starting new tasks as soon as any task fails
+    :return: Mapping of task names to the exception raised by the task, or None if it succeeded; tasks which were
+             never started (due to a failed dependency or fail_fast) are omitted
+    """
 
-            "SERVICE_ENVIRONMENT": f"/chord/data/{s_artifact}/.environment",
-        }
+    pending = {t: {d for d in (dependencies or {}).get(t, ()) if d in tasks and d != t} for t in tasks}
+
+    # Check for cycles before starting anything, otherwise some tasks would silently never run
+    remaining = {t: set(deps) for t, deps in pending.items()}
+    while remaining:
+        ready = {t for t, deps in remaining.items() if not deps}
+        if not ready:
+            raise ValueError(f"Dependency cycle between tasks: {', '.join(sorted(remaining))}")
+        remaining = {t: deps - ready for t, deps in remaining.items() if t not in ready}
+
+    results: TaskResults = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or get_cpu_count()) as executor:
+        running = {}
+
+        while True:
+            if fail_fast and any(e is not None for e in results.values()):
+                pending.clear()
+
+            for t, deps in tuple(pending.items()):
+                if any(results.get(d) is not None for d in deps if d in results):
+                    # A dependency failed, so this task can never run
+                    del pending[t]
+                elif all(d in results for d in deps):
+                    running[executor.submit(tasks[t])] = t
+                    del pending[t]
+
+            if not running:
+                # Either everything is finished, or anything left depends on a task which failed
+                break
 
-        json_save(config, CHORD_SERVICES_CONFIG_PATH)
-        subprocess.run(("chmod", "644", CHORD_SERVICES_CONFIG_PATH))  # TODO: How to secure properly?
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                results[running.pop(f)] = f.exception()
 
-    return config[s_artifact]
+    return results
+
+
+def generate_secret_key() -> str:
+    return "".join(random.choice(SECRET_CHARACTERS) for _ in range(SECRET_LENGTH))
+
+
+def _generate_service_config(s_artifact: str) -> ConfigVars:
+    return {
+        "REDIS_SOCKET": "/chord/tmp/redis.sock",
+
+        "POSTGRES_SOCKET": "/chord/tmp/postgresql/.s.PGSQL.5432",
+        "POSTGRES_SOCKET_DIR": "/chord/tmp/postgresql",
+        "POSTGRES_PORT": "5432",
+        "POSTGRES_DATABASE": f"{s_artifact}_db",
+        "POSTGRES_USER": f"{s_artifact}_acct",
+
+        "SERVICE_ARTIFACT": s_artifact,
+        "SERVICE_SOCKET": f"/chord/tmp/{s_artifact}.sock",
+        "SERVICE_VENV": f"/chord/services/{s_artifact}/env",
+        "SERVICE_URL_BASE_PATH": f"/api/{s_artifact}",
+
+        "SERVICE_DATA": f"/chord/data/{s_artifact}",
+        "SERVICE_LOGS": f"/chord/tmp/logs/{s_artifact}",
+        "SERVICE_TEMP": f"/chord/tmp/data/{s_artifact}",
+
+        "SERVICE_ENVIRONMENT": f"/chord/data/{s_artifact}/.environment",
+    }
+
+
+def _generate_service_secrets() -> ConfigVars:
+    return {
+        "POSTGRES_PASSWORD": generate_secret_key(),  # Generate a password to be used for the Postgres user
+        "SERVICE_SECRET_KEY": generate_secret_key(),  # Generate a general-purpose secret key
+        "SERVICE_ID": str(uuid.uuid4())  # Generate a unique UUID for the service
+    }
 
 
 def get_runtime_common_chord_environment() -> ConfigVars:
@@ -142,55 +259,214 @@ def get_runtime_common_chord_environment() -> ConfigVars:
     }
 
 
-def get_runtime_config_vars(s: Service) -> ConfigVars:
-    """Should only be run from inside an instance."""
+class ChordConfig:
+    """
+    Loads each configuration file once and resolves configuration variables for all services in a single pass.
+    Any newly-generated configuration (service configuration at build time, secrets on first launch) is only
+    written back to disk when save() is called.
+    """
+
+    def __init__(self, services: ServiceList, build: bool = False):
+        self.build = build
+
+        self._lock = threading.Lock()
+
+        self._services_config = json_load_dict_or_empty(CHORD_SERVICES_CONFIG_PATH)
+        self._services_config_changed = False
+
+        # Runtime configuration files don't exist when the image is being built
+        self._runtime_config = {} if build else json_load_dict_or_empty(RUNTIME_CONFIG_PATH)
+        self._runtime_config_changed = False
+        self.common_environment: ConfigVars = {} if build else get_runtime_common_chord_environment()
+
+        self._config_vars: Dict[str, ConfigVars] = {}
+        self._runtime_config_vars: Dict[str, ConfigVars] = {}
+
+        for s in services:
+            self._resolve(s)
 
-    runtime_config = json_load_dict_or_empty(RUNTIME_CONFIG_PATH)
+    def _resolve(self, s: Service) -> None:
+        s_artifact = s["type"]["artifact"]
 
-    s_artifact = s["type"]["artifact"]
+        if s_artifact not in self._services_config:
+            # This should only happen when the image is being built.
+            self._services_config[s_artifact] = _generate_service_config(s_artifact)
+            self._services_config_changed = True
 
-    if s_artifact not in runtime_config:
-        # Generate Secrets
-        # This should only happen the first time a node is launched.
-        runtime_config[s_artifact] = {
-            "POSTGRES_PASSWORD": generate_secret_key(),  # Generate a password to be used for the Postgres user
-            "SERVICE_SECRET_KEY": generate_secret_key(),  # Generate a general-purpose secret key
-            "SERVICE_ID": str(uuid.uuid4())  # Generate a unique UUID for the service
+        self._config_vars[s_artifact] = self._services_config[s_artifact]
+
+        if self.build:
+            return
+
+        if s_artifact not in self._runtime_config:
+            # Generate Secrets
+            # This should only happen the first time a node is launched.
+            self._runtime_config[s_artifact] = _generate_service_secrets()
+            self._runtime_config_changed = True
+
+        self._runtime_config_vars[s_artifact] = {
+            **self.common_environment,
+            **self._services_config[s_artifact],
+            **self._runtime_config[s_artifact],
         }
 
-    json_save(runtime_config, RUNTIME_CONFIG_PATH)
-    subprocess.run(("chmod", "600", RUNTIME_CONFIG_PATH))
+    def config_vars(self, s: Service) -> ConfigVars:
+        with self._lock:
+            if s["type"]["artifact"] not in self._config_vars:
+                self._resolve(s)
+            return self._config_vars[s["type"]["artifact"]]
 
-    return {
-        **get_runtime_common_chord_environment(),
-        **json_load_dict_or_empty(CHORD_SERVICES_CONFIG_PATH)[s_artifact],
-        **runtime_config[s_artifact]
-    }
+    def runtime_config_vars(self, s: Service) -> ConfigVars:
+        """Should only be run from inside an instance."""
+        with self._lock:
+            if s["type"]["artifact"] not in self._runtime_config_vars:
+                self._resolve(s)
+            return self._runtime_config_vars[s["type"]["artifact"]]
 
+    def save(self) -> None:
+        with self._lock:
+            if self._services_config_changed:
+                json_save(self._services_config, CHORD_SERVICES_CONFIG_PATH, 0o644)  # TODO: How to secure properly?
+                self._services_config_changed = False
 
-def get_service_command_preamble(service: Service, config_vars: ConfigVars) -> Iterable[str]:
-    if service["type"]["language"] == TYPE_PYTHON:
-        yield f"source {config_vars['SERVICE_VENV']}/bin/activate"
+            if self._runtime_config_changed:
+                json_save(self._runtime_config, RUNTIME_CONFIG_PATH, 0o600)
+                self._runtime_config_changed = False
 
-    yield f"source {config_vars['SERVICE_ENVIRONMENT']}"
-    yield f"export $(cut -d= -f1 {config_vars['SERVICE_ENVIRONMENT']})"
 
+def get_config_vars(s: Service) -> ConfigVars:
+    with _config_lock:
+        config = ChordConfig([s], build=True)
+        config.save()
+        return config.config_vars(s)
 
-def execute_runtime_command(s: Service, command: str) -> None:
-    config_vars = get_runtime_config_vars(s)
 
-    commands = (*get_service_command_preamble(s, config_vars),
-                f"{get_env_str(s, config_vars)} {bash_escape_single_quotes(command.format(**config_vars))}")
+def get_runtime_config_vars(s: Service) -> ConfigVars:
+    """Should only be run from inside an instance."""
+    with _config_lock:
+        config = ChordConfig([s])
+        config.save()
+        return config.runtime_config_vars(s)
 
-    try:
-        subprocess.run(f"/bin/bash -c '{' && '.join(commands)}'", shell=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(e, file=sys.stderr, flush=True)
 
+def get_service_command_preamble(service: Service, config_vars: ConfigVars) -> Iterable[str]:
+    if service["type"]["language"] == TYPE_PYTHON:
+        yield f"source {config_vars['SERVICE_VENV']}/bin/activate"
 
-def execute_runtime_commands(s: Service, commands: Tuple[str]) -> None:
-    for command in commands:
-        execute_runtime_command(s, command)
+    # Export everything defined in the environment file without needing to parse it separately
+    yield "set -a"
+    yield f"source {config_vars['SERVICE_ENVIRONMENT']}"
+    yield "set +a"
+
+
+def print_prefixed(prefix: str, line: str, file=sys.stdout) -> None:
+    with _output_lock:
+        print(f"{prefix} {line}", file=file, flush=True)
+
+
+def _relay_prefixed_output(stream, prefix: str) -> None:
+    for line in iter(stream.readline, b""):
+        print_prefixed(prefix, line.decode("utf-8", errors="replace").rstrip())
+
+
+def run_with_prefixed_output(args, prefix: str, **kwargs) -> int:
+    """
+    Runs a process, printing each line of its combined stdout/stderr with a prefix so that output from processes
+    running concurrently can be told apart.
+    :param args: Arguments to pass to subprocess.Popen
+    :param prefix: Prefix for each line of output
+    :return: The exit status of the process
+    """
+
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    relay = threading.Thread(target=_relay_prefixed_output, args=(p.stdout, prefix), daemon=True)
+    relay.start()
+    return_code = p.wait()
+    relay.join(timeout=OUTPUT_DRAIN_TIMEOUT)
+    return return_code
+
+
+class CommandResult(NamedTuple):
+    command: str
+    return_code: Optional[int]  # None if the command was never run
+    duration: float  # seconds
+
+
+def run_runtime_commands(s: Service, commands: Tuple[str, ...], output_prefix: Optional[str] = None,
+                         config_vars: Optional[ConfigVars] = None) -> List[CommandResult]:
+    """
+    Runs all of a service's commands in a single shell session, which only needs to be prepared (virtual environment
+    activated, environment loaded) once. Each command runs in its own subshell, so commands cannot affect each other
+    and one failing does not stop the rest from running.
+    :param s: Service to run the commands for
+    :param commands: Commands to run, which may contain configuration variable placeholders
+    :param output_prefix: If set, each line of output is printed with this prefix
+    :param config_vars: Pre-resolved runtime configuration variables for the service
+    :return: Exit status and duration of each command
+    """
+
+    if not commands:
+        return []
+
+    config_vars = config_vars or get_runtime_config_vars(s)
+    env_str = get_env_str(s, config_vars)
+
+    # The shell reports each command's exit status on a separate pipe, which is closed for the commands themselves
+    # so that any background processes they start don't hold it open.
+    status_r, status_w = os.pipe()
+    script = "\n".join((
+        f"{' && '.join(get_service_command_preamble(s, config_vars))} || exit 1",
+        f"echo ready >&{status_w}",
+        *(f"( {env_str} {command.format(**config_vars)} ) {status_w}>&-\necho $? >&{status_w}" for command in commands),
+    ))
+
+    stdout = subprocess.PIPE if output_prefix is not None else None
+    p = subprocess.Popen(("/bin/bash", "-c", script), pass_fds=(status_w,), stdout=stdout,
+                         stderr=subprocess.STDOUT if stdout else None)
+    os.close(status_w)
+
+    relay = None
+    if output_prefix is not None:
+        relay = threading.Thread(target=_relay_prefixed_output, args=(p.stdout, output_prefix), daemon=True)
+        relay.start()
+
+    timestamps = []
+    return_codes = []
+    with os.fdopen(status_r, "r") as status_f:
+        for line in status_f:
+            timestamps.append(time.monotonic())
+            if line.strip() != "ready":
+                return_codes.append(int(line))
+
+    p.wait()
+    if relay:
+        relay.join(timeout=OUTPUT_DRAIN_TIMEOUT)
+
+    return [CommandResult(command, return_codes[i] if i < len(return_codes) else None,
+                          timestamps[i + 1] - timestamps[i] if i < len(return_codes) else 0.0)
+            for i, command in enumerate(commands)]
+
+
+def execute_runtime_commands(s: Service, commands: Tuple[str, ...], output_prefix: Optional[str] = None,
+                             config_vars: Optional[ConfigVars] = None) -> bool:
+    prefix = output_prefix or f"[{s['type']['artifact']}]"
+    results = run_runtime_commands(s, commands, output_prefix, config_vars)
+
+    for r in results:
+        if r.return_code is None:
+            print_prefixed(prefix, f"Command '{r.command}' was not run.", file=sys.stderr)
+        elif r.return_code != 0:
+            print_prefixed(prefix, f"Command '{r.command}' returned non-zero exit status {r.return_code} "
+                                   f"({r.duration:.2f}s).", file=sys.stderr)
+        else:
+            print_prefixed(prefix, f"Command '{r.command}' succeeded ({r.duration:.2f}s).")
+
+    return all(r.return_code == 0 for r in results)
+
+
+def execute_runtime_command(s: Service, command: str, output_prefix: Optional[str] = None,
+                            config_vars: Optional[ConfigVars] = None) -> bool:
+    return execute_runtime_commands(s, (command,), output_prefix, config_vars)
 
 
 def bash_escape_single_quotes(v: str) -> str:
@@ -212,14 +488,33 @@ def write_environment_dict_to_path(env: Dict[str, str], path: str, export: bool
 
 
 class ContainerJob(ABC):
+    # Whether to record a timing span for the job; off for daemons, which run for as long as the instance does
+    timed = True
+    # Whether the job uses the instance configuration; if not, it's neither loaded nor written back
+    configured = True
+
     def __init__(self, build=False):
         self.build = build
-
-    def main(self) -> None:
-        if len(sys.argv) != 1:
+        self.args = None
+        self.config: Optional[ChordConfig] = None
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(sys.argv[0])
+
+    def parse_args(self, args: List[str]):
+        """
+        Parses any command-line arguments given to the job. By default, jobs do not take any arguments.
+        :param args: Command-line arguments, not including the program name
+        :return: Parsed arguments, available to the job as self.args
+        """
+        if args:
             print(f"Usage: {sys.argv[0]}")
             exit(1)
 
+    def main(self) -> None:
+        self.args = self.parse_args(sys.argv[1:])
+
         singularity_env = "SINGULARITY_ENVIRONMENT" if self.build else "SINGULARITY_CONTAINER"
 
         # TODO: No way of differentiating build from runtime with Docker at the moment
@@ -230,7 +525,25 @@ class ContainerJob(ABC):
         with open(CHORD_SERVICES_SCHEMA_PATH) as chord_services_fh:
             services = load_services()
             validate(instance=services, schema=json.load(chord_services_fh))
+
+        # Load configuration once for the whole job, and write back any changes once it's done
+        if self.configured:
+            self.config = ChordConfig(services, build=self.build)
+
+        if self.build or not self.timed:
+            # Timing spans are only recorded for instance lifecycle jobs, since /chord/tmp only exists at runtime
+            self._run_job(services)
+            return
+
+        with span(self.name):
+            self._run_job(services)
+
+    def _run_job(self, services: ServiceList) -> None:
+        try:
             self.job(services)
+        finally:
+            if self.config is not None:
+                self.config.save()
 
     @abstractmethod
     def job(self, services: ServiceList) -> None:
@@ -241,6 +554,16 @@ class BasicCommandHookContainerJob(ContainerJob):
     commands_key = "commands"
 
     def job(self, services: ServiceList) -> None:
-        # Execute post-start hook commands for any services which have them
-        for s in services:
-            execute_runtime_commands(s, s.get(self.commands_key, ()))
+        # Execute hook commands for any services which have them, for up to HOOK_WORKERS services at once
+        services_with_hooks = [s for s in services if s.get(self.commands_key)]
+        prefix_output = HOOK_WORKERS > 1
+
+        run_task_graph({
+            s["type"]["artifact"]: partial(
+                execute_runtime_commands,
+                s,
+                s[self.commands_key],
+                f"[{s['type']['artifact']}]" if prefix_output else None,
+                self.config.runtime_config_vars(s))
+            for s in services_with_hooks
+        }, max_workers=HOOK_WORKERS, fail_fast=False)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import socketserver
+import threading
+
+from http.server import BaseHTTPRequestHandler
+
+from .chord_common import ServiceList, ContainerJob
+from .metrics import collect_uwsgi_stats, render_uwsgi_metrics
+
+# NGINX proxies /metrics on the internal socket here
+METRICS_SOCKET = "/chord/tmp/metrics.sock"
+METRICS_PID_PATH = "/chord/tmp/metrics.pid"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ContainerMetricsJob(ContainerJob):
+    timed = False
+
+    def job(self, services: ServiceList) -> None:
+        """
+        Serves metrics for all WSGI services, read from their uWSGI stats sockets on each request, over HTTP on
+        METRICS_SOCKET until told to stop (with SIGTERM or SIGINT.)
+        :param services: List of services from chord_services.json
+        """
+
+        wsgi_artifacts = [s["type"]["artifact"] for s in services if s.get("wsgi", True)]
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = render_uwsgi_metrics(collect_uwsgi_stats(wsgi_artifacts)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # UNIX socket clients don't have an address to log, and NGINX already logs requests
+                pass
+
+        if os.path.exists(METRICS_SOCKET):
+            os.remove(METRICS_SOCKET)
+
+        with _UnixHTTPServer(METRICS_SOCKET, MetricsRequestHandler) as server:
+            # serve_forever has to be stopped from another thread than the one it's running in
+            def _stop(_signum, _frame):
+                threading.Thread(target=server.shutdown).start()
+
+            signal.signal(signal.SIGTERM, _stop)
+            signal.signal(signal.SIGINT, _stop)
+
+            with open(METRICS_PID_PATH, "w") as pf:
+                pf.write(f"{os.getpid()}\n")
+
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(METRICS_PID_PATH)
+                os.remove(METRICS_SOCKET)
+
+
+job = ContainerMetricsJob()
+
+if __name__ == "__main__":
+    job.main()
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
-from .chord_common import ServiceList, execute_runtime_command, ContainerJob
+from .chord_common import ConfigVars, Service, ServiceList, execute_runtime_command, ContainerJob
+
+
+def start_non_wsgi_service(service: Service, config_vars: ConfigVars) -> bool:
+    return execute_runtime_command(service, (
+        f"exec nohup {service['service_runnable']} &> {{SERVICE_LOGS}}/{{SERVICE_ARTIFACT}}.log & "
+        f"echo $! > {{SERVICE_TEMP}}/{{SERVICE_ARTIFACT}}.pid"
+    ), f"[{service['type']['artifact']}]", config_vars)
 
 
 class ContainerNonWSGIStartJob(ContainerJob):
     def job(self, services: ServiceList) -> None:
         for service in filter(lambda s: not s.get("wsgi", True), services):
-            execute_runtime_command(service, (
-                f"exec nohup {service['service_runnable']} &> {{SERVICE_LOGS}}/{{SERVICE_ARTIFACT}}.log & "
-                f"echo $! > {{SERVICE_TEMP}}/{{SERVICE_ARTIFACT}}.pid"
-            ))
+            start_non_wsgi_service(service, self.config.runtime_config_vars(service))
 
 
 job = ContainerNonWSGIStartJob()
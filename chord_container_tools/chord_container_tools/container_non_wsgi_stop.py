@@ -1,44 +1,65 @@
 #!/usr/bin/env python3
 
-import time
-import subprocess
 import sys
 
-from .chord_common import ServiceList, get_runtime_config_vars, ContainerJob
-
-SLEEP_TIME = 0.5  # seconds
-MAX_WAIT_TIME = 10  # seconds
+from .chord_common import ServiceList, print_prefixed, ContainerJob
+from .container_supervisor import SUPERVISOR_PID_PATH
+from .processes import (
+    DEFAULT_STOP_GRACE_PERIOD,
+    KILL_WAIT_TIME,
+    STOP_KILLED,
+    STOP_FAILED,
+    get_pid_file_path,
+    read_pid_file,
+    is_running,
+    stop_processes,
+)
 
 
 class ContainerNonWSGIStopJob(ContainerJob):
     def job(self, services: ServiceList) -> None:
         """
-        Stops all non-WSGI services (i.e. services which run their own HTTP server), killing them if needed.
-        :param services: List of all services to first filter to only non-WSGI services and then to kill
+        Stops all non-WSGI services (i.e. services which run their own HTTP server) at the same time, giving each
+        service its stop_grace_period (from chord_services.json) to exit after SIGTERM before killing it.
+        :param services: List of all services to first filter to only non-WSGI services and then to stop
         """
 
-        for service in filter(lambda s: "wsgi" in s and not s["wsgi"], services):
-            config_vars = get_runtime_config_vars(service)
+        def _report(a: str, outcome: str, elapsed: float):
+            print_prefixed(f"[{a}]", f"{outcome.capitalize()} ({elapsed:.2f}s)",
+                           file=sys.stderr if outcome in (STOP_KILLED, STOP_FAILED) else sys.stdout)
+
+        non_wsgi_services = [s for s in services if "wsgi" in s and not s["wsgi"]]
+
+        # If the services are supervised, the supervisor has to be stopped first so it doesn't restart them; it stops
+        # the services itself, giving each of them their grace period.
+        supervisor_pid = read_pid_file(SUPERVISOR_PID_PATH)
+        supervised = supervisor_pid is not None and is_running(supervisor_pid)
+        if supervised:
+            supervisor_grace_period = KILL_WAIT_TIME + max(
+                (s.get("stop_grace_period", DEFAULT_STOP_GRACE_PERIOD) for s in non_wsgi_services), default=0)
+            stop_processes({"supervisor": supervisor_pid}, {"supervisor": supervisor_grace_period}, _report)
+
+        pids = {}
+        grace_periods = {}
+
+        for service in non_wsgi_services:
+            config_vars = self.config.runtime_config_vars(service)
+            a = config_vars["SERVICE_ARTIFACT"]
 
-            try:
-                # Send a kill signal to the service via pkill and the service's process ID
-                pid_file = f"{config_vars['SERVICE_TEMP']}/{config_vars['SERVICE_ARTIFACT']}.pid"
-                subprocess.run(f"/bin/bash -c 'pkill -9 -F {pid_file}'", shell=True, check=True)
+            pid = read_pid_file(get_pid_file_path(config_vars))
+            if pid is None:
+                # The supervisor removes services' PID files once they've stopped
+                if not supervised:
+                    print_prefixed(f"[{a}]", "No valid PID file; not stopping", file=sys.stderr)
+                continue
 
-                wait_iterations = MAX_WAIT_TIME / SLEEP_TIME
-                while wait_iterations > 0:
-                    if subprocess.run(f"/bin/bash -c 'kill -0 \"$(cat {pid_file})\"'", shell=True,
-                                      stderr=subprocess.DEVNULL).returncode == 1:
-                        # The process has been killed already, so kill -0 returns 1 -- i.e. we're done
-                        break
+            pids[a] = pid
+            grace_periods[a] = service.get("stop_grace_period", DEFAULT_STOP_GRACE_PERIOD)
 
-                    # The kill -0 command exited with status 0, meaning it's currently being attempted - try to wait
-                    # until kill has occurred by sleeping and checking the process status again
-                    time.sleep(SLEEP_TIME)
-                    wait_iterations -= 1
+        results = stop_processes(pids, grace_periods, _report)
 
-            except subprocess.CalledProcessError:
-                print(f"Error stopping service {config_vars['SERVICE_ARTIFACT']}", file=sys.stderr)
+        if any(outcome == STOP_FAILED for outcome in results.values()):
+            exit(1)
 
 
 job = ContainerNonWSGIStopJob()
@@ -2,20 +2,27 @@
 
 import os
 import subprocess
+import sys
+
+from functools import partial
+from typing import Iterable, List, Tuple
 
 from .chord_common import (
     CHORD_ENVIRONMENT_PATH,
     ConfigVars,
+    Service,
     ServiceList,
-    get_runtime_common_chord_environment,
+    get_cpu_count,
     execute_runtime_commands,
-    get_runtime_config_vars,
+    print_prefixed,
+    run_task_graph,
     write_environment_dict_to_path,
     ContainerJob,
 )
 
 
-NEW_DATABASE = os.environ.get("NEW_DATABASE", "False") == "True"
+# Maximum number of services to run pre-start operations for at once; set to 1 to handle services one at a time.
+PRE_START_WORKERS = int(os.environ.get("CHORD_PRE_START_WORKERS", "0")) or get_cpu_count()
 
 
 def create_service_directories_if_needed(config_vars: ConfigVars) -> None:
@@ -24,29 +31,88 @@ def create_service_directories_if_needed(config_vars: ConfigVars) -> None:
     subprocess.run(("mkdir", "-m770", "-p", config_vars["SERVICE_TEMP"]), check=True)
 
 
-def configure_postgres_if_needed(config_vars: ConfigVars) -> None:
-    # Set up Postgres for the service
+def _pg_literal(v: str) -> str:
+    return "'" + v.replace("'", "''") + "'"
+
+
+def _pg_values(rows: Iterable[Tuple[str, ...]]) -> str:
+    return ", ".join(f"({', '.join(_pg_literal(v) for v in row)})" for row in rows)
+
+
+def get_postgres_provisioning_sql(config_vars_list: List[ConfigVars]) -> str:
+    """
+    Generates a psql script which creates a user and a database for every service in a handful of batched
+    statements. The script checks the catalog for existing users/databases, so it is safe to run on every boot.
+    Each statement generates the commands to run, which are executed by psql's \\gexec.
+    :param config_vars_list: Configuration variables for every service
+    :return: psql script text
+    """
+
+    users = _pg_values((cv["POSTGRES_USER"],) for cv in config_vars_list)
+    passwords = _pg_values((cv["POSTGRES_USER"], cv["POSTGRES_PASSWORD"]) for cv in config_vars_list)
+    databases = _pg_values((cv["POSTGRES_DATABASE"], cv["POSTGRES_USER"]) for cv in config_vars_list)
+
+    return "\n".join((
+        # Create service users which don't exist yet
+        f"SELECT format('CREATE ROLE %I LOGIN NOSUPERUSER NOCREATEDB NOCREATEROLE', u) FROM (VALUES {users}) AS v(u) "
+        f"WHERE NOT EXISTS (SELECT FROM pg_catalog.pg_roles WHERE rolname = u)",
+        "\\gexec",
+
+        # Set the generated password for each service user
+        f"SELECT format('ALTER ROLE %I ENCRYPTED PASSWORD %L', u, p) FROM (VALUES {passwords}) AS v(u, p)",
+        "\\gexec",
+
+        # Create service databases which don't exist yet, owned by the service user
+        f"SELECT format('CREATE DATABASE %I OWNER %I', d, u) FROM (VALUES {databases}) AS v(d, u) "
+        f"WHERE NOT EXISTS (SELECT FROM pg_catalog.pg_database WHERE datname = d)",
+        "\\gexec",
+
+        # Prevent other users from connecting to the databases
+        f"SELECT format('REVOKE CONNECT ON DATABASE %I FROM PUBLIC', d) FROM (VALUES {databases}) AS v(d, u)",
+        "\\gexec",
+    )) + "\n"
+
+
+def configure_postgres(config_vars_list: List[ConfigVars]) -> bool:
+    """
+    Sets up a Postgres user and database for every service over a single connection, skipping anything which
+    already exists.
+    :param config_vars_list: Configuration variables for every service
+    :return: Whether provisioning succeeded
+    """
+
     # TODO: Store password somewhere secure/locked down
 
-    if not NEW_DATABASE:
-        # Not configuring Postgres for the first time
-        return
+    if not config_vars_list:
+        return True
+
+    cv = config_vars_list[0]  # Socket location is the same for every service
+
+    # The script is passed via stdin so that passwords don't show up in the process list
+    p = subprocess.run(
+        ("psql", "-X", "-q", "-v", "ON_ERROR_STOP=1", "-h", cv["POSTGRES_SOCKET_DIR"], "-p", cv["POSTGRES_PORT"],
+         "-d", "postgres"),
+        input=get_postgres_provisioning_sql(config_vars_list).encode("utf-8"),
+        stdout=subprocess.DEVNULL)
 
-    # Create a service user
-    subprocess.run(("createuser", "-D", "-R", "-S", "-h", config_vars["POSTGRES_SOCKET_DIR"], "-p",
-                    config_vars["POSTGRES_PORT"], config_vars["POSTGRES_USER"]))
+    return p.returncode == 0
 
-    # Create a service database owned by the service user
-    subprocess.run(("createdb", "-O", config_vars["POSTGRES_USER"], config_vars["POSTGRES_DATABASE"]))
 
-    # Prevent other users from connecting to the database
-    subprocess.run(("psql", "-d", config_vars["POSTGRES_DATABASE"], "-c",
-                    f"REVOKE CONNECT ON DATABASE {config_vars['POSTGRES_DATABASE']} FROM PUBLIC;"))
+def get_output_prefix(config_vars: ConfigVars) -> str:
+    return f"[{config_vars['SERVICE_ARTIFACT']}]"
 
-    # Set the generated password for the service user
-    subprocess.run(("psql", "-d", config_vars["POSTGRES_DATABASE"], "-c",
-                    f"ALTER USER {config_vars['POSTGRES_USER']} ENCRYPTED PASSWORD "
-                    f"'{config_vars['POSTGRES_PASSWORD']}'"))
+
+def pre_start_service(s: Service, config_vars: ConfigVars) -> None:
+    # Create required directories if needed at startup
+    create_service_directories_if_needed(config_vars)
+
+    # Write service-specific environment variables to the file system and lock down its permissions
+    write_environment_dict_to_path(config_vars, config_vars["SERVICE_ENVIRONMENT"])
+    subprocess.run(("chmod", "600", config_vars["SERVICE_ENVIRONMENT"]), check=True)
+
+    # Run any chord_services.json specified pre-start commands that may exist
+    if not execute_runtime_commands(s, s.get("pre_start_commands", ()), get_output_prefix(config_vars), config_vars):
+        raise RuntimeError("One or more pre-start commands failed")
 
 
 class ContainerPreStartJob(ContainerJob):
@@ -56,27 +122,36 @@ class ContainerPreStartJob(ContainerJob):
          - Writing common environment variables to a common environment file
          - Creating service directories for data, logs, and temporary files
          - Writing service-specific environment variables to a service environment file
+         - Setting up service Postgres users and databases (all at once, if not already set up)
+        Per-service actions are run for up to PRE_START_WORKERS services at once, with each line of output prefixed
+        by the service's artifact. A summary is printed at the end, and the job fails if any service failed.
         :param services: List of services from chord_services.json
         """
 
         # Write common environment variables to a file for later sourcing
-        write_environment_dict_to_path(get_runtime_common_chord_environment(), CHORD_ENVIRONMENT_PATH, export=True)
+        write_environment_dict_to_path(self.config.common_environment, CHORD_ENVIRONMENT_PATH, export=True)
+
+        config_vars_by_artifact = {s["type"]["artifact"]: self.config.runtime_config_vars(s) for s in services}
 
-        for s in services:
-            config_vars = get_runtime_config_vars(s)
+        # Set up Postgres users and databases for all services in one go
+        postgres_ok = configure_postgres(list(config_vars_by_artifact.values()))
+        if not postgres_ok:
+            print("[CHORD Container Pre-Start] Error: Failed to set up Postgres users and databases", file=sys.stderr)
 
-            # Create required directories if needed at startup
-            create_service_directories_if_needed(config_vars)
+        results = run_task_graph(
+            {s["type"]["artifact"]: partial(pre_start_service, s, config_vars_by_artifact[s["type"]["artifact"]])
+             for s in services},
+            max_workers=PRE_START_WORKERS,
+            fail_fast=False)
 
-            # Write service-specific environment variables to the file system and lock down its permissions
-            write_environment_dict_to_path(config_vars, config_vars["SERVICE_ENVIRONMENT"])
-            subprocess.run(("chmod", "600", config_vars["SERVICE_ENVIRONMENT"]))
+        failed = {a: e for a, e in results.items() if e is not None}
 
-            # Set up the service's Postgres database if not already set up
-            configure_postgres_if_needed(config_vars)
+        print(f"[CHORD Container Pre-Start] {len(results) - len(failed)} of {len(services)} service(s) succeeded")
+        for a, e in failed.items():
+            print_prefixed(get_output_prefix(config_vars_by_artifact[a]), f"Pre-start failed: {e}", file=sys.stderr)
 
-            # Run any chord_services.json specified pre-start commands that may exist
-            execute_runtime_commands(s, s.get("pre_start_commands", ()))
+        if failed or not postgres_ok:
+            exit(1)
 
 
 job = ContainerPreStartJob()
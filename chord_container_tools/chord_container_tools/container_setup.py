@@ -1,18 +1,92 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import os
+import resource
+import stat
 import subprocess
 import sys
+import time
+
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Union
 
 from .chord_common import (
     AUTH_CONFIG_PATH,
     INSTANCE_CONFIG_PATH,
     TYPE_PYTHON,
     TYPE_JAVASCRIPT,
+    Service,
     ServiceList,
-    get_config_vars,
+    ChordConfig,
+    get_cpu_count,
+    get_memory_mb,
+    json_load_dict_or_empty,
+    json_save,
+    run_task_graph,
     ContainerJob,
 )
+from .metrics import get_uwsgi_stats_socket_path
+
+
+# Maximum number of services to provision at once; set to 1 to provision services one after another.
+SETUP_WORKERS = int(os.environ.get("CHORD_SETUP_WORKERS", "0")) or get_cpu_count()
+
+SETUP_LOG_TAIL_LINES = 20
+
+# Whether to build all Python services' packages and dependencies into a shared wheelhouse before creating any
+# virtual environments, then install each virtual environment from the wheelhouse without network access.
+SETUP_WHEELHOUSE = os.environ.get("CHORD_SETUP_WHEELHOUSE", "True") == "True"
+
+# Whether to replace identical files across service virtual environments with hard links to a single copy.
+SETUP_HARDLINK_VENVS = os.environ.get("CHORD_SETUP_HARDLINK_VENVS", "False") == "True"
+
+# Everything in /chord/.cache is removed at the end of the build, so the wheelhouse doesn't end up in the image.
+WHEELHOUSE_PATH = "/chord/.cache/wheelhouse"
+SERVICE_WHEELS_PATH = f"{WHEELHOUSE_PATH}/services"
+# Dependencies of each service, when they have to be resolved per service; merged into the wheelhouse afterwards
+SERVICE_DEPENDENCY_WHEELS_PATH = f"{WHEELHOUSE_PATH}/dependencies"
+WHEEL_ENV = "/chord/.cache/wheel_env"
+# Log for resolving all services' requirements together; kept alongside the per-service setup logs, since
+# /chord/tmp only exists at runtime
+WHEELHOUSE_LOG_PATH = "/chord/services/wheelhouse.log"
+
+# Whether to only provision and generate configuration for services which have changed since the last build, as
+# recorded in the setup manifest. Used when updating an existing image.
+SETUP_INCREMENTAL = os.environ.get("CHORD_SETUP_INCREMENTAL", "False") == "True"
+
+# The setup manifest records a fingerprint of each service as of the last build.
+SETUP_MANIFEST_PATH = os.environ.get("CHORD_SETUP_MANIFEST", "/chord/services/manifest.json")
+
+# Service properties which affect how a service is provisioned or configured at build time.
+FINGERPRINT_KEYS = (
+    "type",
+    "repository",
+    "apt_dependencies",
+    "pre_install_commands",
+    "run_environment",
+    "wsgi",
+    "service_runnable",
+    "python_module",
+    "python_callable",
+    "python_args",
+)
+
+# uWSGI worker settings are rendered into a separate file for each service when the instance starts (see
+# write_uwsgi_workers_confs), since defaults depend on the resources of the host the image is running on.
+# Overrides for the number of CPUs and amount of memory (in MB) to scale default worker counts to; 0 to detect.
+UWSGI_HOST_CPUS = int(os.environ.get("CHORD_UWSGI_HOST_CPUS", "0"))
+UWSGI_HOST_MEMORY_MB = int(os.environ.get("CHORD_UWSGI_HOST_MEMORY_MB", "0"))
+
+UWSGI_WORKER_MEMORY_MB = 200  # Rough estimate of the memory used by a single worker of a Python service
+UWSGI_MEMORY_FRACTION = 0.5  # Fraction of the host's memory which all uWSGI workers together are sized to use
+UWSGI_DEFAULT_THREADS = 1
+UWSGI_DEFAULT_CHEAPER = 1  # Workers kept running when a service is idle
+UWSGI_DEFAULT_CHEAPER_ALGO = "spare"
+
+SOMAXCONN_PATH = "/proc/sys/net/core/somaxconn"
 
 # threads = 4 to allow some "parallel" requests; important for peer discovery/confirmation.
 UWSGI_CONF_TEMPLATE = """[uwsgi]
@@ -24,6 +98,9 @@ harakiri = 610
 lazy-apps = true  # use pre-forking instead, to prevent threading headaches
 buffer-size = 32768  # allow reading of larger headers, for e.g. auth
 socket = {SERVICE_SOCKET}
+# Expose worker stats (including memory usage) for chord_container_metrics
+stats = {uwsgi_stats_socket}
+memory-report = true
 venv = {SERVICE_VENV}
 chdir = /chord/services/{SERVICE_ARTIFACT}
 mount = /api/{SERVICE_ARTIFACT}={service_python_module}:{service_python_callable}
@@ -32,6 +109,8 @@ logto = {SERVICE_LOGS}/{SERVICE_ARTIFACT}.log
 # To solve an issue between werkzeug, uWSGI and reading from a file pointer
 wsgi-disable-file-wrapper = true
 {service_python_args}
+# Load worker settings (processes, threads, cheaper, etc.), which are rendered when the instance starts
+ini = {uwsgi_workers_conf}
 # Import configuration environment variables into uWSGI environment
 for-readline = {SERVICE_ENVIRONMENT}
   env = %(_)
@@ -40,13 +119,31 @@ endfor =
 """
 
 NGINX_CONF_LOCATION = "/usr/local/openresty/nginx/conf/nginx.conf"
+NGINX_WORKERS_CONF_LOCATION = "/chord/tmp/nginx_workers.conf"
+NGINX_EVENTS_CONF_LOCATION = "/chord/tmp/nginx_events.conf"
+NGINX_HTTP_CONF_LOCATION = "/chord/tmp/nginx_http.conf"
+NGINX_LIMIT_REQ_CONF_LOCATION = "/chord/tmp/nginx_limit_req.conf"
 NGINX_UPSTREAMS_CONF_LOCATION = "/usr/local/openresty/nginx/conf/chord_upstreams.conf"
 NGINX_GATEWAY_CONF_TPL_LOCATION = "/usr/local/openresty/nginx/conf/nginx_gateway.conf.template"
 NGINX_GATEWAY_CONF_LOCATION = "/chord/tmp/nginx_gateway.conf"
 NGINX_SERVICES_CONF_LOCATION = "/usr/local/openresty/nginx/conf/chord_services.conf"
+NGINX_ROUTES_LOCATION = "/usr/local/openresty/nginx/conf/bento_routes.json"
+NGINX_CACHE_LOCATION = "/chord/tmp/nginx/cache"
 
 NGINX_GATEWAY_CONF_TPL_TEMPLATE = """
-limit_req_zone $binary_remote_addr zone=external:10m rate=10r/s;
+# Every external request is rate limited per IP address before it reaches the Lua scripts (see
+# write_nginx_workers_confs): requests without credentials by the "external" zone, and requests with credentials (a
+# bearer token, one-time token or session cookie) by the "external_credentialed" zone, which has a higher budget since
+# they're also rate limited per user once authenticated by proxy_auth.lua (see bento_limits.lua.) Each request only
+# counts against one zone, since an empty key isn't counted.
+map "$http_authorization$http_x_ott$cookie_bento_session" $bento_anonymous_limit_key {{
+  ""      $binary_remote_addr;
+  default "";
+}}
+map "$http_authorization$http_x_ott$cookie_bento_session" $bento_credentialed_limit_key {{
+  ""      "";
+  default $binary_remote_addr;
+}}
 
 server {{
   listen LISTEN_ON;  # unix:/chord/tmp/nginx.sock;
@@ -69,7 +166,10 @@ server {{
   #  - use Redis for sessions to allow scaling of NGINX:
   set $session_storage         redis;
   set $session_redis_prefix    oidc;
-  set $session_redis_socket    unix:///chord/tmp/redis.sock;
+
+  # - template value, replaced at startup with the same Redis connection as
+  #   the Lua scripts use (BENTO_REDIS_CONNECTION):
+  SESSION_REDIS_CONNECTION
 
   # - template value, replaced at startup using sed:
   set $session_secret          "SESSION_SECRET";
@@ -79,10 +179,6 @@ server {{
   #   immediately replace the old records for sessions when making a new one.
   set $session_strategy        regenerate;
 
-  # CHORD constants (configuration file locations)
-  set $chord_auth_config     "{auth_config}";
-  set $chord_instance_config "{instance_config}";
-
   # Head off any favicon requests before they pass through the auth flow
   location = /favicon.ico {{
     return 404;
@@ -95,28 +191,36 @@ server {{
     alias /chord/data/web/public/;
   }}
 
-  # For the next few blocks, set up two-stage rate limiting:
-  #   Store:  10 MB worth of IP addresses (~160 000)
-  #   Rate:   10 requests per second.
+  # For the next few blocks, set up two-stage rate limiting per IP address:
+  #   Store:  10 MB worth of IP addresses (~160 000) per zone
+  #   Rate:   10 requests per second without credentials, 100 with (by default.)
   #   Bursts: Allow for bursts of 15 with no delay and an additional 25
-  #          (total 40) queued requests before throwing up 503.
+  #          (total 40) queued requests before throwing up 429 (by default,
+  #          without credentials.)
   #   This limit is for requests from outside the DMZ; internal microservices
   #   currently get unlimited access.
   # See: https://www.nginx.com/blog/rate-limiting-nginx/
+  # Rates and bursts are set with BENTO_RATE_LIMIT_ANONYMOUS_* and BENTO_RATE_LIMIT_CREDENTIALED_* in
+  # instance_config.json.
+
+  # Count requests delayed or rejected by the above (see /api/auth/stats)
+  log_by_lua_block {{
+    require("bento_limits").log()
+  }}
 
   location / {{
-    limit_req zone=external burst=40 delay=15;
+    include {limit_req_conf};
     access_by_lua_file /chord/container_scripts/proxy_auth.lua;
     try_files $uri /index.html;
   }}
 
   location = /api/node-info {{
-    limit_req zone=external burst=40 delay=15;
+    include {limit_req_conf};
     content_by_lua_file /chord/container_scripts/node_info.lua;
   }}
 
   location /api/ {{
-    limit_req zone=external burst=40 delay=15;
+    include {limit_req_conf};
     access_by_lua_file   /chord/container_scripts/proxy_auth.lua;
 
     # TODO: Deduplicate with below?
@@ -125,7 +229,9 @@ server {{
 
     proxy_pass_header    Server;
     proxy_set_header     Upgrade           $http_upgrade;
-    proxy_set_header     Connection        "upgrade";
+    # Only send Connection: upgrade for WebSocket requests, so other connections to the internal server are kept
+    # alive and reused (see the chord_internal upstream)
+    proxy_set_header     Connection        $connection_upgrade;
     proxy_set_header     Host              $http_host;
     proxy_set_header     X-Real-IP         $remote_addr;
     proxy_set_header     X-Forwarded-For   $proxy_add_x_forwarded_for;
@@ -134,7 +240,7 @@ server {{
     # Clear X-CHORD-Internal header and set it to the "off" value (0)
     proxy_set_header     X-CHORD-Internal  "0";
 
-    proxy_pass           http://unix:/chord/tmp/nginx_internal.sock;
+    proxy_pass           http://chord_internal;
 
     client_body_timeout  660s;
     proxy_read_timeout   660s;
@@ -150,11 +256,14 @@ server {{
 NGINX_CONF_TEMPLATE = """
 daemon off;
 
-worker_processes 1;
+# Worker settings (worker_processes, etc.) are rendered when the instance starts; see write_nginx_workers_confs.
+# Any state which must be consistent across workers lives in Lua shared dicts or in Redis, and the session
+# secret is rendered into the gateway configuration once, so every worker uses the same one.
+include {workers_conf};
 pid /chord/tmp/nginx.pid;
 
 events {{
-  worker_connections 1024;
+  include {events_conf};
 }}
 
 http {{
@@ -167,7 +276,9 @@ http {{
   uwsgi_temp_path /chord/tmp/nginx/uwsgi_tmp;
   scgi_temp_path /chord/tmp/nginx/scgi_tmp;
 
-  sendfile off;
+  # sendfile, tcp_nopush, open file caching, Lua shared dict sizes and the per IP address rate limit zones
+  include {http_conf};
+
   keepalive_timeout 660;
 
   server_names_hash_bucket_size 128;
@@ -186,11 +297,20 @@ http {{
   # performance reasons:
   lua_code_cache on;  
 
+  # Lua modules shared by the scripts (e.g. bento_config)
+  lua_package_path "/chord/container_scripts/?.lua;;";
+
+  # Load auth and instance configuration once, before workers are started, rather than on every request; see
+  # bento_config.lua for how it is re-loaded. The route table (see get_route_trie) is only generated at build time.
+  init_by_lua_block {{
+    require("bento_config").init("{auth_config}", "{instance_config}")
+    require("bento_routes").init("{routes}")
+    require("bento_cache").init()
+  }}
+
   lua_ssl_trusted_certificate /etc/ssl/certs/ca-certificates.crt;
   lua_ssl_verify_depth 5;
-  lua_shared_dict discovery 1m;
-  lua_shared_dict jwks 1m;
-  lua_shared_dict introspection 2m;
+  # Shared dicts (discovery, jwks, introspection) are declared along with the other runtime HTTP settings above.
 
   # ======================================
 
@@ -202,6 +322,34 @@ http {{
   # Prevent proxy from trying multiple upstreams.
   proxy_next_upstream off;
 
+  # Whether to skip the response cache for services' cacheable routes (see NGINX_SERVICE_CACHE_TEMPLATE), which is
+  # always the case for internal (service-to-service) requests and private routes, and also the case for any
+  # authenticated request to routes which don't vary by identity, since those are only cached for anonymous users.
+  map "$http_x_chord_internal:$uri" $bento_cache_bypass {{
+    "~^1:"                         1;
+    "~^[^:]*:/api/[^/]+/private"   1;
+    default                        0;
+  }}
+  map "$bento_cache_bypass:$http_x_user" $bento_cache_bypass_anonymous {{
+    "0:"    0;
+    default 1;
+  }}
+
+  # Pass along WebSocket upgrades, but otherwise clear the Connection header
+  # so that upstream connections can be kept alive.
+  map $http_upgrade $connection_upgrade {{
+    default upgrade;
+    ''      '';
+  }}
+
+  # Pool of persistent connections from the gateway to the internal server
+  upstream chord_internal {{
+    server unix:/chord/tmp/nginx_internal.sock;
+    keepalive {internal_keepalive};
+    keepalive_requests 10000;
+    keepalive_timeout 60s;
+  }}
+
   include {upstreams_conf};
 
   include {gateway_conf};
@@ -223,17 +371,89 @@ http {{
       ngx.req.set_header('X-CHORD-Internal', ngx.ctx.chord_internal)
     }}
 
+    # State of supervised non-WSGI services, if any (see chord_container_supervisor.) Only /api/ requests are
+    # proxied here from outside, so this is only reachable via the internal socket.
+    location = /supervisor/state {{
+      default_type application/json;
+      alias /chord/tmp/supervisor_state.json;
+    }}
+
+    # uWSGI metrics for all WSGI services, in the Prometheus text format (see chord_container_metrics)
+    location = /metrics {{
+      proxy_pass http://unix:/chord/tmp/metrics.sock:/metrics;
+    }}
+
+    # Purges services' cached responses, e.g. after their data changes (see bento_cache.lua)
+    location = /cache/purge {{
+      content_by_lua_block {{
+        require("bento_cache").handle_purge()
+      }}
+    }}
+
     include {services_conf};
   }}
 }}
 """
 
+# NGINX worker settings are rendered into separate files when the instance starts (see write_nginx_workers_confs),
+# since defaults depend on the resources of the host the image is running on. Each can be overridden by setting the
+# corresponding NGINX_* key in instance_config.json.
+NGINX_MAX_WORKER_CONNECTIONS = 4096
+NGINX_MAX_WORKER_RLIMIT_NOFILE = 65536
+NGINX_DEFAULT_OPEN_FILE_CACHE = "max=1000 inactive=60s"
+
+# Where sessions and the Lua scripts connect to Redis, unless set with BENTO_REDIS_CONNECTION (see bento_config.lua)
+NGINX_DEFAULT_REDIS_CONNECTION = "unix:/chord/tmp/redis.sock"
+NGINX_DEFAULT_REDIS_PORT = 6379
+
+# Per IP address rate limit zones for external requests, by zone name: the key variable (see the gateway
+# configuration), the instance_config.json key infix, and defaults for requests per second, the number of excess
+# requests to queue, and how many of those aren't delayed. Each can be overridden with a BENTO_RATE_LIMIT_<INFIX>_<NAME>
+# key in instance_config.json; bento_config.lua uses the same ANONYMOUS keys and defaults for requests with credentials
+# which don't authenticate.
+NGINX_IP_RATE_LIMITS = {
+    "external": ("$bento_anonymous_limit_key", "ANONYMOUS", {"RATE": 10, "BURST": 40, "DELAY": 15}),
+    "external_credentialed": ("$bento_credentialed_limit_key", "CREDENTIALED",
+                              {"RATE": 100, "BURST": 400, "DELAY": 200}),
+}
+
+# Sizes of the Lua shared dicts, which are shared between all workers; each can be overridden with an
+# NGINX_LUA_SHARED_DICT_<NAME> key in instance_config.json, e.g. NGINX_LUA_SHARED_DICT_JWKS.
+NGINX_LUA_SHARED_DICT_DEFAULTS = {
+    "discovery": "1m",
+    "jwks": "1m",
+    "introspection": "2m",
+    "bento_bearer_cache": "10m",  # Bearer token user info and roles (see proxy_auth.lua)
+    "bento_session_cache": "10m",  # Session user info and roles (see proxy_auth.lua)
+    "bento_stats": "1m",  # Counters exposed at /api/auth/stats
+    "bento_rate_limits": "10m",  # Per-user rate limiting state (see bento_limits.lua)
+    "bento_config": "1m",  # Configuration generation, bumped to make all workers re-load configuration
+    "bento_cache": "1m",  # Response cache generations, bumped to purge services' cached responses
+}
+
+# Which file (i.e. configuration context) each worker setting is rendered into; everything else goes in the http one
+NGINX_WORKERS_DIRECTIVES = ("worker_processes", "worker_cpu_affinity", "worker_rlimit_nofile")
+NGINX_LIMIT_REQ_DIRECTIVES = tuple(f"limit_req zone={zone}" for zone in NGINX_IP_RATE_LIMITS)
+NGINX_EVENTS_DIRECTIVES = ("worker_connections",)
+
+NGINX_INTERNAL_KEEPALIVE = 64  # Idle connections kept open (per NGINX worker) from the gateway to the internal server
+NGINX_SERVICE_KEEPALIVE = 16  # Idle connections kept open (per NGINX worker) to each non-WSGI service
+
 NGINX_SERVICE_UPSTREAM_TEMPLATE = """
 upstream chord_{s_artifact} {{
   server unix:{s_socket};
 }}
 """
 
+# Non-WSGI services speak HTTP/1.1, so connections to them can be kept alive and reused. uWSGI closes its socket
+# after every request, so WSGI service upstreams don't get a pool.
+NGINX_SERVICE_NON_WSGI_UPSTREAM_TEMPLATE = """
+upstream chord_{s_artifact} {{
+  server unix:{s_socket};
+  keepalive {keepalive};
+}}
+"""
+
 NGINX_SERVICE_BASE_TEMPLATE = """
 location = {base_url} {{
   rewrite ^ {base_url}/;
@@ -242,7 +462,7 @@ location = {base_url} {{
 
 NGINX_SERVICE_WSGI_TEMPLATE = """
 location {base_url} {{
-  include              uwsgi_params;
+  include              /usr/local/openresty/nginx/conf/uwsgi_params;
   # uwsgi_param          HTTP_Host            $http_host;
   # uwsgi_param          HTTP_X-Forwarded-For $proxy_add_x_forwarded_for;
   uwsgi_pass           chord_{s_artifact};
@@ -252,7 +472,7 @@ location {base_url} {{
   client_body_timeout  630s;
   client_max_body_size 200m;
   send_timeout         630s;
-}}
+{cache_conf}}}
 """
 
 NGINX_SERVICE_NON_WSGI_TEMPLATE = """
@@ -261,7 +481,7 @@ location {base_url} {{
 
   proxy_pass_header    Server;
   proxy_set_header     Upgrade           $http_upgrade;
-  proxy_set_header     Connection        "upgrade";
+  proxy_set_header     Connection        $connection_upgrade;
   proxy_pass_header    Host;
   proxy_pass_header    X-Real-IP;
   proxy_set_header     X-Forwarded-For   $proxy_add_x_forwarded_for;
@@ -276,9 +496,47 @@ location {base_url} {{
   client_body_timeout  630s;
   client_max_body_size 200m;
   send_timeout         630s;
-}}
+{cache_conf}}}
+"""
+
+# Response caching for services' cacheable routes, declared with cache in chord_services.json; each service with any
+# gets its own cache (and so its own limits) under NGINX_CACHE_LOCATION. The cache type is uwsgi for WSGI services and
+# proxy for non-WSGI ones.
+NGINX_SERVICE_CACHE_KEYS_ZONE_SIZE = "10m"
+NGINX_SERVICE_CACHE_MAX_SIZE = "1g"
+NGINX_SERVICE_CACHE_INACTIVE = "60m"
+
+NGINX_SERVICE_CACHE_PATH_TEMPLATE = """
+{cache_type}_cache_path {cache_path} levels=1:2 keys_zone=bento_cache_{s_artifact}:{keys_zone_size}
+  max_size={max_size} inactive={inactive} use_temp_path=off;
+"""
+
+# Cache keys start with a generation which is bumped to purge the cache (see bento_cache.lua)
+NGINX_SERVICE_CACHE_TEMPLATE = """
+  # Cache responses ({vary} policy)
+  set_by_lua_block $bento_cache_generation {{
+    return require("bento_cache").get_generation("{s_artifact}")
+  }}
+  {cache_type}_cache           bento_cache_{s_artifact};
+  {cache_type}_cache_key       "$bento_cache_generation:$request_method:$request_uri{vary_key}";
+  {cache_type}_cache_valid     200 {ttl}s;
+  {cache_type}_cache_bypass    {bypass};
+  {cache_type}_no_cache        {bypass};
+  {cache_type}_cache_lock      on;
+  {cache_type}_cache_use_stale updating;
+  add_header           X-Cache-Status $upstream_cache_status;
 """
 
+# What each vary policy adds to the cache key, and which requests skip the cache:
+#   none: responses are the same for everyone; only anonymous requests are cached
+#   role: responses depend on the user's role (owner or not)
+#   user: responses depend on the user
+NGINX_SERVICE_CACHE_VARY = {
+    "none": ("", "$bento_cache_bypass_anonymous"),
+    "role": (":$http_x_user_role", "$bento_cache_bypass"),
+    "user": (":$http_x_user", "$bento_cache_bypass"),
+}
+
 
 def install_apt_dependencies(services: ServiceList):
     apt_dependencies = set().union(*(s.get("apt_dependencies", ()) for s in services))
@@ -292,49 +550,263 @@ def run_pre_install_commands(services: ServiceList):
             subprocess.run(c, shell=True, check=True, stdout=subprocess.DEVNULL)
 
 
-def create_service_virtual_environments(services: ServiceList):
+def get_service_setup_log_path(s: Service) -> str:
+    return f"/chord/services/{s['type']['artifact']}/setup.log"
+
+
+def reset_service_setup_logs(services: ServiceList):
+    # Commands append to each service's log, so start every build with an empty one
     for s in services:
-        s_language = s["type"]["language"]
-        s_artifact = s["type"]["artifact"]
-        s_repo = s["repository"]
-
-        subprocess.run(f"/bin/bash -c 'mkdir -p /chord/services/{s_artifact}'", shell=True, check=True)
-
-        if s_language == TYPE_PYTHON:
-            subprocess.run(
-                f"/bin/bash -c 'cd /chord/services/{s_artifact}; "
-                f"              python3.7 -m virtualenv --system-site-packages -p python3.7 env; "
-                f"              source env/bin/activate; "
-                f"              pip install --no-cache-dir git+{s_repo};"
-                f"              deactivate'",
-                shell=True,
-                check=True,
-                stdout=subprocess.DEVNULL
-            )
-
-        elif s_language == TYPE_JAVASCRIPT:
-            subprocess.run(
-                f"/bin/bash -c 'cd /chord/services/{s_artifact}; "
-                f"              npm install -g {s_repo}'",
-                shell=True,
-                check=True,
-                stdout=subprocess.DEVNULL
-            )
-
-        else:
-            raise NotImplementedError(f"Unknown language: {s_language}")
-
-
-def _generate_uwsgi_confs(services: ServiceList):
+        os.makedirs(f"/chord/services/{s['type']['artifact']}", exist_ok=True)
+        open(get_service_setup_log_path(s), "w").close()
+
+
+def _run_logged(s: Service, command: str):
+    # Keep a per-service log, since output from concurrent installs would otherwise be interleaved
+    with open(get_service_setup_log_path(s), "a") as lf:
+        subprocess.run(f"/bin/bash -c '{command}'", shell=True, check=True, stdout=lf, stderr=subprocess.STDOUT)
+
+
+def build_service_wheel(s: Service):
+    s_artifact = s["type"]["artifact"]
+
+    subprocess.run(f"/bin/bash -c 'mkdir -p /chord/services/{s_artifact}'", shell=True, check=True)
+
+    # Build only the service package itself here; dependencies are resolved for all services at once afterwards
+    _run_logged(s, f"{WHEEL_ENV}/bin/pip wheel --no-deps --wheel-dir {SERVICE_WHEELS_PATH}/{s_artifact} "
+                   f"git+{s['repository']}")
+
+
+def build_service_dependency_wheels(s: Service, service_wheel: str):
+    # Each service gets its own wheel directory, so that no pip process reads (via --find-links) a wheel which
+    # another is still writing
+    _run_logged(s, f"{WHEEL_ENV}/bin/pip wheel --wheel-dir {SERVICE_DEPENDENCY_WHEELS_PATH}/{s['type']['artifact']} "
+                   f"--find-links {WHEELHOUSE_PATH} {service_wheel}")
+
+
+def merge_service_dependency_wheels():
+    # Wheels with the same file name are the same version of the same package, so only one copy of each is kept
+    for dependencies_dir in os.listdir(SERVICE_DEPENDENCY_WHEELS_PATH):
+        for w in os.listdir(f"{SERVICE_DEPENDENCY_WHEELS_PATH}/{dependencies_dir}"):
+            if w.endswith(".whl") and not os.path.exists(f"{WHEELHOUSE_PATH}/{w}"):
+                os.replace(f"{SERVICE_DEPENDENCY_WHEELS_PATH}/{dependencies_dir}/{w}", f"{WHEELHOUSE_PATH}/{w}")
+
+
+def get_service_wheel(s: Service) -> str:
+    wheel_dir = f"{SERVICE_WHEELS_PATH}/{s['type']['artifact']}"
+    wheels = [w for w in os.listdir(wheel_dir) if w.endswith(".whl")]
+    if len(wheels) != 1:
+        raise ValueError(f"Expected exactly one wheel in {wheel_dir}, found {len(wheels)}")
+    return f"{wheel_dir}/{wheels[0]}"
+
+
+def build_wheelhouse(services: ServiceList, max_workers: int = SETUP_WORKERS) -> Dict[str, str]:
+    """
+    Builds a wheelhouse containing every Python service's package and all of their dependencies, so that each
+    distinct wheel is only built once and service virtual environments can be installed without network access.
+    :param services: List of services from chord_services.json
+    :param max_workers: Maximum number of service packages to build at once
+    :return: Mapping of Python service artifacts to the paths of their own package wheels
+    """
+
+    python_services = [s for s in services if s["type"]["language"] == TYPE_PYTHON]
+    if not python_services:
+        return {}
+
+    # Use an up-to-date pip, which resolves all services' requirements together rather than first-come-first-serve
+    subprocess.run(f"/bin/bash -c 'python3.7 -m virtualenv -p python3.7 {WHEEL_ENV} && "
+                   f"              {WHEEL_ENV}/bin/pip install --upgrade pip wheel'",
+                   shell=True, check=True, stdout=subprocess.DEVNULL)
+
+    run_service_setup_tasks(python_services, build_service_wheel, {}, max_workers, "build")
+
+    service_wheels = {s["type"]["artifact"]: get_service_wheel(s) for s in python_services}
+
+    try:
+        with open(WHEELHOUSE_LOG_PATH, "w") as lf:
+            subprocess.run((f"{WHEEL_ENV}/bin/pip", "wheel", "--wheel-dir", WHEELHOUSE_PATH, "--find-links",
+                            WHEELHOUSE_PATH, *service_wheels.values()), check=True, stdout=lf,
+                           stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        # Services have conflicting requirements; fall back to resolving each service on its own. Wheels shared
+        # between services are still only built once, since they end up in the (shared) pip cache.
+        print(f"[CHORD Container Setup]    Could not resolve all requirements together (see {WHEELHOUSE_LOG_PATH}); "
+              f"resolving per service")
+        run_service_setup_tasks(
+            python_services,
+            lambda s: build_service_dependency_wheels(s, service_wheels[s["type"]["artifact"]]),
+            {}, max_workers, "resolve")
+        merge_service_dependency_wheels()
+
+    return service_wheels
+
+
+def create_service_virtual_environment(s: Service, service_wheel: Optional[str] = None):
+    s_language = s["type"]["language"]
+    s_artifact = s["type"]["artifact"]
+    s_repo = s["repository"]
+
+    subprocess.run(f"/bin/bash -c 'mkdir -p /chord/services/{s_artifact}'", shell=True, check=True)
+
+    start_time = time.time()
+
+    if s_language == TYPE_PYTHON:
+        # If the offline install fails (e.g. due to a direct URL requirement), fall back to using the index as well
+        pip_install = (f"(pip install --no-index --find-links {WHEELHOUSE_PATH} {service_wheel} || "
+                       f" pip install --find-links {WHEELHOUSE_PATH} {service_wheel})" if service_wheel
+                       else f"pip install --no-cache-dir git+{s_repo}")
+        _run_logged(s, f"cd /chord/services/{s_artifact}; "
+                       f"rm -rf env; "
+                       f"python3.7 -m virtualenv --system-site-packages -p python3.7 env && "
+                       f"source env/bin/activate && "
+                       f"{pip_install} && "
+                       f"deactivate")
+
+    elif s_language == TYPE_JAVASCRIPT:
+        _run_logged(s, f"cd /chord/services/{s_artifact}; npm install -g {s_repo}")
+
+    else:
+        raise NotImplementedError(f"Unknown language: {s_language}")
+
+    print(f"[CHORD Container Setup]    {s_artifact}: done ({time.time() - start_time:.1f}s)", flush=True)
+
+
+def get_install_dependencies(services: ServiceList) -> Dict[str, List[str]]:
+    dependencies = {s["type"]["artifact"]: list(s.get("install_after", ())) for s in services}
+
+    # Global npm installs share a prefix, so JavaScript services are always installed one after another
+    js_artifacts = [s["type"]["artifact"] for s in services if s["type"]["language"] == TYPE_JAVASCRIPT]
+    for previous, current in zip(js_artifacts, js_artifacts[1:]):
+        dependencies[current].append(previous)
+
+    return dependencies
+
+
+def _print_setup_log_tail(s: Service):
+    try:
+        with open(get_service_setup_log_path(s), "r") as lf:
+            for line in lf.readlines()[-SETUP_LOG_TAIL_LINES:]:
+                print(f"[CHORD Container Setup]        {line.rstrip()}", file=sys.stderr)
+    except OSError:
+        pass
+
+
+def run_service_setup_tasks(services: ServiceList, task: Callable[[Service], None],
+                            dependencies: Dict[str, Iterable[str]], max_workers: int, verb: str):
+    """
+    Runs a setup task for each service, running up to max_workers tasks at once. If any task fails, no new tasks
+    are started and the build is aborted with a summary of the failure(s).
+    :param services: List of services to run the task for
+    :param task: Setup task, called with each service
+    :param dependencies: Mapping of service artifacts to artifacts of services whose task must finish first
+    :param max_workers: Maximum number of tasks to run at once
+    :param verb: Description of the task for the failure summary, e.g. "install"
+    """
+
+    services_by_artifact = {s["type"]["artifact"]: s for s in services}
+
+    try:
+        results = run_task_graph({a: partial(task, s) for a, s in services_by_artifact.items()}, dependencies,
+                                 max_workers=max_workers)
+    except ValueError as e:  # Dependency cycle in install_after
+        print(f"Error: {e}", file=sys.stderr)
+        exit(1)
+
+    failed = {a: e for a, e in results.items() if e is not None}
+    if not failed:
+        return
+
+    print(f"[CHORD Container Setup] Error: {len(failed)} service(s) failed to {verb}:", file=sys.stderr)
+    for a, e in failed.items():
+        print(f"[CHORD Container Setup]    {a}: {e}", file=sys.stderr)
+        print(f"[CHORD Container Setup]    Last lines of {get_service_setup_log_path(services_by_artifact[a])}:",
+              file=sys.stderr)
+        _print_setup_log_tail(services_by_artifact[a])
+
+    not_run = sorted(set(services_by_artifact) - set(results))
+    if not_run:
+        print(f"[CHORD Container Setup] Not run due to failures: {', '.join(not_run)}", file=sys.stderr)
+
+    exit(1)
+
+
+def create_service_virtual_environments(services: ServiceList, max_workers: int = SETUP_WORKERS,
+                                        service_wheels: Optional[Dict[str, str]] = None):
+    """
+    Creates virtual environments and installs packages for all services, running up to max_workers installations
+    at once. Services listing other services in install_after are only installed once those services are done.
+    If any service fails to install, no new installations are started and the build is aborted with a summary.
+    :param services: List of services from chord_services.json
+    :param max_workers: Maximum number of services to install at once
+    :param service_wheels: Mapping of Python service artifacts to their package wheels in the wheelhouse, if built
+    """
+
+    service_wheels = service_wheels or {}
+    run_service_setup_tasks(
+        services,
+        lambda s: create_service_virtual_environment(s, service_wheels.get(s["type"]["artifact"])),
+        get_install_dependencies(services),
+        max_workers,
+        "install")
+
+
+def hardlink_identical_files(root_paths: Iterable[str]) -> int:
+    """
+    Replaces files with identical contents and permissions found under any of the given paths with hard links to a
+    single copy of the file.
+    :param root_paths: Directories to search for duplicate files
+    :return: Number of bytes saved
+    """
+
+    files_by_key = defaultdict(list)
+    for root_path in root_paths:
+        for dir_path, _, file_names in os.walk(root_path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                    files_by_key[(st.st_size, st.st_mode, st.st_dev)].append((path, st.st_ino))
+
+    saved = 0
+
+    for (size, _, _), files in files_by_key.items():
+        if len(files) < 2:
+            continue
+
+        first_by_hash = {}
+        for path, inode in files:
+            with open(path, "rb") as f:
+                h = hashlib.sha256(f.read()).digest()
+
+            if h not in first_by_hash:
+                first_by_hash[h] = (path, inode)
+                continue
+
+            first_path, first_inode = first_by_hash[h]
+            if inode == first_inode:
+                continue
+
+            # Link to a temporary name first so the original is never missing
+            tmp_path = f"{path}.chord_link"
+            os.link(first_path, tmp_path)
+            os.replace(tmp_path, path)
+            saved += size
+
+    return saved
+
+
+def _generate_uwsgi_confs(services: ServiceList, config: ChordConfig):
     for s in services:
         if not s.get("wsgi", True):
             continue
 
-        config_vars = get_config_vars(s)
+        config_vars = config.config_vars(s)
         yield (s, UWSGI_CONF_TEMPLATE.format(
             **config_vars,
             service_python_module=s["python_module"],
             service_python_callable=s["python_callable"],
+            uwsgi_workers_conf=get_uwsgi_workers_conf_path(config_vars["SERVICE_ARTIFACT"]),
+            uwsgi_stats_socket=get_uwsgi_stats_socket_path(config_vars["SERVICE_ARTIFACT"]),
             service_python_args=(f"pyargv = {' '.join(a.format(**config_vars) for a in s['python_args'])}"
                                  if "python_args" in s else ""),
             service_run_environment="\n".join(f"env = {e}={val.format(**config_vars)}"
@@ -342,11 +814,15 @@ def _generate_uwsgi_confs(services: ServiceList):
         ))
 
 
-def write_uwsgi_confs(services: ServiceList):
-    for s, c in _generate_uwsgi_confs(services):
-        conf_path = f"/chord/vassals/{s['type']['artifact']}.ini"  # TODO: Make this a config var / template
+def get_uwsgi_conf_path(s_artifact: str) -> str:
+    return f"/chord/vassals/{s_artifact}.ini"  # TODO: Make this a config var / template
 
-        if os.path.exists(conf_path):
+
+def write_uwsgi_confs(services: ServiceList, config: ChordConfig, overwrite: bool = False):
+    for s, c in _generate_uwsgi_confs(services, config):
+        conf_path = get_uwsgi_conf_path(s["type"]["artifact"])
+
+        if os.path.exists(conf_path) and not overwrite:
             print(f"Error: File already exists: '{conf_path}'", file=sys.stderr)
             exit(1)
 
@@ -354,34 +830,287 @@ def write_uwsgi_confs(services: ServiceList):
             uf.write(c)
 
 
-def write_nginx_confs(services: ServiceList):
+def get_uwsgi_workers_conf_path(s_artifact: str) -> str:
+    return f"/chord/tmp/uwsgi/{s_artifact}.workers.ini"
+
+
+def _get_somaxconn() -> Optional[int]:
+    try:
+        with open(SOMAXCONN_PATH) as sf:
+            return int(sf.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def get_uwsgi_worker_settings(s: Service, n_wsgi_services: int, cpu_count: int,
+                              memory_mb: int) -> Dict[str, Union[int, str]]:
+    """
+    Works out uWSGI worker settings for a service from its uwsgi settings in chord_services.json, falling back to
+    defaults scaled to the host: as many workers as there are CPUs, unless the host doesn't have enough memory for
+    every service to have that many. Idle workers are stopped (down to the cheaper minimum) when load drops.
+    :param s: Service to get worker settings for
+    :param n_wsgi_services: Number of WSGI services sharing the host
+    :param cpu_count: Number of CPUs on the host
+    :param memory_mb: Memory on the host, in MB, or 0 if unknown
+    :return: Mapping of uWSGI option names to values
+    """
+
+    uwsgi_settings = s.get("uwsgi", {})
+
+    default_processes = cpu_count
+    if memory_mb:
+        default_processes = min(default_processes, int(memory_mb * UWSGI_MEMORY_FRACTION) // (
+            UWSGI_WORKER_MEMORY_MB * max(n_wsgi_services, 1)))
+
+    processes = uwsgi_settings.get("processes", max(default_processes, 1))
+    worker_settings = {
+        "master": "true",  # Needed to manage multiple workers (respawning, cheaper, max-requests)
+        "processes": processes,
+        "threads": uwsgi_settings.get("threads", UWSGI_DEFAULT_THREADS),
+    }
+
+    cheaper = uwsgi_settings.get("cheaper", UWSGI_DEFAULT_CHEAPER)
+    if 0 < cheaper < processes:
+        worker_settings["cheaper-algo"] = uwsgi_settings.get("cheaper_algo", UWSGI_DEFAULT_CHEAPER_ALGO)
+        worker_settings["cheaper"] = cheaper
+        worker_settings["cheaper-initial"] = uwsgi_settings.get("cheaper_initial", cheaper)
+    elif "cheaper" in uwsgi_settings and cheaper > 0:
+        print(f"Warning: Ignoring uWSGI cheaper for {s['type']['artifact']}: must be less than processes "
+              f"({processes})", file=sys.stderr)
+
+    if uwsgi_settings.get("max_requests"):
+        worker_settings["max-requests"] = uwsgi_settings["max_requests"]
+
+    if "listen" in uwsgi_settings:
+        # uWSGI refuses to start if the listen backlog is larger than the kernel allows
+        somaxconn = _get_somaxconn()
+        worker_settings["listen"] = uwsgi_settings["listen"]
+        if somaxconn is not None and uwsgi_settings["listen"] > somaxconn:
+            print(f"Warning: Limiting uWSGI listen backlog for {s['type']['artifact']} to net.core.somaxconn "
+                  f"({somaxconn})", file=sys.stderr)
+            worker_settings["listen"] = somaxconn
+
+    return worker_settings
+
+
+def write_uwsgi_workers_confs(services: ServiceList) -> Dict[str, Dict[str, Union[int, str]]]:
+    """
+    Should only be run from inside an instance, before uWSGI is started.
+    :return: Worker settings written for each WSGI service
+    """
+
+    wsgi_services = [s for s in services if s.get("wsgi", True)]
+    cpu_count = UWSGI_HOST_CPUS or get_cpu_count()
+    memory_mb = UWSGI_HOST_MEMORY_MB or get_memory_mb()
+
+    all_worker_settings = {}
+
+    for s in wsgi_services:
+        worker_settings = get_uwsgi_worker_settings(s, len(wsgi_services), cpu_count, memory_mb)
+        with open(get_uwsgi_workers_conf_path(s["type"]["artifact"]), "w") as wf:
+            wf.write("[uwsgi]\n")
+            wf.writelines(f"{k} = {v}\n" for k, v in worker_settings.items())
+        all_worker_settings[s["type"]["artifact"]] = worker_settings
+
+    return all_worker_settings
+
+
+def _get_nofile_hard_limit() -> int:
+    hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+    return NGINX_MAX_WORKER_RLIMIT_NOFILE if hard_limit == resource.RLIM_INFINITY else hard_limit
+
+
+def _on_off(v: Union[bool, str]) -> str:
+    return v if isinstance(v, str) else ("on" if v else "off")
+
+
+def _get_limit_req_rate(zone: str, rate: float) -> str:
+    # NGINX only takes whole numbers of requests per second or per minute, so fractional rates are given per minute
+    if rate <= 0:
+        raise ValueError(f"Rate limit for {zone} must be positive, got {rate}")
+    if float(rate).is_integer():
+        return f"{int(rate)}r/s"
+    per_minute = round(rate * 60, 6)
+    if not per_minute.is_integer():
+        raise ValueError(f"Rate limit for {zone} must be a whole number of requests per second or minute, got {rate}")
+    return f"{int(per_minute)}r/m"
+
+
+def get_nginx_worker_settings(instance_config: Dict, cpu_count: int, nofile_limit: int) -> Dict[str, str]:
+    """
+    Works out NGINX worker settings from NGINX_* keys in the instance configuration, falling back to defaults scaled
+    to the host: a worker per CPU, each pinned to its own CPU, and as many connections per worker as its file
+    descriptor limit allows (each proxied request uses two.)
+    :param instance_config: Instance configuration (from instance_config.json)
+    :param cpu_count: Number of CPUs on the host
+    :param nofile_limit: Hard limit on open files for the NGINX processes
+    :return: Mapping of NGINX directives (including any arguments before the value) to values
+    """
+
+    worker_processes = int(instance_config.get("NGINX_WORKER_PROCESSES", cpu_count))
+    worker_rlimit_nofile = int(instance_config.get("NGINX_WORKER_RLIMIT_NOFILE",
+                                                   min(nofile_limit, NGINX_MAX_WORKER_RLIMIT_NOFILE)))
+
+    worker_settings = {"worker_processes": str(worker_processes)}
+
+    # Only pin workers by default if there's exactly one for each CPU; "" to not pin them at all
+    cpu_affinity = instance_config.get("NGINX_WORKER_CPU_AFFINITY",
+                                       "auto" if 1 < worker_processes == cpu_count else "")
+    if cpu_affinity:
+        worker_settings["worker_cpu_affinity"] = cpu_affinity
+
+    worker_settings["worker_rlimit_nofile"] = str(worker_rlimit_nofile)
+    worker_settings["worker_connections"] = str(instance_config.get(
+        "NGINX_WORKER_CONNECTIONS", max(min(worker_rlimit_nofile // 2, NGINX_MAX_WORKER_CONNECTIONS), 1)))
+
+    worker_settings["sendfile"] = _on_off(instance_config.get("NGINX_SENDFILE", True))
+    worker_settings["tcp_nopush"] = _on_off(instance_config.get("NGINX_TCP_NOPUSH", True))
+
+    open_file_cache = instance_config.get("NGINX_OPEN_FILE_CACHE", NGINX_DEFAULT_OPEN_FILE_CACHE) or "off"
+    worker_settings["open_file_cache"] = open_file_cache
+    if open_file_cache != "off":
+        worker_settings["open_file_cache_valid"] = "60s"
+        worker_settings["open_file_cache_min_uses"] = "2"
+
+    for name, default_size in NGINX_LUA_SHARED_DICT_DEFAULTS.items():
+        worker_settings[f"lua_shared_dict {name}"] = instance_config.get(
+            f"NGINX_LUA_SHARED_DICT_{name.upper()}", default_size)
+
+    worker_settings["limit_req_status"] = "429"
+    for zone, (key, infix, defaults) in NGINX_IP_RATE_LIMITS.items():
+        rate_limit = {k: instance_config.get(f"BENTO_RATE_LIMIT_{infix}_{k}", v) for k, v in defaults.items()}
+        rate = _get_limit_req_rate(zone, float(rate_limit["RATE"]))
+        burst, delay = int(rate_limit["BURST"]), int(rate_limit["DELAY"])
+        if delay > burst:
+            raise ValueError(f"Rate limit delay for {zone} ({delay}) cannot be greater than its burst ({burst})")
+        worker_settings[f"limit_req_zone {key} zone={zone}:10m"] = f"rate={rate}"
+        worker_settings[f"limit_req zone={zone}"] = f"burst={burst} delay={delay}"
+
+    return worker_settings
+
+
+def get_nginx_session_redis_conf(instance_config: Dict) -> str:
+    """
+    Works out the lua-resty-session Redis directives from BENTO_REDIS_CONNECTION, parsed the same way as the Lua
+    scripts do, so sessions are kept in the same Redis as everything else.
+    :param instance_config: Instance configuration (from instance_config.json)
+    :return: NGINX directives, for the gateway server block
+    """
+
+    connection = instance_config.get("BENTO_REDIS_CONNECTION", NGINX_DEFAULT_REDIS_CONNECTION)
+    if connection.startswith("unix:"):
+        return f"set $session_redis_socket {connection};"
+
+    host, _, port = connection.partition(":")
+    return f"set $session_redis_host {host};\n  set $session_redis_port {port or NGINX_DEFAULT_REDIS_PORT};"
+
+
+def write_nginx_workers_confs(instance_config: Dict) -> Dict[str, str]:
+    """
+    Should only be run from inside an instance, before NGINX is started.
+    :param instance_config: Instance configuration (from instance_config.json)
+    :return: Worker settings written
+    """
+
+    worker_settings = get_nginx_worker_settings(instance_config, get_cpu_count(), _get_nofile_hard_limit())
+
+    confs = {NGINX_WORKERS_CONF_LOCATION: "", NGINX_EVENTS_CONF_LOCATION: "", NGINX_HTTP_CONF_LOCATION: "",
+             NGINX_LIMIT_REQ_CONF_LOCATION: ""}
+    for k, v in worker_settings.items():
+        conf_location = (NGINX_WORKERS_CONF_LOCATION if k in NGINX_WORKERS_DIRECTIVES
+                         else NGINX_EVENTS_CONF_LOCATION if k in NGINX_EVENTS_DIRECTIVES
+                         else NGINX_LIMIT_REQ_CONF_LOCATION if k in NGINX_LIMIT_REQ_DIRECTIVES
+                         else NGINX_HTTP_CONF_LOCATION)
+        confs[conf_location] += f"{k} {v};\n"
+
+    for conf_location, conf in confs.items():
+        with open(conf_location, "w") as nf:
+            nf.write(conf)
+
+    return worker_settings
+
+
+def get_route_trie(services: ServiceList, config: ChordConfig) -> Dict:
+    # Prefix trie of service base paths, keyed by path segment, which proxy_auth.lua uses (via bento_routes.lua) to
+    # classify requests without matching the URI against each service in turn, and to find any per-service rate limit.
+    trie = {"children": {}}
+
+    for s in services:
+        config_vars = config.config_vars(s)
+        node = trie
+        for segment in config_vars["SERVICE_URL_BASE_PATH"].strip("/").split("/"):
+            node = node["children"].setdefault(segment, {"children": {}})
+        node["service"] = {
+            "artifact": config_vars["SERVICE_ARTIFACT"],
+            "wsgi": s.get("wsgi", True),
+            **({"rate_limit": {"burst": 0, "delay": 0, **s["rate_limit"]}} if "rate_limit" in s else {}),
+        }
+
+    return trie
+
+
+def write_nginx_confs(services: ServiceList, config: ChordConfig):
     nginx_conf = NGINX_CONF_TEMPLATE.format(
         upstreams_conf=NGINX_UPSTREAMS_CONF_LOCATION,
         gateway_conf=NGINX_GATEWAY_CONF_LOCATION,
         services_conf=NGINX_SERVICES_CONF_LOCATION,
-    )
-    nginx_gateway_conf_tpl = NGINX_GATEWAY_CONF_TPL_TEMPLATE.format(
+        workers_conf=NGINX_WORKERS_CONF_LOCATION,
+        events_conf=NGINX_EVENTS_CONF_LOCATION,
+        http_conf=NGINX_HTTP_CONF_LOCATION,
         auth_config=AUTH_CONFIG_PATH,
         instance_config=INSTANCE_CONFIG_PATH,
+        routes=NGINX_ROUTES_LOCATION,
+        internal_keepalive=NGINX_INTERNAL_KEEPALIVE,
     )
+    nginx_gateway_conf_tpl = NGINX_GATEWAY_CONF_TPL_TEMPLATE.format(limit_req_conf=NGINX_LIMIT_REQ_CONF_LOCATION)
     nginx_upstreams_conf = ""
     nginx_services_conf = ""
 
     for s in services:
-        config_vars = get_config_vars(s)
+        config_vars = config.config_vars(s)
 
         # Upstream
-        nginx_upstreams_conf += NGINX_SERVICE_UPSTREAM_TEMPLATE.format(s_artifact=config_vars["SERVICE_ARTIFACT"],
-                                                                       s_socket=config_vars["SERVICE_SOCKET"])
+        nginx_upstreams_conf += (NGINX_SERVICE_UPSTREAM_TEMPLATE if "wsgi" not in s or s["wsgi"]
+                                 else NGINX_SERVICE_NON_WSGI_UPSTREAM_TEMPLATE).format(
+            s_artifact=config_vars["SERVICE_ARTIFACT"],
+            s_socket=config_vars["SERVICE_SOCKET"],
+            keepalive=NGINX_SERVICE_KEEPALIVE)
 
         # Service location wrapper
         nginx_services_conf += NGINX_SERVICE_BASE_TEMPLATE.format(base_url=config_vars["SERVICE_URL_BASE_PATH"],
                                                                   s_artifact=config_vars["SERVICE_ARTIFACT"])
 
         # Named location
-        nginx_services_conf += (NGINX_SERVICE_WSGI_TEMPLATE if "wsgi" not in s or s["wsgi"]
-                                else NGINX_SERVICE_NON_WSGI_TEMPLATE).format(
-            base_url=config_vars["SERVICE_URL_BASE_PATH"], s_artifact=config_vars["SERVICE_ARTIFACT"])
+        service_template = (NGINX_SERVICE_WSGI_TEMPLATE if "wsgi" not in s or s["wsgi"]
+                            else NGINX_SERVICE_NON_WSGI_TEMPLATE)
+        nginx_services_conf += service_template.format(
+            base_url=config_vars["SERVICE_URL_BASE_PATH"], s_artifact=config_vars["SERVICE_ARTIFACT"], cache_conf="")
+
+        # Cacheable routes, each with its own copy of the service location plus caching
+        if s.get("cache"):
+            cache_type = "uwsgi" if "wsgi" not in s or s["wsgi"] else "proxy"
+
+            nginx_upstreams_conf += NGINX_SERVICE_CACHE_PATH_TEMPLATE.format(
+                cache_type=cache_type,
+                cache_path=f"{NGINX_CACHE_LOCATION}/{config_vars['SERVICE_ARTIFACT']}",
+                s_artifact=config_vars["SERVICE_ARTIFACT"],
+                keys_zone_size=NGINX_SERVICE_CACHE_KEYS_ZONE_SIZE,
+                max_size=NGINX_SERVICE_CACHE_MAX_SIZE,
+                inactive=NGINX_SERVICE_CACHE_INACTIVE)
+
+            for route in s["cache"]:
+                vary = route.get("vary", "none")
+                vary_key, bypass = NGINX_SERVICE_CACHE_VARY[vary]
+                nginx_services_conf += service_template.format(
+                    base_url=config_vars["SERVICE_URL_BASE_PATH"] + route["path"],
+                    s_artifact=config_vars["SERVICE_ARTIFACT"],
+                    cache_conf=NGINX_SERVICE_CACHE_TEMPLATE.format(
+                        cache_type=cache_type,
+                        s_artifact=config_vars["SERVICE_ARTIFACT"],
+                        vary=vary,
+                        vary_key=vary_key,
+                        ttl=route["ttl"],
+                        bypass=bypass))
 
     # Write configurations to the container file system
 
@@ -397,28 +1126,94 @@ def write_nginx_confs(services: ServiceList):
     with open(NGINX_SERVICES_CONF_LOCATION, "w") as nf:
         nf.write(nginx_services_conf)
 
+    json_save(get_route_trie(services, config), NGINX_ROUTES_LOCATION)
+
+
+def get_service_fingerprint(s: Service) -> str:
+    return hashlib.sha256(json.dumps({k: s.get(k) for k in FINGERPRINT_KEYS}, sort_keys=True).encode()).hexdigest()
+
+
+def load_setup_manifest() -> Dict[str, Dict]:
+    return json_load_dict_or_empty(SETUP_MANIFEST_PATH)
+
+
+def write_setup_manifest(services: ServiceList):
+    manifest = {s["type"]["artifact"]: {
+        "repository": s["repository"],
+        "fingerprint": get_service_fingerprint(s),
+    } for s in services}
+
+    # Write to a temporary file first, so an interrupted build never leaves a half-written manifest behind
+    with open(f"{SETUP_MANIFEST_PATH}.tmp", "w") as mf:
+        json.dump(manifest, mf, indent=2)
+    os.replace(f"{SETUP_MANIFEST_PATH}.tmp", SETUP_MANIFEST_PATH)
+
+
+def get_changed_services(services: ServiceList, manifest: Dict[str, Dict]) -> ServiceList:
+    return [s for s in services
+            if manifest.get(s["type"]["artifact"], {}).get("fingerprint") != get_service_fingerprint(s)]
+
+
+def remove_services(artifacts: Iterable[str]):
+    for s_artifact in artifacts:
+        print(f"[CHORD Container Setup]    Removing {s_artifact}")
+        subprocess.run(("rm", "-rf", f"/chord/services/{s_artifact}", get_uwsgi_conf_path(s_artifact)), check=True)
+
 
 class ContainerSetupJob(ContainerJob):
     def job(self, services: ServiceList):
+        # STEP 0: Figure out which services need to be provisioned
+        changed_services = services
+        if SETUP_INCREMENTAL:
+            manifest = load_setup_manifest()
+            changed_services = get_changed_services(services, manifest)
+
+            print(f"[CHORD Container Setup] Incremental build: {len(changed_services)} of {len(services)} "
+                  f"service(s) changed")
+            for s in changed_services:
+                print(f"[CHORD Container Setup]    {s['type']['artifact']}")
+
+            remove_services(set(manifest) - {s["type"]["artifact"] for s in services})
+
+        reset_service_setup_logs(changed_services)
+
         # STEP 1: Install de-duplicated apt dependencies.
         print("[CHORD Container Setup] Installing apt dependencies...")
-        install_apt_dependencies(services)
+        install_apt_dependencies(changed_services)
 
         # STEP 2: Run pre-install commands
         print("[CHORD Container Setup] Running service pre-install commands...")
-        run_pre_install_commands(services)
-
-        # STEP 3: Create virtual environments and install packages
-        print("[CHORD Container Setup] Creating virtual environments...")
-        create_service_virtual_environments(services)
-
-        # STEP 4: Generate uWSGI configuration files
+        run_pre_install_commands(changed_services)
+
+        # STEP 3: Build a shared wheelhouse for Python services, if enabled
+        service_wheels = None
+        if SETUP_WHEELHOUSE:
+            print(f"[CHORD Container Setup] Building wheelhouse (up to {SETUP_WORKERS} at once)...")
+            service_wheels = build_wheelhouse(changed_services)
+
+        # STEP 4: Create virtual environments and install packages
+        print(f"[CHORD Container Setup] Creating virtual environments (up to {SETUP_WORKERS} at once)...")
+        create_service_virtual_environments(changed_services, service_wheels=service_wheels)
+
+        # STEP 5: De-duplicate files between virtual environments, if enabled
+        if SETUP_HARDLINK_VENVS:
+            print("[CHORD Container Setup] Hard-linking identical virtual environment files...")
+            saved = hardlink_identical_files(
+                f"/chord/services/{s['type']['artifact']}/env" for s in services
+                if s["type"]["language"] == TYPE_PYTHON)
+            print(f"[CHORD Container Setup]    Saved {saved / 1024 / 1024:.1f} MB")
+
+        # STEP 6: Generate uWSGI configuration files (always for all services, since templates may have changed)
         print("[CHORD Container Setup] Generating uWSGI configuration files...")
-        write_uwsgi_confs(services)
+        write_uwsgi_confs(services, self.config, overwrite=SETUP_INCREMENTAL)
 
-        # STEP 5: Generate NGINX configuration file
+        # STEP 7: Generate NGINX configuration file (always for all services, since they share configuration files)
         print("[CHORD Container Setup] Generating NGINX configuration file...")
-        write_nginx_confs(services)
+        write_nginx_confs(services, self.config)
+
+        # STEP 8: Record what was set up, for future incremental builds
+        print("[CHORD Container Setup] Writing setup manifest...")
+        write_setup_manifest(services)
 
 
 job = ContainerSetupJob(build=True)
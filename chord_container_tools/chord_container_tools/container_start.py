@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os
+import secrets
+import subprocess
+import sys
+import time
+
+from functools import partial
+from typing import Callable, Dict, List, Set
+
+from .chord_common import (
+    CHORD_ENVIRONMENT_PATH,
+    ConfigVars,
+    Service,
+    ServiceList,
+    execute_runtime_commands,
+    print_prefixed,
+    run_task_graph,
+    run_with_prefixed_output,
+    write_environment_dict_to_path,
+    ContainerJob,
+)
+from .container_non_wsgi_start import start_non_wsgi_service
+from .container_pre_start import PRE_START_WORKERS, configure_postgres, pre_start_service
+from .container_setup import (
+    NGINX_GATEWAY_CONF_LOCATION,
+    NGINX_GATEWAY_CONF_TPL_LOCATION,
+    get_nginx_session_redis_conf,
+    write_nginx_workers_confs,
+    write_uwsgi_workers_confs,
+)
+from .container_metrics import METRICS_SOCKET
+from .container_supervisor import SUPERVISE_NON_WSGI, SUPERVISOR_LOG_PATH
+from .readiness import (
+    REDIS_SOCKET,
+    get_infrastructure_probes,
+    get_service_probe,
+    probe_unix_socket,
+    wait_until_ready,
+)
+from .timing import TIMING_PARENT_ENV, TIMING_RUN_ENV, span
+
+
+POSTGRES_VERSION = "11"
+POSTGRES_DATA_PATH = "/chord/data/postgresql"
+
+UWSGI_PID_PATH = "/chord/tmp/uwsgi/uwsgi.pid"
+OPENRESTY_PATHS = ("/usr/local/openresty/bin", "/usr/local/openresty/nginx/sbin")
+
+# Seconds to wait for each component to start accepting connections before giving up on it.
+READY_TIMEOUT = int(os.environ.get("CHORD_START_READY_TIMEOUT", "60"))
+
+SESSION_SECRET_BYTES = 48
+
+OTT_MIGRATION_SCRIPT_PATH = "/chord/container_scripts/migrate_ott.lua"
+
+NODE_REDIS = "redis"
+NODE_POSTGRES = "postgres"
+NODE_POSTGRES_SETUP = "postgres_setup"
+NODE_ENVIRONMENT = "environment"
+NODE_UWSGI = "uwsgi"
+NODE_WEB = "web"
+NODE_NGINX = "nginx"
+NODE_SUPERVISOR = "supervisor"
+NODE_METRICS = "metrics"
+
+# Steps which spend most of their time waiting for something to accept connections
+WAITING_NODES = (NODE_REDIS, NODE_POSTGRES, NODE_NGINX, NODE_METRICS)
+
+
+def pre_start_node(a: str) -> str:
+    return f"pre_start:{a}"
+
+
+def start_node(a: str) -> str:
+    return f"start:{a}"
+
+
+def ready_node(a: str) -> str:
+    return f"ready:{a}"
+
+
+def post_start_node(a: str) -> str:
+    return f"post_start:{a}"
+
+
+def _print(node: str, line: str, file=sys.stdout):
+    print_prefixed(f"[{node}]", line, file=file)
+
+
+def _check_output(node: str, args, **kwargs):
+    return_code = run_with_prefixed_output(args, f"[{node}]", **kwargs)
+    if return_code != 0:
+        raise RuntimeError(f"'{' '.join(args)}' returned non-zero exit status {return_code}")
+
+
+def _spawn(args, log_path: str = os.devnull, **kwargs):
+    # Detach long-running processes from the orchestrator, so they keep running once startup is finished. They
+    # outlive the start run, so anything they time must not be attributed to it.
+    env = {k: v for k, v in kwargs.pop("env", os.environ).items() if k not in (TIMING_RUN_ENV, TIMING_PARENT_ENV)}
+    with open(log_path, "a") as log:
+        subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True, env=env, **kwargs)
+
+
+def _wait_ready(node: str, probe: Callable[[], bool]):
+    start_time = time.monotonic()
+    if not wait_until_ready(probe, READY_TIMEOUT):
+        raise RuntimeError(f"Not ready after {READY_TIMEOUT}s")
+    _print(node, f"Ready ({time.monotonic() - start_time:.2f}s)")
+
+
+def start_redis():
+    with open("/chord/tmp/redis/redis.log", "w") as log:
+        subprocess.run(("redis-server", "/etc/redis/redis.conf"), stdout=log, stderr=subprocess.STDOUT,
+                       check=True)  # Daemonized, so returns once Redis has forked
+
+    _wait_ready(NODE_REDIS, get_infrastructure_probes()[NODE_REDIS])
+
+    # Delete existing session locks in case they were persisted by accident
+    _check_output(NODE_REDIS, (
+        "/bin/bash", "-c",
+        f"redis-cli -s {REDIS_SOCKET} --scan --pattern 'oidc:*.lock' "
+        f"| xargs -r -L 100 redis-cli -s {REDIS_SOCKET} DEL"
+    ))
+
+    # Move any one-time tokens stored in the old format (one hash per field) to one key per token
+    _check_output(NODE_REDIS, ("redis-cli", "-s", REDIS_SOCKET, "--eval", OTT_MIGRATION_SCRIPT_PATH, ",",
+                               str(int(time.time()))))
+
+
+def start_postgres():
+    # Initialize DB if nothing's there
+    if not os.listdir(POSTGRES_DATA_PATH):
+        _check_output(NODE_POSTGRES, (f"/usr/lib/postgresql/{POSTGRES_VERSION}/bin/initdb", "-D", POSTGRES_DATA_PATH))
+
+    _check_output(NODE_POSTGRES, ("pg_ctlcluster", POSTGRES_VERSION, "main", "start"))
+    _wait_ready(NODE_POSTGRES, get_infrastructure_probes()[NODE_POSTGRES])
+
+
+def set_up_postgres(config_vars_list: List[ConfigVars]):
+    if not configure_postgres(config_vars_list):
+        raise RuntimeError("Failed to set up Postgres users and databases")
+
+
+def start_uwsgi(services: ServiceList, common_environment: ConfigVars):
+    for a, worker_settings in write_uwsgi_workers_confs(services).items():
+        _print(NODE_UWSGI, f"{a}: {', '.join(f'{k}={v}' for k, v in worker_settings.items())}")
+
+    # Vassals inherit the emperor's environment, which must include the common runtime configuration
+    _spawn(("uwsgi", "--emperor", "/chord/vassals", "--master", "--safe-pidfile", UWSGI_PID_PATH),
+           env={**os.environ, **{k: str(v) for k, v in common_environment.items()}})
+
+
+def start_non_wsgi(s: Service, config_vars: ConfigVars):
+    if not start_non_wsgi_service(s, config_vars):
+        raise RuntimeError("Failed to start service")
+
+
+def start_metrics():
+    _spawn(("chord_container_metrics",))
+    _wait_ready(NODE_METRICS, partial(probe_unix_socket, METRICS_SOCKET))
+
+
+def start_supervisor():
+    _spawn(("chord_container_supervisor",), SUPERVISOR_LOG_PATH)
+
+
+def install_web():
+    _check_output(NODE_WEB, ("bash", "/chord/container_scripts/install_web.bash"))
+
+
+def start_nginx(common_environment: ConfigVars):
+    # Copy configuration template to writable location and replace template configuration variables with their set
+    # values; the session secret is regenerated every time the instance starts.
+    with open(NGINX_GATEWAY_CONF_TPL_LOCATION) as tf:
+        nginx_gateway_conf = tf.read()
+
+    nginx_gateway_conf = nginx_gateway_conf \
+        .replace("LISTEN_ON", str(common_environment["LISTEN_ON"])) \
+        .replace("SESSION_REDIS_CONNECTION", get_nginx_session_redis_conf(common_environment)) \
+        .replace("SESSION_SECRET", secrets.token_hex(SESSION_SECRET_BYTES))
+
+    with open(NGINX_GATEWAY_CONF_LOCATION, "w") as nf:
+        nf.write(nginx_gateway_conf)
+
+    worker_settings = write_nginx_workers_confs(common_environment)
+    _print(NODE_NGINX, ", ".join(f"{k}={v}" for k, v in worker_settings.items()))
+
+    _spawn(("nginx",), env={**os.environ, "PATH": ":".join((*OPENRESTY_PATHS, os.environ.get("PATH", "")))})
+    _wait_ready(NODE_NGINX, get_infrastructure_probes()[NODE_NGINX])
+
+
+def post_start(s: Service, config_vars: ConfigVars):
+    if not execute_runtime_commands(s, s["post_start_commands"], f"[{post_start_node(s['type']['artifact'])}]",
+                                    config_vars):
+        raise RuntimeError("One or more post-start commands failed")
+
+
+def get_startup_graph(services: ServiceList, config_vars_by_artifact: Dict[str, ConfigVars],
+                      common_environment: ConfigVars):
+    """
+    Builds the startup dependency graph: infrastructure first, then each service's pre-start, start, readiness and
+    post-start steps, with each service's steps also waiting on the corresponding steps of any services it
+    depends_on. The web interface is installed alongside everything else, since nothing else depends on it.
+    :param services: List of services from chord_services.json
+    :param config_vars_by_artifact: Runtime configuration variables for each service
+    :param common_environment: Common runtime configuration
+    :return: Tuple of a mapping of node names to tasks, and a mapping of node names to their dependencies
+    """
+
+    tasks: Dict[str, Callable[[], None]] = {
+        NODE_REDIS: start_redis,
+        NODE_POSTGRES: start_postgres,
+        NODE_POSTGRES_SETUP: partial(set_up_postgres, list(config_vars_by_artifact.values())),
+        NODE_ENVIRONMENT: partial(write_environment_dict_to_path, common_environment, CHORD_ENVIRONMENT_PATH,
+                                  export=True),
+        NODE_WEB: install_web,
+        NODE_NGINX: partial(start_nginx, common_environment),
+    }
+
+    dependencies: Dict[str, Set[str]] = {
+        NODE_POSTGRES_SETUP: {NODE_POSTGRES},
+        NODE_WEB: {NODE_ENVIRONMENT},
+        NODE_NGINX: {NODE_ENVIRONMENT},
+    }
+
+    wsgi_services = [s for s in services if s.get("wsgi", True)]
+    if wsgi_services:
+        # uWSGI starts all vassals at once, so it has to wait for every WSGI service to be ready to start
+        tasks[NODE_UWSGI] = partial(start_uwsgi, wsgi_services, common_environment)
+        dependencies[NODE_UWSGI] = {pre_start_node(s["type"]["artifact"]) for s in wsgi_services}
+
+        # Metrics are read from vassals' stats sockets on request, so the exporter can start at any time
+        tasks[NODE_METRICS] = start_metrics
+
+    non_wsgi_services = [s for s in services if not s.get("wsgi", True)]
+    if non_wsgi_services and SUPERVISE_NON_WSGI:
+        # The supervisor starts all non-WSGI services at once, so likewise has to wait for all of them
+        tasks[NODE_SUPERVISOR] = start_supervisor
+        dependencies[NODE_SUPERVISOR] = {pre_start_node(s["type"]["artifact"]) for s in non_wsgi_services}
+
+    for s in services:
+        a = s["type"]["artifact"]
+        config_vars = config_vars_by_artifact[a]
+        depends_on = [d for d in s.get("depends_on", ()) if d in config_vars_by_artifact]
+
+        # Pre-start commands may use the database, Redis (e.g. Celery workers), or the common environment
+        tasks[pre_start_node(a)] = partial(pre_start_service, s, config_vars)
+        dependencies[pre_start_node(a)] = {NODE_REDIS, NODE_POSTGRES_SETUP, NODE_ENVIRONMENT,
+                                           *(pre_start_node(d) for d in depends_on)}
+
+        if s.get("wsgi", True):
+            started = NODE_UWSGI
+            # WSGI services can only wait on non-WSGI services, since all vassals are started together
+            dependencies[NODE_UWSGI].update(ready_node(d["type"]["artifact"]) for d in services
+                                            if d["type"]["artifact"] in depends_on and not d.get("wsgi", True))
+        elif SUPERVISE_NON_WSGI:
+            # The supervisor starts all non-WSGI services at once, so depends_on doesn't affect their start order
+            started = NODE_SUPERVISOR
+        else:
+            started = start_node(a)
+            tasks[started] = partial(start_non_wsgi, s, config_vars)
+            dependencies[started] = {pre_start_node(a), *(ready_node(d) for d in depends_on)}
+
+        tasks[ready_node(a)] = partial(_wait_ready, ready_node(a), get_service_probe(config_vars))
+        dependencies[ready_node(a)] = {started}
+
+        if s.get("post_start_commands"):
+            tasks[post_start_node(a)] = partial(post_start, s, config_vars)
+            dependencies[post_start_node(a)] = {NODE_NGINX, ready_node(a), *(ready_node(d) for d in depends_on)}
+
+    return tasks, dependencies
+
+
+class ContainerStartJob(ContainerJob):
+    def job(self, services: ServiceList) -> None:
+        """
+        Starts infrastructure (Redis, Postgres, uWSGI, NGINX) and services, running each step as soon as everything
+        it depends on is done rather than in a fixed sequence. Independent steps (e.g. installing the web interface,
+        and each service's pre-start operations) are run concurrently, for up to PRE_START_WORKERS steps at once,
+        plus one for each step which spends most of its time waiting (infrastructure components and each service's
+        readiness check), so that waiting steps can never hold up the rest.
+        If a step fails, anything depending on it is skipped; a summary is printed at the end, and the job fails if
+        any step failed or was skipped.
+        :param services: List of services from chord_services.json
+        """
+
+        start_time = time.monotonic()
+
+        config_vars_by_artifact = {s["type"]["artifact"]: self.config.runtime_config_vars(s) for s in services}
+        common_environment = self.config.common_environment
+
+        tasks, dependencies = get_startup_graph(services, config_vars_by_artifact, common_environment)
+
+        # Save any newly-generated service secrets before services start using them
+        self.config.save()
+
+        def _run(node: str, task: Callable[[], None]):
+            node_start_time = time.monotonic()
+            # Per-service steps are named <step>:<service artifact>
+            attributes = {"service": node.split(":", 1)[1]} if ":" in node else {}
+            try:
+                with span(node, parent=self.name, **attributes):
+                    task()
+            except Exception as e:
+                _print(node, f"Failed after {time.monotonic() - node_start_time:.2f}s: {e}", file=sys.stderr)
+                raise
+            _print(node, f"Done ({time.monotonic() - node_start_time:.2f}s)")
+
+        n_waiting = sum(1 for node in tasks if node in WAITING_NODES or node.startswith(ready_node("")))
+
+        try:
+            results = run_task_graph({node: partial(_run, node, task) for node, task in tasks.items()}, dependencies,
+                                     max_workers=PRE_START_WORKERS + n_waiting, fail_fast=False)
+        except ValueError as e:  # Services depend on each other in a cycle
+            print(f"[CHORD Container Start] Error: {e}", file=sys.stderr)
+            exit(1)
+
+        failed = sorted(n for n, e in results.items() if e is not None)
+        skipped = sorted(n for n in tasks if n not in results)
+
+        print(f"[CHORD Container Start] {len(results) - len(failed)} of {len(tasks)} step(s) succeeded in "
+              f"{time.monotonic() - start_time:.2f}s")
+        if failed:
+            print(f"[CHORD Container Start] Failed: {', '.join(failed)}", file=sys.stderr)
+        if skipped:
+            print(f"[CHORD Container Start] Skipped: {', '.join(skipped)}", file=sys.stderr)
+
+        if failed or skipped:
+            exit(1)
+
+
+job = ContainerStartJob()
+
+if __name__ == "__main__":
+    job.main()
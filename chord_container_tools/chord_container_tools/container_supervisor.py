@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from .chord_common import (
+    ConfigVars,
+    Service,
+    ServiceList,
+    get_env_str,
+    get_service_command_preamble,
+    json_save,
+    print_prefixed,
+    ContainerJob,
+)
+from .processes import DEFAULT_STOP_GRACE_PERIOD, get_pid_file_path, stop_processes
+
+
+# Whether non-WSGI services should be started and watched by chord_container_supervisor, which restarts them if they
+# exit, instead of being started once and left alone.
+SUPERVISE_NON_WSGI = os.environ.get("CHORD_SUPERVISE_NON_WSGI", "False") == "True"
+
+SUPERVISOR_PID_PATH = "/chord/tmp/supervisor.pid"
+SUPERVISOR_LOG_PATH = "/chord/tmp/logs/supervisor.log"
+# Readable by NGINX, which serves it on the internal socket at /supervisor/state
+SUPERVISOR_STATE_PATH = "/chord/tmp/supervisor_state.json"
+
+POLL_INTERVAL = 0.5  # seconds
+STATE_WRITE_INTERVAL = 5  # seconds; state is also written whenever a service starts or exits
+
+INITIAL_BACKOFF = 1  # seconds before the first restart, doubled for each consecutive failure
+MAX_BACKOFF = 60  # seconds
+STABLE_UPTIME = 60  # seconds a service must stay up for before its backoff is reset
+
+# If a service has to be restarted more than this many times in the flap window, it is given up on
+MAX_RESTARTS = 5
+FLAP_WINDOW = 300  # seconds
+
+STATUS_RUNNING = "running"
+STATUS_BACKOFF = "backoff"
+STATUS_FAILED = "failed"  # Restarted too often; left stopped until the instance is restarted
+STATUS_STOPPED = "stopped"
+
+
+def get_supervised_command(s: Service, config_vars: ConfigVars) -> str:
+    # exec, so that the supervisor's child (and the PID in the service's PID file) is the service itself
+    return (f"{' && '.join(get_service_command_preamble(s, config_vars))} && "
+            f"exec env {get_env_str(s, config_vars)} {s['service_runnable']}")
+
+
+class SupervisedService:
+    def __init__(self, s: Service, config_vars: ConfigVars):
+        self.service = s
+        self.config_vars = config_vars
+        self.artifact = config_vars["SERVICE_ARTIFACT"]
+
+        self.process: Optional[subprocess.Popen] = None
+        self.status = STATUS_STOPPED
+        self.started_at: Optional[float] = None  # Wall-clock time, for reporting
+        self._started_monotonic = 0.0
+
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.last_exit_code: Optional[int] = None
+        self.last_exit_at: Optional[float] = None
+        self.next_start = 0.0  # Monotonic time
+        self._restart_times: Deque[float] = deque()
+
+    def log(self, line: str, file=sys.stdout):
+        print_prefixed(f"[{self.artifact}]", line, file=file)
+
+    def start(self) -> None:
+        log_path = f"{self.config_vars['SERVICE_LOGS']}/{self.artifact}.log"
+        with open(log_path, "a") as log:
+            self.process = subprocess.Popen(
+                ("/bin/bash", "-c", get_supervised_command(self.service, self.config_vars)),
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+
+        with open(get_pid_file_path(self.config_vars), "w") as pf:
+            pf.write(f"{self.process.pid}\n")
+
+        self.status = STATUS_RUNNING
+        self.started_at = time.time()
+        self._started_monotonic = time.monotonic()
+        self.log(f"Started (PID {self.process.pid})")
+
+    def remove_pid_file(self) -> None:
+        try:
+            os.remove(get_pid_file_path(self.config_vars))
+        except FileNotFoundError:
+            pass
+
+    def check(self) -> bool:
+        """
+        Checks whether the service has exited, and if so schedules a restart (or gives up on the service if it's
+        restarting too often), or restarts the service if its backoff is over.
+        :return: Whether the service's state changed
+        """
+
+        now = time.monotonic()
+
+        if self.status == STATUS_BACKOFF and now >= self.next_start:
+            self.restarts += 1
+            self._restart_times.append(now)
+            self.start()
+            return True
+
+        if self.status != STATUS_RUNNING or self.process.poll() is None:
+            return False
+
+        self.last_exit_code = self.process.returncode
+        self.last_exit_at = time.time()
+        self.process = None
+
+        self.remove_pid_file()
+
+        if now - self._started_monotonic >= STABLE_UPTIME:
+            self.consecutive_failures = 0
+        self.consecutive_failures += 1
+
+        while self._restart_times and now - self._restart_times[0] > FLAP_WINDOW:
+            self._restart_times.popleft()
+
+        if len(self._restart_times) >= MAX_RESTARTS:
+            self.status = STATUS_FAILED
+            self.log(f"Exited with status {self.last_exit_code}; restarted {len(self._restart_times)} times in "
+                     f"the last {FLAP_WINDOW}s, so not restarting again", file=sys.stderr)
+            return True
+
+        backoff = min(INITIAL_BACKOFF * 2 ** (self.consecutive_failures - 1), MAX_BACKOFF)
+        self.status = STATUS_BACKOFF
+        self.next_start = now + backoff
+        self.log(f"Exited with status {self.last_exit_code}; restarting in {backoff}s", file=sys.stderr)
+        return True
+
+    def get_state(self) -> dict:
+        running = self.status == STATUS_RUNNING
+        return {
+            "status": self.status,
+            "pid": self.process.pid if running else None,
+            "started_at": self.started_at,
+            "uptime": round(time.monotonic() - self._started_monotonic, 1) if running else None,
+            "restarts": self.restarts,
+            "last_exit_code": self.last_exit_code,
+            "last_exit_at": self.last_exit_at,
+            "next_start_in": (round(max(self.next_start - time.monotonic(), 0), 1)
+                              if self.status == STATUS_BACKOFF else None),
+        }
+
+
+class ContainerSupervisorJob(ContainerJob):
+    timed = False
+
+    def __init__(self, build=False):
+        super().__init__(build)
+        self._stopping = threading.Event()
+
+    def _handle_stop_signal(self, _signum, _frame):
+        self._stopping.set()
+
+    def _write_state(self, supervised: Dict[str, SupervisedService]):
+        json_save({
+            "updated": time.time(),
+            "supervisor_pid": os.getpid(),
+            "services": {a: ss.get_state() for a, ss in supervised.items()},
+        }, SUPERVISOR_STATE_PATH)
+
+    def job(self, services: ServiceList) -> None:
+        """
+        Starts all non-WSGI services as child processes and watches them until told to stop (with SIGTERM or
+        SIGINT.) Services which exit are restarted with exponential backoff, unless they have been restarted too
+        often recently. Each service's status, uptime and restart count is written to SUPERVISOR_STATE_PATH.
+        When stopping, services are given their stop_grace_period to exit after SIGTERM before being killed.
+        :param services: List of services from chord_services.json
+        """
+
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+
+        with open(SUPERVISOR_PID_PATH, "w") as pf:
+            pf.write(f"{os.getpid()}\n")
+
+        supervised = {s["type"]["artifact"]: SupervisedService(s, self.config.runtime_config_vars(s))
+                      for s in services if not s.get("wsgi", True)}
+
+        try:
+            for ss in supervised.values():
+                ss.start()
+
+            last_write = 0.0
+            while not self._stopping.is_set():
+                changed = False
+                for ss in supervised.values():
+                    changed = ss.check() or changed
+
+                if changed or time.monotonic() - last_write >= STATE_WRITE_INTERVAL:
+                    self._write_state(supervised)
+                    last_write = time.monotonic()
+
+                self._stopping.wait(POLL_INTERVAL)
+
+            running = {a: ss for a, ss in supervised.items() if ss.status == STATUS_RUNNING}
+
+            # Reap children as they exit, so they don't linger as zombies (which would look like they're running)
+            for ss in running.values():
+                threading.Thread(target=ss.process.wait, daemon=True).start()
+
+            stop_processes({a: ss.process.pid for a, ss in running.items()},
+                           {a: ss.service.get("stop_grace_period", DEFAULT_STOP_GRACE_PERIOD)
+                            for a, ss in running.items()},
+                           lambda a, outcome, elapsed: supervised[a].log(f"{outcome.capitalize()} ({elapsed:.2f}s)"))
+
+            for ss in running.values():
+                ss.status = STATUS_STOPPED
+                ss.remove_pid_file()
+            self._write_state(supervised)
+
+        finally:
+            os.remove(SUPERVISOR_PID_PATH)
+
+
+job = ContainerSupervisorJob()
+
+if __name__ == "__main__":
+    job.main()
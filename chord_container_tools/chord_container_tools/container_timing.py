@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import statistics
+import sys
+
+from collections import defaultdict
+from typing import Dict, List
+
+from .chord_common import ServiceList, ContainerJob
+from .timing import TIMING_LOG_PATH, Span, load_spans, get_critical_path
+
+DEFAULT_RUNS = 10
+DEFAULT_TOP = 5
+
+
+def _duration(s: Span) -> float:
+    return s["end"] - s["start"]
+
+
+def _run_duration(spans: List[Span]) -> float:
+    return max(s["end"] for s in spans) - min(s["start"] for s in spans)
+
+
+def get_service_durations(spans: List[Span]) -> Dict[str, float]:
+    # Total time spent on each service's steps in a single run
+    durations = defaultdict(float)
+    for s in spans:
+        if s.get("service"):
+            durations[s["service"]] += _duration(s)
+    return durations
+
+
+class ContainerTimingJob(ContainerJob):
+    # Reporting on runs shouldn't add a run of its own
+    timed = False
+    configured = False
+
+    def parse_args(self, args: List[str]):
+        parser = argparse.ArgumentParser(
+            description="Summarizes timing spans recorded while starting and stopping the container.")
+        parser.add_argument("--log", default=TIMING_LOG_PATH,
+                            help=f"timing log to read (default: {TIMING_LOG_PATH})")
+        parser.add_argument("--run", help="run to show the critical path for (default: the latest start or stop run)")
+        parser.add_argument("--runs", type=int, default=DEFAULT_RUNS,
+                            help=f"number of recent runs to compare (default: {DEFAULT_RUNS})")
+        parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                            help=f"number of slowest services to show (default: {DEFAULT_TOP})")
+        return parser.parse_args(args)
+
+    def job(self, services: ServiceList) -> None:
+        """
+        Prints, for one run, the critical path (the chain of steps which determined how long the run took), then
+        compares recent runs of the same kind (start or stop) and lists the services which took longest across them.
+        :param services: List of services from chord_services.json
+        """
+
+        runs = load_spans(self.args.log)
+        if not runs:
+            print(f"Error: No timing spans recorded in {self.args.log}", file=sys.stderr)
+            exit(1)
+
+        # Ad hoc runs (jobs run by hand, outside of starting or stopping the container) aren't worth defaulting to
+        run_id = self.args.run or next((r for r in reversed(runs) if not r.startswith("adhoc-")), None)
+        if run_id is None:
+            print(f"Error: No start or stop runs recorded in {self.args.log}", file=sys.stderr)
+            exit(1)
+        if run_id not in runs:
+            print(f"Error: Unknown run: {run_id}", file=sys.stderr)
+            exit(1)
+
+        spans = runs[run_id]
+        run_start = min(s["start"] for s in spans)
+        failed = [s for s in spans if not s["ok"]]
+
+        print(f"Run {run_id}: {_run_duration(spans):.2f}s, {len(spans)} span(s), {len(failed)} failed")
+        for s in failed:
+            print(f"  Failed: {s['name']}")
+
+        print("\nCritical path:")
+        for s in get_critical_path(spans):
+            print(f"  {s['start'] - run_start:+8.2f}s {_duration(s):7.2f}s  {s['name']}")
+
+        # Only compare runs of the same kind, e.g. boots with other boots
+        kind = run_id.split("-", 1)[0]
+        recent = [r for r in runs if r.split("-", 1)[0] == kind][-self.args.runs:]
+
+        print(f"\nRecent {kind} runs:")
+        for r in recent:
+            print(f"  {_run_duration(runs[r]):7.2f}s  {r}{' (shown above)' if r == run_id else ''}")
+
+        service_durations = defaultdict(list)
+        for r in recent:
+            for a, d in get_service_durations(runs[r]).items():
+                service_durations[a].append(d)
+
+        if not service_durations:
+            return
+
+        print(f"\nSlowest services across {len(recent)} run(s) (mean / max / latest):")
+        slowest = sorted(service_durations.items(), key=lambda i: statistics.mean(i[1]), reverse=True)
+        for a, ds in slowest[:self.args.top]:
+            print(f"  {statistics.mean(ds):7.2f}s {max(ds):7.2f}s {ds[-1]:7.2f}s  {a}")
+
+
+job = ContainerTimingJob()
+
+if __name__ == "__main__":
+    job.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from typing import List
+
+from .chord_common import ServiceList, ContainerJob
+from .readiness import get_infrastructure_probes, get_service_probe, wait_until_all_ready
+
+DEFAULT_TIMEOUT = 60  # seconds
+
+
+class ContainerWaitReadyJob(ContainerJob):
+    def parse_args(self, args: List[str]):
+        parser = argparse.ArgumentParser(
+            description="Waits until container components are accepting connections on their UNIX sockets.")
+        parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                            help=f"seconds to wait for before giving up (default: {DEFAULT_TIMEOUT})")
+        parser.add_argument("components", metavar="component", nargs="+",
+                            help="redis|postgres|nginx|services|[service artifact]")
+        return parser.parse_args(args)
+
+    def job(self, services: ServiceList) -> None:
+        """
+        Waits for all requested components at once, exiting with an error if any of them don't become ready before
+        the timeout.
+        :param services: List of services from chord_services.json
+        """
+
+        infrastructure_probes = get_infrastructure_probes()
+        service_probes = {s["type"]["artifact"]: get_service_probe(self.config.runtime_config_vars(s))
+                          for s in services}
+
+        probes = {}
+        for component in self.args.components:
+            if component in infrastructure_probes:
+                probes[component] = infrastructure_probes[component]
+            elif component == "services":
+                probes.update(service_probes)
+            elif component in service_probes:
+                probes[component] = service_probes[component]
+            else:
+                print(f"Error: Unknown component: {component}", file=sys.stderr)
+                exit(1)
+
+        def _report(name: str, ready: bool, elapsed: float):
+            if ready:
+                print(f"[CHORD Wait Ready] {name} is ready ({elapsed:.2f}s)", flush=True)
+            else:
+                print(f"[CHORD Wait Ready] {name} is not ready after {elapsed:.2f}s", file=sys.stderr, flush=True)
+
+        ready = wait_until_all_ready(probes, self.args.timeout, _report)
+
+        if not all(ready.values()):
+            exit(1)
+
+
+job = ContainerWaitReadyJob()
+
+if __name__ == "__main__":
+    job.main()
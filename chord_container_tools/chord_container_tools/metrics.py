@@ -0,0 +1,133 @@
+import json
+import socket
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .chord_common import run_task_graph
+
+
+__all__ = [
+    "STATS_TIMEOUT",
+
+    "get_uwsgi_stats_socket_path",
+    "read_uwsgi_stats",
+    "collect_uwsgi_stats",
+    "render_uwsgi_metrics",
+]
+
+
+STATS_TIMEOUT = 2  # seconds, for reading stats from a single vassal
+
+WORKER_STATUSES = ("idle", "busy", "cheap", "pause", "sig")
+
+# Name, type and help text for each metric, in the order they're rendered
+METRICS: Tuple[Tuple[str, str, str], ...] = (
+    ("bento_uwsgi_up", "gauge", "Whether the service's uWSGI stats could be read"),
+    ("bento_uwsgi_workers", "gauge", "Number of uWSGI workers, by status"),
+    ("bento_uwsgi_listen_queue", "gauge", "Number of requests waiting in the service socket's listen queue"),
+    ("bento_uwsgi_requests_total", "counter", "Requests handled by the service's current workers"),
+    ("bento_uwsgi_exceptions_total", "counter", "Exceptions raised by the service's current workers"),
+    ("bento_uwsgi_harakiri_total", "counter", "Workers killed for taking too long to handle a request"),
+    ("bento_uwsgi_respawns_total", "counter", "Times the service's workers have been respawned"),
+    ("bento_uwsgi_rss_bytes", "gauge", "Resident memory of all of the service's workers"),
+    ("bento_uwsgi_avg_response_time_seconds", "gauge",
+     "Average response time across the service's workers, weighted by requests handled"),
+)
+
+
+def get_uwsgi_stats_socket_path(s_artifact: str) -> str:
+    return f"/chord/tmp/uwsgi/{s_artifact}.stats.sock"
+
+
+def read_uwsgi_stats(path: str) -> Optional[dict]:
+    """
+    Reads stats from a uWSGI stats socket, which sends a single JSON document and then closes the connection.
+    :param path: Path to the stats socket
+    :return: Parsed stats, or None if they couldn't be read
+    """
+
+    chunks = []
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(STATS_TIMEOUT)
+            sock.connect(path)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def collect_uwsgi_stats(s_artifacts: Iterable[str]) -> Dict[str, Optional[dict]]:
+    # Read from all vassals at once, so one slow vassal doesn't hold up the rest
+    stats = {}
+
+    def _read(a: str):
+        stats[a] = read_uwsgi_stats(get_uwsgi_stats_socket_path(a))
+
+    s_artifacts = list(s_artifacts)
+    run_task_graph({a: (lambda a_=a: _read(a_)) for a in s_artifacts}, max_workers=max(len(s_artifacts), 1),
+                   fail_fast=False)
+    return stats
+
+
+def _get_service_samples(stats: dict) -> List[Tuple[str, Dict[str, str], float]]:
+    workers = stats.get("workers", [])
+
+    statuses = Counter(w.get("status", "") for w in workers)
+    requests = sum(w.get("requests", 0) for w in workers)
+    # avg_rt is in microseconds, and only meaningful for workers which have handled requests
+    weighted_rt = sum(w.get("avg_rt", 0) * w.get("requests", 0) for w in workers)
+
+    samples = [("bento_uwsgi_up", {}, 1)]
+    samples.extend(("bento_uwsgi_workers", {"status": status}, statuses.get(status, 0))
+                   for status in WORKER_STATUSES)
+    samples.extend((
+        ("bento_uwsgi_listen_queue", {}, stats.get("listen_queue", 0)),
+        ("bento_uwsgi_requests_total", {}, requests),
+        ("bento_uwsgi_exceptions_total", {}, sum(w.get("exceptions", 0) for w in workers)),
+        ("bento_uwsgi_harakiri_total", {}, sum(w.get("harakiri_count", 0) for w in workers)),
+        ("bento_uwsgi_respawns_total", {}, sum(w.get("respawn_count", 0) for w in workers)),
+        ("bento_uwsgi_rss_bytes", {}, sum(w.get("rss", 0) for w in workers)),
+        ("bento_uwsgi_avg_response_time_seconds", {}, weighted_rt / requests / 1000000 if requests else 0),
+    ))
+    return samples
+
+
+def _escape_label_value(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items()) + "}"
+
+
+def render_uwsgi_metrics(stats_by_service: Dict[str, Optional[dict]]) -> str:
+    """
+    Renders uWSGI stats for all services in the Prometheus text exposition format.
+    :param stats_by_service: Mapping of service artifacts to their uWSGI stats, or None if unavailable
+    :return: Metrics text
+    """
+
+    samples_by_metric: Dict[str, List[str]] = {name: [] for name, _, _ in METRICS}
+
+    for a, stats in sorted(stats_by_service.items()):
+        if stats is None:
+            samples_by_metric["bento_uwsgi_up"].append(f"bento_uwsgi_up{_format_labels({'service': a})} 0")
+            continue
+
+        for name, labels, value in _get_service_samples(stats):
+            samples_by_metric[name].append(f"{name}{_format_labels({'service': a, **labels})} {value}")
+
+    lines = []
+    for name, metric_type, help_text in METRICS:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples_by_metric[name])
+
+    return "\n".join(lines) + "\n"
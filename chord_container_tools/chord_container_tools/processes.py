@@ -0,0 +1,117 @@
+import os
+import signal
+import time
+
+from typing import Callable, Dict, Optional
+
+from .chord_common import ConfigVars
+
+
+__all__ = [
+    "DEFAULT_STOP_GRACE_PERIOD",
+    "KILL_WAIT_TIME",
+
+    "STOP_STOPPED",
+    "STOP_KILLED",
+    "STOP_NOT_RUNNING",
+    "STOP_FAILED",
+
+    "get_pid_file_path",
+    "read_pid_file",
+    "is_running",
+    "stop_processes",
+]
+
+
+POLL_INTERVAL = 0.05  # seconds
+DEFAULT_STOP_GRACE_PERIOD = 10  # seconds, if a service doesn't specify stop_grace_period
+KILL_WAIT_TIME = 5  # seconds to wait for a process to exit after SIGKILL before giving up on it
+
+STOP_STOPPED = "stopped"
+STOP_KILLED = "killed"
+STOP_NOT_RUNNING = "not running"
+STOP_FAILED = "still running"
+
+
+def get_pid_file_path(config_vars: ConfigVars) -> str:
+    return f"{config_vars['SERVICE_TEMP']}/{config_vars['SERVICE_ARTIFACT']}.pid"
+
+
+def read_pid_file(path: str) -> Optional[int]:
+    try:
+        with open(path) as pf:
+            return int(pf.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Exists, but belongs to someone else
+        return True
+    return True
+
+
+def _signal(pid: int, sig: int) -> bool:
+    try:
+        os.kill(pid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # The process has exited, and its PID was reused by someone else's process
+        return False
+
+
+def stop_processes(pids: Dict[str, int], grace_periods: Dict[str, float],
+                   on_result: Optional[Callable[[str, str, float], None]] = None) -> Dict[str, str]:
+    """
+    Asks all processes to stop at once with SIGTERM, then waits for all of them together, sending SIGKILL to any
+    process which is still running after its grace period.
+    :param pids: Mapping of names to process IDs
+    :param grace_periods: Mapping of names to seconds to wait for after SIGTERM before sending SIGKILL
+    :param on_result: Called with each process' name, outcome and time taken as soon as it is known
+    :return: Mapping of names to outcomes (STOP_STOPPED, STOP_KILLED, STOP_NOT_RUNNING or STOP_FAILED)
+    """
+
+    start_time = time.monotonic()
+    results: Dict[str, str] = {}
+
+    def _done(name: str, outcome: str):
+        results[name] = outcome
+        if on_result:
+            on_result(name, outcome, time.monotonic() - start_time)
+
+    deadlines = {}
+    for name, pid in pids.items():
+        if _signal(pid, signal.SIGTERM):
+            deadlines[name] = start_time + grace_periods.get(name, DEFAULT_STOP_GRACE_PERIOD)
+        else:
+            _done(name, STOP_NOT_RUNNING)
+
+    killed = set()
+
+    while deadlines:
+        now = time.monotonic()
+
+        for name, deadline in tuple(deadlines.items()):
+            if not is_running(pids[name]):
+                del deadlines[name]
+                _done(name, STOP_KILLED if name in killed else STOP_STOPPED)
+            elif now < deadline:
+                continue
+            elif name not in killed:
+                # Grace period is over; stop asking nicely
+                killed.add(name)
+                _signal(pids[name], signal.SIGKILL)
+                deadlines[name] = now + KILL_WAIT_TIME
+            else:
+                del deadlines[name]
+                _done(name, STOP_FAILED)
+
+        if deadlines:
+            time.sleep(POLL_INTERVAL)
+
+    return results
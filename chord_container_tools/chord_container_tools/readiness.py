@@ -0,0 +1,154 @@
+import getpass
+import socket
+import struct
+import time
+
+from typing import Callable, Dict, Optional
+
+from .chord_common import ConfigVars, run_task_graph
+
+
+__all__ = [
+    "REDIS_SOCKET",
+    "POSTGRES_SOCKET",
+    "NGINX_INTERNAL_SOCKET",
+
+    "Probe",
+
+    "probe_unix_socket",
+    "probe_redis",
+    "probe_postgres",
+    "get_infrastructure_probes",
+    "get_service_probe",
+    "wait_until_ready",
+    "wait_until_all_ready",
+]
+
+
+REDIS_SOCKET = "/chord/tmp/redis.sock"
+POSTGRES_SOCKET = "/chord/tmp/postgresql/.s.PGSQL.5432"
+NGINX_INTERNAL_SOCKET = "/chord/tmp/nginx_internal.sock"
+
+PROBE_TIMEOUT = 1  # seconds, for each individual probe
+INITIAL_BACKOFF = 0.01  # seconds
+MAX_BACKOFF = 0.5  # seconds
+
+POSTGRES_PROTOCOL_VERSION = 196608  # 3.0
+
+
+Probe = Callable[[], bool]
+
+
+def _connect(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(PROBE_TIMEOUT)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def probe_unix_socket(path: str, request: Optional[bytes] = None, expected_prefix: Optional[bytes] = None) -> bool:
+    """
+    Checks whether something is accepting connections on a UNIX socket, optionally sending a request and checking
+    the start of the response.
+    :param path: Path to the UNIX socket
+    :param request: Bytes to send after connecting, if any
+    :param expected_prefix: Bytes the response must start with, if any
+    :return: Whether the socket is ready
+    """
+
+    try:
+        with _connect(path) as sock:
+            if request is not None:
+                sock.sendall(request)
+            if expected_prefix is None:
+                return True
+            return sock.recv(len(expected_prefix)) == expected_prefix
+    except OSError:
+        return False
+
+
+def probe_redis(path: str = REDIS_SOCKET) -> bool:
+    # Redis accepts connections while still loading its data set, but only replies to PING once it's done
+    return probe_unix_socket(path, b"PING\r\n", b"+PONG")
+
+
+def probe_postgres(path: str = POSTGRES_SOCKET) -> bool:
+    # Postgres accepts connections while it is still starting up, but rejects them with an error ('E') after the
+    # startup message; once it's ready, it replies with an authentication request ('R') instead.
+    params = f"user\0{getpass.getuser()}\0database\0postgres\0\0".encode("utf-8")
+    startup_message = struct.pack("!ii", len(params) + 8, POSTGRES_PROTOCOL_VERSION) + params
+    terminate_message = b"X" + struct.pack("!i", 4)
+
+    try:
+        with _connect(path) as sock:
+            sock.sendall(startup_message)
+            ready = sock.recv(1) == b"R"
+            if ready:
+                sock.sendall(terminate_message)
+            return ready
+    except OSError:
+        return False
+
+
+def get_infrastructure_probes() -> Dict[str, Probe]:
+    return {
+        "redis": probe_redis,
+        "postgres": probe_postgres,
+        "nginx": lambda: probe_unix_socket(NGINX_INTERNAL_SOCKET),
+    }
+
+
+def get_service_probe(config_vars: ConfigVars) -> Probe:
+    # Both uWSGI vassals and non-WSGI services listen on the service's socket
+    return lambda: probe_unix_socket(config_vars["SERVICE_SOCKET"])
+
+
+def wait_until_ready(probe: Probe, timeout: float) -> bool:
+    """
+    Repeatedly runs a readiness probe, with exponential backoff, until it succeeds or the deadline passes.
+    :param probe: Readiness probe to run
+    :param timeout: Seconds to wait for before giving up
+    :return: Whether the probe succeeded before the deadline
+    """
+
+    deadline = time.monotonic() + timeout
+    backoff = INITIAL_BACKOFF
+
+    while True:
+        if probe():
+            return True
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        time.sleep(min(backoff, remaining))
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+
+def wait_until_all_ready(probes: Dict[str, Probe], timeout: float,
+                         on_result: Optional[Callable[[str, bool, float], None]] = None) -> Dict[str, bool]:
+    """
+    Waits for several components at once, sharing a single deadline.
+    :param probes: Mapping of component names to readiness probes
+    :param timeout: Seconds to wait for before giving up on any components which aren't ready
+    :param on_result: Called with each component's name, readiness and time taken as soon as it is known
+    :return: Mapping of component names to whether they became ready before the deadline
+    """
+
+    start_time = time.monotonic()
+    ready = {}
+
+    def _wait(name: str, probe: Probe):
+        ready[name] = wait_until_ready(probe, timeout - (time.monotonic() - start_time))
+        if on_result:
+            on_result(name, ready[name], time.monotonic() - start_time)
+
+    run_task_graph({name: (lambda n=name, p=probe: _wait(n, p)) for name, probe in probes.items()},
+                   max_workers=max(len(probes), 1), fail_fast=False)
+
+    return ready
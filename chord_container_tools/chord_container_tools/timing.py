@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+
+__all__ = [
+    "TIMING_LOG_PATH",
+
+    "Span",
+
+    "get_run_id",
+    "record_span",
+    "span",
+    "load_spans",
+    "get_critical_path",
+]
+
+
+# Spans from all lifecycle jobs and scripts, for all runs (boots and shutdowns), are appended to a single file.
+TIMING_LOG_PATH = os.environ.get("CHORD_TIMING_LOG", "/chord/tmp/logs/timing.jsonl")
+
+# Set by the start and stop scripts, so that spans from the same boot or shutdown can be grouped together
+TIMING_RUN_ENV = "CHORD_TIMING_RUN"
+# Set by the start and stop scripts to the name of the span a job is running within
+TIMING_PARENT_ENV = "CHORD_TIMING_PARENT"
+
+# Spans which end within this many seconds of another span starting are treated as blocking it
+CRITICAL_PATH_TOLERANCE = 0.05  # seconds
+
+
+Span = Dict
+
+
+def get_run_id() -> str:
+    # Jobs run by hand (outside of the start and stop scripts) are each treated as their own run
+    return os.environ.get(TIMING_RUN_ENV) or f"adhoc-{os.getpid()}"
+
+
+def record_span(name: str, start: float, end: float, ok: bool = True, parent: Optional[str] = None,
+                **attributes) -> None:
+    """
+    Appends a span to the timing log. Failing to record a span never fails the job being timed.
+    :param name: Name of the span
+    :param start: Start of the span, in seconds since the epoch
+    :param end: End of the span, in seconds since the epoch
+    :param ok: Whether whatever was being timed succeeded
+    :param parent: Name of the span this span is part of; defaults to the span the current process is running within
+    :param attributes: Any other properties of the span, e.g. which service it is for
+    """
+
+    line = json.dumps({
+        "run": get_run_id(),
+        "name": name,
+        "parent": parent or os.environ.get(TIMING_PARENT_ENV),
+        "start": round(start, 6),
+        "end": round(end, 6),
+        "ok": ok,
+        **attributes,
+    }) + "\n"
+
+    try:
+        # A single append-mode write per span keeps lines from concurrent writers from interleaving
+        fd = os.open(TIMING_LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Warning: Could not record timing span '{name}': {e}", file=sys.stderr)
+
+
+@contextmanager
+def span(name: str, parent: Optional[str] = None, **attributes):
+    """
+    Times the body of a with statement, recording it as a span once it finishes (successfully or not.)
+    Wall-clock time is used for the start of the span so that spans from different processes line up, but the
+    duration is measured with a monotonic clock.
+    """
+
+    start = time.time()
+    start_monotonic = time.monotonic()
+    ok = False
+
+    try:
+        yield
+        ok = True
+    finally:
+        record_span(name, start, start + (time.monotonic() - start_monotonic), ok, parent, **attributes)
+
+
+def load_spans(path: str = TIMING_LOG_PATH) -> Dict[str, List[Span]]:
+    """
+    Loads all spans from the timing log, skipping any lines which are malformed (e.g. partially written.)
+    :param path: Path to the timing log
+    :return: Mapping of run IDs to their spans, in the order the runs first appear in the log
+    """
+
+    runs: Dict[str, List[Span]] = {}
+
+    try:
+        with open(path) as tf:
+            for line in tf:
+                try:
+                    s = json.loads(line)
+                    runs.setdefault(s["run"], []).append(s)
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return runs
+
+
+def get_critical_path(spans: List[Span]) -> List[Span]:
+    """
+    Approximates a run's critical path from its leaf spans (those which no other span is part of.) Starting from the
+    span which ended last, works backwards by repeatedly picking the span which ended last before the current span
+    started, i.e. the one which most likely held it up.
+    :param spans: All spans from a single run
+    :return: Spans on the critical path, in the order they ran
+    """
+
+    parents = {s["parent"] for s in spans if s.get("parent")}
+    leaves = [s for s in spans if s["name"] not in parents]
+
+    if not leaves:
+        return []
+
+    path = [max(leaves, key=lambda s: s["end"])]
+    while True:
+        blockers = [s for s in leaves if s["end"] <= path[-1]["start"] + CRITICAL_PATH_TOLERANCE and s not in path]
+        if not blockers:
+            break
+        path.append(max(blockers, key=lambda s: s["end"]))
+
+    return path[::-1]
@@ -23,6 +23,11 @@ setuptools.setup(
             "chord_container_post_stop = chord_container_tools.container_post_stop:job.main",
             "chord_container_non_wsgi_start = chord_container_tools.container_non_wsgi_start:job.main",
             "chord_container_non_wsgi_stop = chord_container_tools.container_non_wsgi_stop:job.main",
+            "chord_container_start = chord_container_tools.container_start:job.main",
+            "chord_container_metrics = chord_container_tools.container_metrics:job.main",
+            "chord_container_supervisor = chord_container_tools.container_supervisor:job.main",
+            "chord_container_timing = chord_container_tools.container_timing:job.main",
+            "chord_container_wait_ready = chord_container_tools.container_wait_ready:job.main",
         ]
     },
 
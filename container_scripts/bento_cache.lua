@@ -0,0 +1,76 @@
+-- Module for invalidating the responses cached by the internal NGINX server
+-- for services' cacheable routes (see cache in chord_services.json.)
+
+-- Open source NGINX can't remove individual entries from a cache, so every
+-- cache key starts with a generation, made up of an instance-wide part and a
+-- per-service part. Purging bumps one of them; entries cached with an older
+-- generation are never looked up again, and are evicted once inactive.
+
+-- Services can purge their own cached responses (e.g. after their data
+-- changes) via the internal NGINX server, which isn't reachable from outside:
+--   curl -X POST --unix-socket /chord/tmp/nginx_internal.sock \
+--     "http://localhost/cache/purge?service=<artifact>"
+-- Leaving out the service purges every service's cached responses.
+
+local ngx = ngx
+local require = require
+
+local cjson = require("cjson")
+
+local GLOBAL_GENERATION_KEY = "generation"
+local SERVICE_GENERATION_PREFIX = "generation:"
+
+-- Shared by all workers; holds the cache generations
+local cache_dict = ngx.shared.bento_cache
+
+local _M = {}
+
+_M.init = function ()
+  -- Called from init_by_lua. Caches live on disk, so they outlast NGINX; start
+  -- from the current time, rather than 0, so entries cached before NGINX was
+  -- (re)started are never served. add() leaves the generation alone on HUP
+  -- reloads, since shared dicts are kept.
+  cache_dict:add(GLOBAL_GENERATION_KEY, ngx.time())
+end
+
+_M.get_generation = function (artifact)
+  -- Called (via set_by_lua) for every request to a cacheable route
+  return (cache_dict:get(GLOBAL_GENERATION_KEY) or 0) .. "." ..
+    (cache_dict:get(SERVICE_GENERATION_PREFIX .. artifact) or 0)
+end
+
+_M.purge = function (artifact)
+  -- Purges a service's cached responses, or every service's if artifact is nil
+  if artifact == nil then
+    return cache_dict:incr(GLOBAL_GENERATION_KEY, 1, ngx.time())
+  end
+  return cache_dict:incr(SERVICE_GENERATION_PREFIX .. artifact, 1, 0)
+end
+
+_M.handle_purge = function ()
+  -- Handles POST /cache/purge[?service=<artifact>] on the internal server
+  if ngx.req.get_method() ~= "POST" then
+    ngx.status = ngx.HTTP_NOT_ALLOWED
+    ngx.header["Content-Type"] = "application/json"
+    ngx.say(cjson.encode({message="Method not allowed", tag="invalid method"}))
+    return ngx.exit(ngx.HTTP_NOT_ALLOWED)
+  end
+
+  local service = ngx.req.get_uri_args().service
+  if service ~= nil and type(service) ~= "string" then
+    ngx.status = ngx.HTTP_BAD_REQUEST
+    ngx.header["Content-Type"] = "application/json"
+    ngx.say(cjson.encode({message="Invalid service", tag="invalid service"}))
+    return ngx.exit(ngx.HTTP_BAD_REQUEST)
+  end
+
+  local _, err = _M.purge(service)
+  if err then
+    ngx.log(ngx.ERR, "failed to purge cache: ", err)
+    return ngx.exit(ngx.HTTP_INTERNAL_SERVER_ERROR)
+  end
+
+  return ngx.exit(ngx.HTTP_NO_CONTENT)
+end
+
+return _M
@@ -0,0 +1,242 @@
+-- Module which loads the instance's authentication and instance configuration
+-- once per NGINX worker, instead of on every request, and derives everything
+-- the Lua scripts need from it (owner IDs, lua-resty-openidc options, etc.)
+
+-- The configuration is first loaded by init_by_lua (in the NGINX master, so
+-- workers inherit it) and is only re-read from disk when a reload is requested
+-- with reload(), which bumps a generation counter in a shared dict so that
+-- every worker picks up the new configuration on its next request.
+
+local ngx = ngx
+local require = require
+
+local cjson = require("cjson")
+
+local OIDC_CALLBACK_PATH = "/api/auth/callback"
+local OIDC_CALLBACK_PATH_NO_SLASH = OIDC_CALLBACK_PATH:sub(2, #OIDC_CALLBACK_PATH)
+local SIGN_OUT_PATH = "/api/auth/sign-out"
+
+local GENERATION_KEY = "config:generation"
+
+local DEFAULT_REDIS_CONNECTION = "unix:/chord/tmp/redis.sock"
+local DEFAULT_REDIS_PORT = 6379
+
+-- Shared by all workers; holds the configuration generation
+local config_dict = ngx.shared.bento_config
+
+local _M = {
+  OIDC_CALLBACK_PATH = OIDC_CALLBACK_PATH,
+  SIGN_OUT_PATH = SIGN_OUT_PATH,
+}
+
+local auth_config_path
+local instance_config_path
+
+-- Configuration as of the last load in this worker
+local config
+local config_generation
+
+local read_json = function (path)
+  local f = assert(io.open(path))
+  local contents = cjson.decode(f:read("*all"))
+  f:close()
+  return contents
+end
+
+local get_redis_config = function (config_params)
+  -- Redis connection settings for bento_redis; timeouts are in milliseconds
+  local redis_config = {
+    pool_size = tonumber(config_params["BENTO_REDIS_POOL_SIZE"]) or 100,
+    keepalive_timeout = tonumber(config_params["BENTO_REDIS_KEEPALIVE_TIMEOUT"]) or 30000,
+    connect_timeout = tonumber(config_params["BENTO_REDIS_CONNECT_TIMEOUT"]) or 1000,
+    send_timeout = tonumber(config_params["BENTO_REDIS_SEND_TIMEOUT"]) or 1000,
+    read_timeout = tonumber(config_params["BENTO_REDIS_READ_TIMEOUT"]) or 1000,
+  }
+
+  local connection = config_params["BENTO_REDIS_CONNECTION"] or DEFAULT_REDIS_CONNECTION
+  if connection:match("^unix:") then
+    redis_config.socket = connection
+  else  -- Treat as host/port, e.g. localhost:6379
+    local port_sep = connection:find(":")
+    if port_sep == nil then
+      redis_config.host = connection
+      redis_config.port = DEFAULT_REDIS_PORT
+    else
+      redis_config.host = connection:sub(1, port_sep - 1)
+      redis_config.port = tonumber(connection:sub(port_sep + 1))
+    end
+  end
+
+  return redis_config
+end
+
+local get_rate_limits = function (config_params)
+  -- Rate limits for bento_limits, in requests per second; see bento_limits.lua.
+  -- The anonymous tier's defaults match those of NGINX's per IP address limit
+  -- (see chord_container_setup.)
+  local tier = function (name, rate, burst, delay)
+    local prefix = "BENTO_RATE_LIMIT_" .. name .. "_"
+    return {
+      rate = tonumber(config_params[prefix .. "RATE"]) or rate,
+      burst = tonumber(config_params[prefix .. "BURST"]) or burst,
+      delay = tonumber(config_params[prefix .. "DELAY"]) or delay,
+    }
+  end
+
+  local rate_limits = {
+    anonymous = tier("ANONYMOUS", 10, 40, 15),
+    user = tier("USER", 20, 80, 30),
+    token = tier("TOKEN", 50, 200, 100),
+    routes = {},  -- Overrides for services' own limits, by artifact
+  }
+
+  for key, value in pairs(config_params) do
+    local artifact, field = key:match("^BENTO_RATE_LIMIT_ROUTE_(.+)_(%u+)$")
+    if artifact and (field == "RATE" or field == "BURST" or field == "DELAY") then
+      rate_limits.routes[artifact] = rate_limits.routes[artifact] or {}
+      rate_limits.routes[artifact][field:lower()] = tonumber(value)
+    end
+  end
+
+  return rate_limits
+end
+
+local load = function ()
+  local auth_params = read_json(auth_config_path)
+  local config_params = read_json(instance_config_path)
+
+  -- Set of owner IDs, so roles can be looked up in constant time
+  local owner_ids = {}
+  for _, owner_id in ipairs(auth_params["OWNER_IDS"] or {}) do
+    owner_ids[owner_id] = true
+  end
+
+  -- Set defaults for any possibly-unspecified configuration options, including
+  -- some boolean casts
+
+  local chord_debug = not (not config_params["CHORD_DEBUG"])
+
+  -- Cannot use "or" shortcut, otherwise would always be true
+  local chord_permissions = config_params["CHORD_PERMISSIONS"]
+  if chord_permissions == nil then chord_permissions = true end
+
+  -- If in production, enforce CHORD_URL as the base for redirect
+  local opts_redirect_uri = OIDC_CALLBACK_PATH
+  local opts_redirect_after_logout_uri = "/"
+  if not chord_debug then
+    opts_redirect_uri = config_params["CHORD_URL"] .. OIDC_CALLBACK_PATH_NO_SLASH
+    opts_redirect_after_logout_uri = config_params["CHORD_URL"]
+  end
+
+  config = {
+    auth_params = auth_params,
+    config_params = config_params,
+
+    owner_ids = owner_ids,
+
+    CHORD_DEBUG = chord_debug,
+    CHORD_PERMISSIONS = chord_permissions,
+    CHORD_PRIVATE_MODE = not (not config_params["CHORD_PRIVATE_MODE"]),
+    CHORD_URL = config_params["CHORD_URL"],
+
+    -- How long (in seconds) to cache the user info and role for a valid bearer
+    -- token (capped at the token's expiry), and how long to remember that a
+    -- token is invalid for. Owner changes apply to cached tokens once they expire.
+    BEARER_CACHE_TTL = tonumber(config_params["BENTO_BEARER_CACHE_TTL"]) or 300,
+    BEARER_CACHE_NEGATIVE_TTL = tonumber(config_params["BENTO_BEARER_CACHE_NEGATIVE_TTL"]) or 10,
+
+    -- How long (in seconds) to cache the user info and role for a session
+    -- (capped at when the session's access token is due to be refreshed.)
+    -- Should stay below $session_cookie_renew, since cached requests don't
+    -- renew the session cookie.
+    SESSION_CACHE_TTL = tonumber(config_params["BENTO_SESSION_CACHE_TTL"]) or 30,
+
+    -- Maximum number of one-time tokens which can be generated at once
+    OTT_MAX_TOKENS = tonumber(config_params["BENTO_OTT_MAX_TOKENS"]) or 1000,
+
+    redis = get_redis_config(config_params),
+
+    rate_limits = get_rate_limits(config_params),
+
+    -- lua-resty-openidc options; built once and re-used for every request
+    opts = {
+      redirect_uri = opts_redirect_uri,
+      logout_path = SIGN_OUT_PATH,
+      redirect_after_logout_uri = opts_redirect_after_logout_uri,
+
+      discovery = auth_params["OIDC_DISCOVERY_URI"],
+
+      client_id = auth_params["CLIENT_ID"],
+      client_secret = auth_params["CLIENT_SECRET"],
+
+      -- Default token_endpoint_auth_method to client_secret_basic
+      token_endpoint_auth_method = auth_params["TOKEN_ENDPOINT_AUTH_METHOD"] or "client_secret_basic",
+
+      accept_none_alg = false,
+      accept_unsupported_alg = false,
+
+      -- If in production, validate the SSL certificate if HTTPS is being used
+      -- (for non-Lua folks, this is a ternary - ssl_verify = !chord_debug)
+      ssl_verify = chord_debug and "no" or "yes",
+
+      -- Disable keepalive to try to prevent some "lost access token" issues with the OP
+      -- See https://github.com/zmartzone/lua-resty-openidc/pull/307 for details
+      keepalive = "no",
+
+      -- TODO: Re-enable this if it doesn't cause sign-out bugs, since it's more secure
+      -- refresh_session_interval = 600,
+
+      iat_slack = 120,
+      -- access_token_expires_in should be shorter than $session_cookie_lifetime otherwise will never be called
+      -- Keycloak defaults to 1-minute access tokens
+      access_token_expires_in = 60,
+      access_token_expires_leeway = 15,
+      renew_access_token_on_expiry = true,
+    },
+  }
+
+  config_generation = config_dict:get(GENERATION_KEY) or 0
+end
+
+_M.init = function (auth_path, instance_path)
+  -- Called from init_by_lua with the configuration file locations
+  auth_config_path = auth_path
+  instance_config_path = instance_path
+  load()
+end
+
+_M.get = function ()
+  -- Returns the current configuration, re-loading it first if a reload has
+  -- been requested (by any worker) since it was last loaded by this one.
+  local generation = config_dict:get(GENERATION_KEY) or 0
+  if generation ~= config_generation then
+    local ok, err = pcall(load)
+    if not ok then
+      -- Keep using the previous configuration rather than failing every request
+      ngx.log(ngx.ERR, "failed to reload configuration: ", err)
+      config_generation = generation
+    end
+  end
+  return config
+end
+
+_M.reload = function ()
+  -- Re-loads the configuration in this worker, and tells all others to.
+  -- Raises an error (leaving the previous configuration in place everywhere)
+  -- if the new configuration cannot be loaded.
+  local previous_config, previous_generation = config, config_generation
+  local ok, err = pcall(load)
+  if not ok then
+    config, config_generation = previous_config, previous_generation
+    error(err)
+  end
+  config_generation = config_dict:incr(GENERATION_KEY, 1, 0)
+  return config
+end
+
+_M.get_user_role = function (user_id)
+  if user_id ~= nil and config.owner_ids[user_id] then return "owner" end
+  return "user"
+end
+
+return _M
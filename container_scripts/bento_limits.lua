@@ -0,0 +1,160 @@
+-- Module for rate limiting external requests once they've been authenticated,
+-- per user rather than per IP address, so that (for example) federated nodes
+-- behind the same NAT don't share a budget, and a single heavy user of one
+-- service can't starve everyone else.
+
+-- Every request is first rate limited per IP address by NGINX itself, before
+-- it reaches the Lua scripts (see the "external" and "external_credentialed"
+-- limit_req zones), so invalid credentials can't be checked with the OIDC
+-- provider or Redis without limit. Requests with credentials get a higher
+-- budget there, and are also limited here, with separate budgets ("tiers"):
+--   anonymous  requests with credentials which didn't authenticate, per IP
+--   user       requests authenticated with a session, per user
+--   token      requests authenticated with a bearer token or one-time token
+--              (i.e. service traffic), per user
+-- Services can also have their own per-user limits on top of these, declared
+-- with rate_limit in chord_services.json (see bento_routes.lua.)
+
+-- Limits come from instance_config.json (via bento_config):
+--   BENTO_RATE_LIMIT_<TIER>_RATE / _BURST / _DELAY
+--   BENTO_RATE_LIMIT_ROUTE_<ARTIFACT>_RATE / _BURST / _DELAY
+-- where ARTIFACT is in upper case, with dashes replaced by underscores.
+
+-- Rate limits work like NGINX's limit_req: requests per second, with up to
+-- BURST excess requests queued (delayed), the first DELAY of which aren't
+-- delayed at all; anything beyond that is rejected.
+
+local ngx = ngx
+local require = require
+
+local bento_config = require("bento_config")
+local limit_req = require("resty.limit.req")
+
+local DICT_NAME = "bento_rate_limits"
+local STATS_PREFIX = "rate_limit:"
+
+local stats = ngx.shared.bento_stats
+
+local _M = {
+  STATS_PREFIX = STATS_PREFIX,
+}
+
+-- Limiter objects, by rate and burst; re-used across requests
+local limiters = {}
+
+-- Per-service limits (chord_services.json merged with any overrides), built
+-- for the configuration they were last built with
+local route_limits = {}
+local route_limits_config
+
+local incr_stat = function (budget, outcome)
+  stats:incr(STATS_PREFIX .. budget .. ":" .. outcome, 1, 0)
+end
+
+local get_limiter = function (rate, burst)
+  local key = rate .. "/" .. burst
+  local limiter = limiters[key]
+  if limiter == nil then
+    local err
+    limiter, err = limit_req.new(DICT_NAME, rate, burst)
+    if not limiter then return nil, err end
+    limiters[key] = limiter
+  end
+  return limiter
+end
+
+local check = function (budget, limit, key)
+  -- Counts a request against a budget, delaying it if needed. Returns false if
+  -- the request should be rejected.
+  local limiter, err = get_limiter(limit.rate, limit.burst)
+  if not limiter then
+    -- Don't turn a misconfiguration into an outage; let the request through
+    ngx.log(ngx.ERR, "failed to create rate limiter for ", budget, ": ", err)
+    return true
+  end
+
+  local _, excess = limiter:incoming(budget .. ":" .. key, true)
+  if excess == "rejected" then
+    incr_stat(budget, "rejected")
+    return false
+  elseif type(excess) ~= "number" then
+    ngx.log(ngx.ERR, "failed to rate limit ", budget, ": ", excess)
+    return true
+  end
+
+  if excess > limit.delay then
+    incr_stat(budget, "delayed")
+    ngx.sleep((excess - limit.delay) / limit.rate)
+  end
+
+  return true
+end
+
+local get_route_limit = function (config, service)
+  -- Limits set in instance_config.json override those in chord_services.json
+  if route_limits_config ~= config then
+    route_limits = {}
+    route_limits_config = config
+  end
+
+  local limit = route_limits[service.artifact]
+  if limit == nil then
+    local override = config.rate_limits.routes[service.artifact:upper():gsub("%-", "_")] or {}
+    local default = service.rate_limit or {}
+    local rate = override.rate or default.rate
+    limit = rate and {
+      rate = rate,
+      burst = override.burst or default.burst or 0,
+      delay = override.delay or default.delay or 0,
+    } or false
+    route_limits[service.artifact] = limit
+  end
+  return limit
+end
+
+_M.limit = function (tier, key, service)
+  -- Applies a tier's limit, and the limit for the service the request is for
+  -- (if there is one), to a request from key (a user ID or an IP address.)
+  -- Returns false if the request should be rejected.
+  local config = bento_config.get()
+  if not check(tier, config.rate_limits[tier], key) then return false end
+
+  if service then
+    local route_limit = get_route_limit(config, service)
+    if route_limit then return check("route:" .. service.artifact, route_limit, key) end
+  end
+
+  return true
+end
+
+_M.log = function ()
+  -- Called from log_by_lua; counts requests delayed or rejected by NGINX's
+  -- own (per IP address) limits
+  local status = ngx.var.limit_req_status
+  if status ~= "DELAYED" and status ~= "REJECTED" then return end
+
+  -- Requests with credentials count against a different zone; see the gateway
+  -- configuration
+  local zone = "external"
+  if ngx.var.http_authorization or ngx.var.http_x_ott or ngx.var.cookie_bento_session then
+    zone = "external_credentialed"
+  end
+  incr_stat(zone, status == "DELAYED" and "delayed" or "rejected")
+end
+
+_M.get_stats = function ()
+  -- Returns the number of requests delayed and rejected for each budget
+  -- (each NGINX zone, each tier, and route:<artifact> for each service) across all
+  -- workers
+  local res = {}
+  for _, key in ipairs(stats:get_keys(0)) do
+    local budget, outcome = key:match("^" .. STATS_PREFIX .. "(.+):(%a+)$")
+    if budget then
+      res[budget] = res[budget] or {delayed=0, rejected=0}
+      res[budget][outcome] = stats:get(key) or 0
+    end
+  end
+  return res
+end
+
+return _M
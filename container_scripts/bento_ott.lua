@@ -0,0 +1,232 @@
+-- Module for storing, consuming, listing and revoking one-time tokens (OTTs)
+-- in Redis, via a bento_redis client.
+
+-- Tokens themselves are never stored; each is identified by its ID (the SHA-1
+-- hash of the token, in hex), which can be listed and used to revoke it
+-- without revealing the token. SHA-1 (rather than SHA-256) is used since it's
+-- the only hash function available to Redis scripts, e.g. migrate_ott.lua.
+
+-- Storage (all keys expire via Redis, 7 days after the tokens are generated):
+--   bento_ott:token:<token ID>  JSON: {scope, user_id, payload}
+--   bento_ott:payload:<id>      JSON: {user, user_id, user_role}; stored once
+--                               for each batch of tokens generated together
+--   bento_ott:user:<user ID>    sorted set of the user's token IDs, by expiry
+--   bento_ott:scope:<scope>     sorted set of the scope's token IDs, by expiry
+
+-- Tokens are removed from both indices whenever they're used or revoked, so
+-- listing or revoking the tokens of a user or scope only touches those
+-- tokens. Payloads are left to expire, since other tokens in the same batch
+-- may still refer to them.
+
+local ngx = ngx
+local require = require
+local unpack = unpack
+
+local cjson = require("cjson")
+local random = require("resty.random")
+local str = require("resty.string")
+
+local TOKEN_PREFIX = "bento_ott:token:"
+local PAYLOAD_PREFIX = "bento_ott:payload:"
+local USER_INDEX_PREFIX = "bento_ott:user:"
+local SCOPE_INDEX_PREFIX = "bento_ott:scope:"
+
+local TOKEN_BYTES = 64  -- Tokens are hex-encoded, so 128 characters long
+local PAYLOAD_ID_BYTES = 16
+
+local EXPIRY = 604800  -- seconds
+
+-- Tokens added to an index per ZADD; keeps the number of arguments unpacked
+-- for each call well within LuaJIT's limits, however many tokens there are
+local INDEX_CHUNK_SIZE = 500
+
+local _M = {
+  EXPIRY = EXPIRY,
+  KEY_PATTERN = "bento_ott:*",
+}
+
+-- Shared by the scripts below; removes a token (by ID) and its index entries
+local REMOVE_TOKEN_FUNCTION = [[
+local remove_token = function (t)
+  local v = redis.call("GET", "]] .. TOKEN_PREFIX .. [[" .. t)
+  if not v then return nil end
+  local d = cjson.decode(v)
+  redis.call("DEL", "]] .. TOKEN_PREFIX .. [[" .. t)
+  if d.user_id then redis.call("ZREM", "]] .. USER_INDEX_PREFIX .. [[" .. d.user_id, t) end
+  if d.scope then redis.call("ZREM", "]] .. SCOPE_INDEX_PREFIX .. [[" .. d.scope, t) end
+  return d
+end
+]]
+
+-- Fetches and deletes a token, along with its payload, in a single atomic
+-- round trip, so a token can never be used twice, even by concurrent requests.
+--   ARGV[1]: token ID
+-- Returns: {token data, payload} (as JSON), or nil if the token isn't valid
+local CONSUME_SCRIPT = REMOVE_TOKEN_FUNCTION .. [[
+local d = remove_token(ARGV[1])
+if not d then return false end
+local payload = d.payload and redis.call("GET", "]] .. PAYLOAD_PREFIX .. [[" .. d.payload)
+return {cjson.encode(d), payload or false}
+]]
+
+-- Revokes individual tokens and/or all tokens in one or more indices.
+--   KEYS: index keys; ARGV: token IDs
+-- Returns: the number of tokens revoked
+local REVOKE_SCRIPT = REMOVE_TOKEN_FUNCTION .. [[
+local revoked = 0
+for _, k in ipairs(KEYS) do
+  for _, t in ipairs(redis.call("ZRANGE", k, 0, -1)) do
+    if remove_token(t) then revoked = revoked + 1 end
+  end
+  redis.call("DEL", k)
+end
+for _, t in ipairs(ARGV) do
+  if remove_token(t) then revoked = revoked + 1 end
+end
+return revoked
+]]
+
+-- Lists the unexpired tokens in an index, dropping expired ones from it.
+--   KEYS[1]: index key; ARGV[1]: current UNIX time
+-- Returns: a list of token data (as JSON)
+local LIST_SCRIPT = [[
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+local tokens = redis.call("ZRANGE", KEYS[1], 0, -1, "WITHSCORES")
+local res = {}
+for i = 1, #tokens, 2 do
+  local v = redis.call("GET", "]] .. TOKEN_PREFIX .. [[" .. tokens[i])
+  if v then
+    local d = cjson.decode(v)
+    res[#res + 1] = cjson.encode({id=tokens[i], scope=d.scope, user_id=d.user_id, expiry=tonumber(tokens[i + 1])})
+  end
+end
+return res
+]]
+
+local script_shas = {}
+
+local run_script = function (red, script, n_keys, ...)
+  -- Runs a script with EVALSHA, only sending the whole script to Redis if it
+  -- hasn't seen it yet (e.g. after Redis restarts)
+  local sha = script_shas[script]
+  if sha == nil then
+    sha = str.to_hex(ngx.sha1_bin(script))
+    script_shas[script] = sha
+  end
+
+  local res, err = red:evalsha(sha, n_keys, ...)
+  if err and err:match("^NOSCRIPT") then
+    res, err = red:eval(script, n_keys, ...)
+  end
+  return res, err
+end
+
+_M.get_token_id = function (token)
+  return str.to_hex(ngx.sha1_bin(token))
+end
+
+_M.get_user_index_key = function (user_id)
+  return USER_INDEX_PREFIX .. user_id
+end
+
+_M.get_scope_index_key = function (scope)
+  return SCOPE_INDEX_PREFIX .. scope
+end
+
+_M.generate = function (red, scope, n_tokens, user, user_id, user_role)
+  -- Generates n_tokens tokens for a scope, all sharing a single payload.
+  -- Returns the list of new tokens, or nil and an error.
+
+  -- Generate all random bytes at once (using OpenSSL via lua-resty-random;
+  -- does not use the token method, since that does not use OpenSSL)
+  local bytes = random.bytes(TOKEN_BYTES * n_tokens + PAYLOAD_ID_BYTES, true)
+  if bytes == nil then
+    return nil, "could not generate random bytes"
+  end
+  local hex = str.to_hex(bytes)
+
+  ngx.update_time()
+  local expiry = ngx.time() + EXPIRY
+
+  local payload_id = hex:sub(1, PAYLOAD_ID_BYTES * 2)
+  local user_index_key = _M.get_user_index_key(user_id or "")
+  local scope_index_key = _M.get_scope_index_key(scope)
+
+  local tokens = {}
+  local index_args = {}  -- expiry, token ID, expiry, token ID, ...
+  local token_length = TOKEN_BYTES * 2
+  for i = 1, n_tokens do
+    local offset = PAYLOAD_ID_BYTES * 2 + (i - 1) * token_length
+    local token = hex:sub(offset + 1, offset + token_length)
+    tokens[i] = token
+    index_args[2 * i - 1] = expiry
+    index_args[2 * i] = _M.get_token_id(token)
+  end
+
+  local token_data = cjson.encode({scope=scope, user_id=user_id, payload=payload_id})
+
+  local res, err = red:init_pipeline(n_tokens + 5)
+  if not res then return nil, err end
+
+  red:set(PAYLOAD_PREFIX .. payload_id, cjson.encode({user=user, user_id=user_id, user_role=user_role}),
+    "EX", EXPIRY)
+  for i = 1, n_tokens do
+    red:set(TOKEN_PREFIX .. index_args[2 * i], token_data, "EX", EXPIRY)
+  end
+  for first = 1, n_tokens, INDEX_CHUNK_SIZE do
+    local first_arg = 2 * first - 1
+    local last_arg = 2 * math.min(first + INDEX_CHUNK_SIZE - 1, n_tokens)
+    red:zadd(user_index_key, unpack(index_args, first_arg, last_arg))
+    red:zadd(scope_index_key, unpack(index_args, first_arg, last_arg))
+  end
+  -- Indices last as long as the newest tokens in them
+  red:expire(user_index_key, EXPIRY)
+  red:expire(scope_index_key, EXPIRY)
+
+  res, err = red:commit_pipeline()
+  if not res then return nil, err end
+  for _, r in ipairs(res) do
+    if type(r) == "table" and r[1] == false then return nil, r[2] end
+  end
+
+  return tokens
+end
+
+_M.consume = function (red, token)
+  -- Fetches and deletes a token. Returns the token's data, with its payload
+  -- (user, user_id, user_role) merged in, or false if the token isn't valid,
+  -- or nil and an error.
+  local res, err = run_script(red, CONSUME_SCRIPT, 0, _M.get_token_id(token))
+  if err then return nil, err end
+  if res == ngx.null then return false end
+
+  local token_data = cjson.decode(res[1])
+  if res[2] ~= ngx.null then
+    for k, v in pairs(cjson.decode(res[2])) do token_data[k] = v end
+  end
+  return token_data
+end
+
+_M.revoke = function (red, index_keys, token_ids)
+  -- Revokes all tokens in the given indices, as well as any given tokens (by
+  -- ID, see get_token_id.)
+  -- Returns the number of tokens revoked, or nil and an error.
+  local args = {}
+  for _, k in ipairs(index_keys) do args[#args + 1] = k end
+  for _, t in ipairs(token_ids) do args[#args + 1] = t end
+  return run_script(red, REVOKE_SCRIPT, #index_keys, unpack(args))
+end
+
+_M.list = function (red, index_key)
+  -- Lists the unexpired tokens in an index (their IDs, scopes, user IDs and
+  -- expiries), or returns nil and an error.
+  ngx.update_time()
+  local res, err = run_script(red, LIST_SCRIPT, 1, index_key, ngx.time())
+  if err then return nil, err end
+
+  local tokens = {}
+  for i, t in ipairs(res) do tokens[i] = cjson.decode(t) end
+  return tokens
+end
+
+return _M
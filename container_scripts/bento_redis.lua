@@ -0,0 +1,150 @@
+-- Module providing a Redis client for the Lua scripts, which connects lazily
+-- (only once a command is actually sent), re-uses pooled connections, and
+-- records the latency of each command in the bento_stats shared dict.
+
+-- Connection settings come from instance_config.json (via bento_config):
+--   BENTO_REDIS_CONNECTION         "unix:/path/to/socket" or "host[:port]"
+--   BENTO_REDIS_POOL_SIZE          max. idle connections kept per worker
+--   BENTO_REDIS_KEEPALIVE_TIMEOUT  ms an idle pooled connection is kept for
+--   BENTO_REDIS_CONNECT_TIMEOUT / BENTO_REDIS_SEND_TIMEOUT /
+--   BENTO_REDIS_READ_TIMEOUT       ms
+
+-- Usage:
+--   local red = bento_redis.new()
+--   local res, err = red:get("key")  -- connects here
+--   red:set_keepalive()  -- returns the connection to the pool
+
+local ngx = ngx
+local require = require
+local setmetatable = setmetatable
+
+local bento_config = require("bento_config")
+local redis = require("resty.redis")
+
+local stats = ngx.shared.bento_stats
+
+local STATS_PREFIX = "redis:"
+
+local _M = {
+  STATS_PREFIX = STATS_PREFIX,
+}
+
+local record = function (command, start, err)
+  -- Record a command's latency (in seconds) and whether it failed
+  ngx.update_time()
+  local key = STATS_PREFIX .. command
+  stats:incr(key .. ":calls", 1, 0)
+  stats:incr(key .. ":time", ngx.now() - start, 0)
+  if err then stats:incr(key .. ":errors", 1, 0) end
+end
+
+local now = function ()
+  ngx.update_time()
+  return ngx.now()
+end
+
+local methods = {}
+local mt = {}
+
+mt.__index = function (self, name)
+  local method = methods[name]
+  if method then return method end
+
+  -- Any other name is treated as a Redis command (get, set, eval, etc.)
+  return function (client, ...)
+    local red, err = client:connect()
+    if not red then return nil, err end
+
+    if client.pipelining then
+      -- Pipelined commands are only sent (and timed) on commit_pipeline
+      return red[name](red, ...)
+    end
+
+    local start = now()
+    local res
+    res, err = red[name](red, ...)
+    record(name, start, err)
+    return res, err
+  end
+end
+
+methods.connect = function (self)
+  -- Connects (or takes a connection from the pool) if not already connected
+  if self.red then return self.red end
+
+  local c = bento_config.get().redis
+
+  local red = redis:new()
+  red:set_timeouts(c.connect_timeout, c.send_timeout, c.read_timeout)
+
+  local start = now()
+  local ok, err
+  if c.socket then
+    ok, err = red:connect(c.socket, {pool_size=c.pool_size})
+  else
+    ok, err = red:connect(c.host, c.port, {pool_size=c.pool_size})
+  end
+  -- Re-used connections are effectively free, so only count new ones
+  if err or red:get_reused_times() == 0 then record("connect", start, err) end
+
+  if not ok then return nil, err end
+
+  self.red = red
+  return red
+end
+
+methods.init_pipeline = function (self, n)
+  local red, err = self:connect()
+  if not red then return nil, err end
+  self.pipelining = true
+  red:init_pipeline(n)
+  return 1
+end
+
+methods.commit_pipeline = function (self)
+  self.pipelining = false
+  local start = now()
+  local res, err = self.red:commit_pipeline()
+  record("pipeline", start, err)
+  return res, err
+end
+
+methods.set_keepalive = function (self)
+  -- Puts the connection (if one was made) back into the pool
+  if not self.red then return 1 end
+  local c = bento_config.get().redis
+  local red = self.red
+  self.red = false
+  return red:set_keepalive(c.keepalive_timeout, c.pool_size)
+end
+
+_M.new = function ()
+  -- Fields must never be nil, since missing fields are looked up as commands
+  return setmetatable({red=false, pipelining=false}, mt)
+end
+
+_M.get_stats = function ()
+  -- Returns per-command call counts, error counts, and total and average
+  -- latencies (in milliseconds) across all workers
+  local command_stats = {}
+  for _, key in ipairs(stats:get_keys(0)) do
+    local command, field = key:match("^" .. STATS_PREFIX .. "(.+):(%a+)$")
+    if command then
+      command_stats[command] = command_stats[command] or {calls=0, errors=0, time=0}
+      command_stats[command][field] = stats:get(key) or 0
+    end
+  end
+
+  local res = {}
+  for command, s in pairs(command_stats) do
+    res[command] = {
+      calls=s.calls,
+      errors=s.errors,
+      total_ms=s.time * 1000,
+      avg_ms=s.calls > 0 and s.time * 1000 / s.calls or 0,
+    }
+  end
+  return res
+end
+
+return _M
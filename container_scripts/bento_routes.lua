@@ -0,0 +1,113 @@
+-- Module which classifies request URIs (virtual endpoint, service route,
+-- private, static front end asset, etc.) up front, with an exact-match table
+-- and a prefix trie of service routes built once per worker, instead of with a
+-- chain of pattern matches on every request.
+
+-- The service route trie is generated from chord_services.json at build time
+-- by chord_container_setup (see write_nginx_confs) and loaded by init().
+
+local require = require
+
+local bento_config = require("bento_config")
+local cjson = require("cjson")
+
+local _M = {}
+
+-- Virtual endpoints handled by proxy_auth.lua (see VIRTUAL_ENDPOINTS.md)
+local PATHS = {
+  OIDC_CALLBACK = bento_config.OIDC_CALLBACK_PATH,
+  SIGN_IN = "/api/auth/sign-in",
+  SIGN_OUT = bento_config.SIGN_OUT_PATH,
+  USER_INFO = "/api/auth/user",
+
+  ONE_TIME_TOKENS_GENERATE = "/api/auth/ott/generate",
+  ONE_TIME_TOKENS_INVALIDATE = "/api/auth/ott/invalidate",
+  ONE_TIME_TOKENS_INVALIDATE_ALL = "/api/auth/ott/invalidate_all",
+  ONE_TIME_TOKENS_INVALIDATE_USER = "/api/auth/ott/invalidate_user",
+  ONE_TIME_TOKENS_INVALIDATE_SCOPE = "/api/auth/ott/invalidate_scope",
+  ONE_TIME_TOKENS_LIST = "/api/auth/ott/list",
+
+  STATS = "/api/auth/stats",
+  RELOAD = "/api/auth/reload",
+}
+_M.PATHS = PATHS
+
+-- Extensions of static front end files, which don't need any authentication
+-- unless the node is in private mode
+local ASSET_EXTENSIONS = {
+  css = true, js = true, map = true,
+  gif = true, ico = true, jpeg = true, jpg = true, png = true, svg = true, webp = true,
+  eot = true, ttf = true, woff = true, woff2 = true,
+}
+
+-- Routes which can be classified without looking at the URI any further
+local exact = {}
+
+-- Service route prefix trie, keyed by path segment:
+--   {children={api={children={metadata={service={artifact=..., wsgi=...}, children={}}}}}}
+local trie = {children={}}
+
+_M.init = function (routes_path)
+  -- Called from init_by_lua with the location of the generated routes file
+  local f = assert(io.open(routes_path))
+  trie = cjson.decode(f:read("*all"))
+  f:close()
+
+  for _, path in pairs(PATHS) do
+    exact[path] = {api=true, auth=true, endpoint=path}
+  end
+end
+
+local find_service = function (uri)
+  -- Walks the trie along the URI's path segments, returning the service with
+  -- the longest matching prefix (if any) and the position after the prefix
+  local node = trie
+  local service, service_end
+  local pos = 2  -- Skip the leading slash
+  while node do
+    local sep = uri:find("/", pos, true)
+    local segment = uri:sub(pos, (sep or 0) - 1)
+    node = node.children[segment]
+    if node and node.service then
+      service = node.service
+      service_end = sep or #uri + 1
+    end
+    if not sep then break end
+    pos = sep + 1
+  end
+  return service, service_end
+end
+
+_M.classify = function (uri)
+  -- Returns a table describing the route, with (where applicable):
+  --   api       whether the URI is in the /api namespace
+  --   auth      whether the URI is in the /api/auth namespace
+  --   endpoint  the virtual endpoint handled by proxy_auth.lua
+  --   service   the service (artifact, wsgi) the request will be proxied to
+  --   private   whether the URI is in a service's /private namespace
+  --   asset     whether the URI is a static front end file
+  local route = exact[uri]
+  if route then return route end
+
+  if uri:sub(1, 4) ~= "/api" then
+    -- Front end; a static asset if the last path segment has a known extension
+    local extension = uri:match("%.(%w+)$")
+    return {asset=(extension ~= nil and ASSET_EXTENSIONS[extension:lower()] == true)}
+  end
+
+  route = {api=true, auth=uri:sub(1, 9) == "/api/auth"}
+
+  local service_end
+  route.service, service_end = find_service(uri)
+
+  if route.service then
+    route.private = uri:sub(service_end + 1, service_end + 7) == "private"
+  else
+    -- Not a known service, but still treat /api/<anything>/private* as private
+    route.private = uri:match("^/api/%a[%w-_]*/private") ~= nil
+  end
+
+  return route
+end
+
+return _M
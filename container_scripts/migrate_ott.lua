@@ -0,0 +1,57 @@
+-- Redis script to move one-time tokens from the old storage format (five
+-- hashes, each mapping tokens to one field of their data) to the format used
+-- by bento_ott.lua (see there.) Run at startup with:
+--   redis-cli --eval migrate_ott.lua , <current UNIX time>
+-- Expired tokens are dropped. Returns the number of tokens migrated.
+
+-- Tokens are stored by ID, i.e. their SHA-1 hash (see bento_ott.get_token_id)
+
+local TOKEN_PREFIX = "bento_ott:token:"
+local PAYLOAD_PREFIX = "bento_ott:payload:"
+local USER_INDEX_PREFIX = "bento_ott:user:"
+local SCOPE_INDEX_PREFIX = "bento_ott:scope:"
+local OLD_HASHES = {
+  "bento_ott:expiry",
+  "bento_ott:scope",
+  "bento_ott:user",
+  "bento_ott:user_id",
+  "bento_ott:user_role",
+}
+
+local now = tonumber(ARGV[1])
+local migrated = 0
+
+local expiries = redis.call("HGETALL", "bento_ott:expiry")
+for i = 1, #expiries, 2 do
+  local token = expiries[i]
+  local token_id = redis.sha1hex(token)
+  local ttl = (tonumber(expiries[i + 1]) or 0) - now
+  local scope = redis.call("HGET", "bento_ott:scope", token)
+
+  -- Tokens without a scope would be valid everywhere, so they aren't migrated
+  if ttl > 0 and scope then
+    local user = redis.call("HGET", "bento_ott:user", token)
+    local user_id = redis.call("HGET", "bento_ott:user_id", token) or ""
+
+    -- Old tokens don't share payloads, so each gets its own (under its own
+    -- token ID, which is unique)
+    redis.call("SET", PAYLOAD_PREFIX .. token_id, cjson.encode({
+      user = user and cjson.decode(user) or {},
+      user_id = user_id,
+      user_role = redis.call("HGET", "bento_ott:user_role", token) or nil,
+    }), "EX", ttl)
+    redis.call("SET", TOKEN_PREFIX .. token_id,
+      cjson.encode({scope = scope, user_id = user_id, payload = token_id}), "EX", ttl)
+
+    for _, index_key in ipairs({USER_INDEX_PREFIX .. user_id, SCOPE_INDEX_PREFIX .. scope}) do
+      redis.call("ZADD", index_key, now + ttl, token_id)
+      if redis.call("TTL", index_key) < ttl then redis.call("EXPIRE", index_key, ttl) end
+    end
+
+    migrated = migrated + 1
+  end
+end
+
+redis.call("DEL", unpack(OLD_HASHES))
+
+return migrated
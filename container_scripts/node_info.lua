@@ -1,18 +1,14 @@
 -- Script to return public node config metadata via the config file contents.
 
+local bento_config = require("bento_config")
 local cjson = require("cjson")
 
-local auth_file = assert(io.open(ngx.var.chord_auth_config))
-local auth_params = cjson.decode(auth_file:read("*all"))
-auth_file:close()
-
-local config_file = assert(io.open(ngx.var.chord_instance_config))
-local config_params = cjson.decode(config_file:read("*all"))
-config_file:close()
+-- Configuration is loaded once per worker, rather than on every request
+local config = bento_config.get()
 
 local response = {
-  CHORD_URL=config_params["CHORD_URL"],
-  OIDC_DISCOVERY_URI=auth_params["OIDC_DISCOVERY_URI"],
+  CHORD_URL=config.CHORD_URL,
+  OIDC_DISCOVERY_URI=config.auth_params["OIDC_DISCOVERY_URI"],
 }
 
 ngx.status = 200
@@ -8,10 +8,14 @@
 local ngx = ngx
 local require = require
 
+local bento_config = require("bento_config")
+local bento_limits = require("bento_limits")
+local bento_ott = require("bento_ott")
+local bento_redis = require("bento_redis")
+local bento_routes = require("bento_routes")
 local cjson = require("cjson")
 local openidc = require("resty.openidc")
-local random = require("resty.random")
-local redis = require("resty.redis")
+local sha256 = require("resty.sha256")
 local str = require("resty.string")
 
 local uncached_response = function (status, mime, message)
@@ -25,163 +29,103 @@ local uncached_response = function (status, mime, message)
   ngx.exit(status)
 end
 
-local invalidate_ott = function (redis_conn, token)
-  -- Helper method to invalidate a one-time token, given a connection to the
-  -- Redis instance being used and the token in question
-  redis_conn:hdel("bento_ott:expiry", token)
-  redis_conn:hdel("bento_ott:scope", token)
-  redis_conn:hdel("bento_ott:user", token)
-  redis_conn:hdel("bento_ott:user_id", token)
-  redis_conn:hdel("bento_ott:user_role", token)
+local PATHS = bento_routes.PATHS
+local OIDC_CALLBACK_PATH = PATHS.OIDC_CALLBACK
+local SIGN_IN_PATH = PATHS.SIGN_IN
+local SIGN_OUT_PATH = PATHS.SIGN_OUT
+local USER_INFO_PATH = PATHS.USER_INFO
+
+local ONE_TIME_TOKENS_GENERATE_PATH = PATHS.ONE_TIME_TOKENS_GENERATE
+local ONE_TIME_TOKENS_INVALIDATE_PATH = PATHS.ONE_TIME_TOKENS_INVALIDATE
+local ONE_TIME_TOKENS_INVALIDATE_ALL_PATH = PATHS.ONE_TIME_TOKENS_INVALIDATE_ALL
+local ONE_TIME_TOKENS_INVALIDATE_USER_PATH = PATHS.ONE_TIME_TOKENS_INVALIDATE_USER
+local ONE_TIME_TOKENS_INVALIDATE_SCOPE_PATH = PATHS.ONE_TIME_TOKENS_INVALIDATE_SCOPE
+local ONE_TIME_TOKENS_LIST_PATH = PATHS.ONE_TIME_TOKENS_LIST
+
+local STATS_PATH = PATHS.STATS
+local RELOAD_PATH = PATHS.RELOAD
+
+-- Shared dicts (declared in the NGINX configuration) are shared by all NGINX
+-- workers, unlike Lua variables, which are local to each worker.
+--  - Results of checking bearer tokens, keyed by a hash of the token
+local bearer_cache = ngx.shared.bento_bearer_cache
+--  - Users and roles for authenticated sessions, keyed by a hash of the
+--    session cookie
+local session_cache = ngx.shared.bento_session_cache
+--  - Counters (hits/misses/etc.), exposed by the stats endpoint
+local stats = ngx.shared.bento_stats
+
+local incr_stat = function (key)
+  stats:incr(key, 1, 0)
 end
 
-local OIDC_CALLBACK_PATH = "/api/auth/callback"
-local OIDC_CALLBACK_PATH_NO_SLASH = OIDC_CALLBACK_PATH:sub(2, #OIDC_CALLBACK_PATH)
-local SIGN_IN_PATH = "/api/auth/sign-in"
-local SIGN_OUT_PATH = "/api/auth/sign-out"
-local USER_INFO_PATH = "/api/auth/user"
-
-local ONE_TIME_TOKENS_GENERATE_PATH = "/api/auth/ott/generate"
-local ONE_TIME_TOKENS_INVALIDATE_PATH = "/api/auth/ott/invalidate"
-local ONE_TIME_TOKENS_INVALIDATE_ALL_PATH = "/api/auth/ott/invalidate_all"
-
--- TODO: Make this configurable
-local REDIS_CONNECTION_STRING = "unix:/chord/tmp/redis.sock"
-
-local REDIS_SOCKET
-local REDIS_HOST
-local REDIS_PORT
-
-if REDIS_CONNECTION_STRING:match("^unix") then
-  REDIS_SOCKET = REDIS_CONNECTION_STRING
-else  -- Treat as host/port
-  -- Format: localhost:6379
-  local port_sep = REDIS_CONNECTION_STRING:find(":")
-  if port_sep == nil then
-    REDIS_HOST = REDIS_CONNECTION_STRING
-    REDIS_PORT = 6379  -- Default Redis port
-  else
-    REDIS_HOST = REDIS_CONNECTION_STRING:sub(1, port_sep-1)
-    REDIS_PORT = tonumber(REDIS_CONNECTION_STRING:sub(port_sep+1, #REDIS_CONNECTION_STRING))
-  end
-end
-
--- Create an un-connected Redis object
-local red_ok
-local red, red_err = redis:new()
-if red_err then
-  uncached_response(
-    ngx.HTTP_INTERNAL_SERVER_ERROR,
-    "application/json",
-    cjson.encode({message=red_err, tag="ott redis conn", user_role=nil}))
-end
-
--- Function to handle common Redis connection tasks
-local redis_connect = function ()
-  if REDIS_SOCKET then
-    return red:connect(REDIS_SOCKET)
-  else
-    return red:connect(REDIS_HOST, REDIS_PORT)
-  end
+local get_cache_key = function (prefix, secret)
+  -- Cache keys are hashes, so tokens and session cookies themselves are never
+  -- stored in the caches
+  local hash = sha256:new()
+  hash:update(secret)
+  return prefix .. str.to_hex(hash:final())
 end
 
--- Load auth configuration for setting up lua-resty-oidconnect
-local auth_file = assert(io.open(ngx.var.chord_auth_config))
-local auth_params = cjson.decode(auth_file:read("*all"))
-auth_file:close()
-
-local config_file = assert(io.open(ngx.var.chord_instance_config))
-local config_params = cjson.decode(config_file:read("*all"))
-config_file:close()
+-- Redis client; only connects if a command is actually sent, so requests
+-- which don't need Redis don't pay for it
+local red_ok, red_err
+local red = bento_redis.new()
 
-local auth__owner_ids = auth_params["OWNER_IDS"]
-if auth__owner_ids == nil then
-  auth__owner_ids = {}
-end
-
--- TODO: This should probably be procedural instead of a function?
-local get_user_role = function (user_id)
-  user_role = "user"
-  for _, owner_id in ipairs(auth__owner_ids) do
-    -- Check each owner ID set in the auth params; if the current user's ID
-    -- matches one, set the user's role to "owner".
-    if owner_id == user_id then user_role = "owner" end
-  end
-  return user_role
-end
+-- Get auth and instance configuration, which is loaded once per worker
+-- (rather than on every request) and only re-loaded when requested
+local config = bento_config.get()
+local get_user_role = bento_config.get_user_role
 
 local NGX_NULL = ngx.null
 local ngx_null_to_nil = function (v)
   if v == NGX_NULL then return nil else return v end
 end
 
--- Set defaults for any possibly-unspecified configuration options, including
--- some boolean casts
-
-local CHORD_DEBUG = not (not config_params["CHORD_DEBUG"])
-
--- Cannot use "or" shortcut, otherwise would always be true
-local CHORD_PERMISSIONS = config_params["CHORD_PERMISSIONS"]
-if CHORD_PERMISSIONS == nil then CHORD_PERMISSIONS = true end
-
-local CHORD_PRIVATE_MODE = not (not config_params["CHORD_PRIVATE_MODE"])
-
--- If in production, validate the SSL certificate if HTTPS is being used (for
--- non-Lua folks, this is a ternary - ssl_verify = !chord_debug)
-local opts_ssl_verify = CHORD_DEBUG and "no" or "yes"
-
--- If in production, enforce CHORD_URL as the base for redirect
-local opts_redirect_uri = OIDC_CALLBACK_PATH
-local opts_redirect_after_logout_uri = "/"
-if not CHORD_DEBUG then
-  opts_redirect_uri = config_params["CHORD_URL"] .. OIDC_CALLBACK_PATH_NO_SLASH
-  opts_redirect_after_logout_uri = config_params["CHORD_URL"]
-end
-
-local opts = {
-  redirect_uri = opts_redirect_uri,
-  logout_path = SIGN_OUT_PATH,
-  redirect_after_logout_uri = opts_redirect_after_logout_uri,
-
-  discovery = auth_params["OIDC_DISCOVERY_URI"],
-
-  client_id = auth_params["CLIENT_ID"],
-  client_secret = auth_params["CLIENT_SECRET"],
-
-  -- Default token_endpoint_auth_method to client_secret_basic
-  token_endpoint_auth_method = auth_params["TOKEN_ENDPOINT_AUTH_METHOD"] or "client_secret_basic",
-
-  accept_none_alg = false,
-  accept_unsupported_alg = false,
-  ssl_verify = opts_ssl_verify,
+local CHORD_PERMISSIONS = config.CHORD_PERMISSIONS
+local CHORD_PRIVATE_MODE = config.CHORD_PRIVATE_MODE
 
-  -- Disable keepalive to try to prevent some "lost access token" issues with the OP
-  -- See https://github.com/zmartzone/lua-resty-openidc/pull/307 for details
-  keepalive = "no",
+local BEARER_CACHE_TTL = config.BEARER_CACHE_TTL
+local BEARER_CACHE_NEGATIVE_TTL = config.BEARER_CACHE_NEGATIVE_TTL
+local SESSION_CACHE_TTL = config.SESSION_CACHE_TTL
 
-  -- TODO: Re-enable this if it doesn't cause sign-out bugs, since it's more secure
-  -- refresh_session_interval = 600,
-
-  iat_slack = 120,
-  -- access_token_expires_in should be shorter than $session_cookie_lifetime otherwise will never be called
-  -- Keycloak defaults to 1-minute access tokens
-  access_token_expires_in = 60,
-  access_token_expires_leeway = 15,
-  renew_access_token_on_expiry = true,
-}
+local opts = config.opts
 
 -- Cache commonly-used ngx.var.uri and ngx.var.request_method to save expensive access calls
 local URI = ngx.var.uri or ""
 local REQUEST_METHOD = ngx.var.request_method or "GET"
 
+-- Classify the request (API, virtual endpoint, private namespace, static
+-- asset, etc.) once, using the route table loaded by bento_routes.init
+local route = bento_routes.classify(URI)
+
 -- Track if the current request is to an API
-local is_api_uri = not (not URI:match("^/api"))
+local is_api_uri = route.api == true
 
 -- Private URIs don't exist if the CHORD_PERMISSIONS flag is off (for dev)
 -- All URIs are effectively "private" externally for CHORD_PRIVATE_MODE nodes
 local is_private_uri = CHORD_PERMISSIONS and (
-  (CHORD_PRIVATE_MODE and not URI:match("^/api/auth")) or
-  URI:match("^/api/%a[%w-_]*/private"))
+  (CHORD_PRIVATE_MODE and not route.auth) or route.private == true)
+
+-- All requests have already been rate limited per IP address by NGINX (with a
+-- higher budget for requests with credentials); requests with credentials are
+-- also rate limited per user once authenticated, below.
+local has_credentials = (ngx.var.http_authorization or ngx.var.http_x_ott or ngx.var.cookie_bento_session) ~= nil
+
+local err_rate_limited = function ()
+  uncached_response(429, "application/json",
+    cjson.encode({message="Too many requests", tag="rate limited", user_role=nil}))
+end
+
+-- Public static assets (scripts, stylesheets, images, fonts) don't depend on
+-- who is asking for them, so skip authentication (and its session lookups in
+-- Redis) entirely
+if route.asset and not is_private_uri then
+  if has_credentials and not bento_limits.limit("anonymous", ngx.var.remote_addr) then
+    err_rate_limited()
+  end
+  return
+end
 
 
 -- Calculate auth_mode for authenticate() calls,
@@ -215,7 +159,7 @@ if URI == OIDC_CALLBACK_PATH or auth_mode == nil then
   if after_chord_url then
     -- If after_chord_url is not nil, i.e. ngx var uri starts with a /
     -- Re-assemble target URI with external URI prefixes/hosts/whatnot:
-    auth_target_uri = config_params["CHORD_URL"] .. after_chord_url  .. "?" .. (ngx.var.args or "")
+    auth_target_uri = config.CHORD_URL .. after_chord_url  .. "?" .. (ngx.var.args or "")
   end
 end
 
@@ -224,6 +168,10 @@ local user_id
 local user_role
 local nested_auth_header
 
+-- Rate limit tier for the request once authenticated (see bento_limits.lua);
+-- bearer and one-time tokens are mostly used by services, so get their own
+local rate_limit_tier = "user"
+
 local err_user_not_owner = function ()
   uncached_response(ngx.HTTP_FORBIDDEN, "application/json",
     cjson.encode({message="Forbidden", tag="user not owner", user_role=user_role}))
@@ -248,9 +196,22 @@ end
 
 local req_headers = ngx.req.get_headers()
 
+-- Name of the session cookie set by lua-resty-session (see $session_name)
+local SESSION_NAME = ngx.var.session_name or "session"
+
+local get_response_session_cookie = function ()
+  -- Returns the value of the session cookie being set by this response, if any
+  local set_cookie = ngx.header["Set-Cookie"]
+  if type(set_cookie) == "string" then set_cookie = {set_cookie} end
+  for _, cookie in ipairs(set_cookie or {}) do
+    local value = cookie:match("^" .. SESSION_NAME .. "=([^;]*)")
+    if value then return value end
+  end
+end
+
 -- TODO: OTT headers are technically also a Bearer token (of a different nature)... should be combined
 local ott_header = req_headers["X-OTT"]
-if ott_header and not URI:match("^/api/auth") then
+if ott_header and not route.auth then
   -- Cannot use a one-time token to bootstrap generation of more one-time
   -- tokens or invalidate existing ones
   -- URIs do not include URL parameters, so this is safe from non-exact matches
@@ -258,40 +219,43 @@ if ott_header and not URI:match("^/api/auth") then
   -- The auth namespace check should theoretically be handled by the scope
   -- validation anyway, but manually check it as a last resort
 
-  red_ok, red_err = redis_connect()
+  red_ok, red_err = red:connect()
   if red_err then  -- Error occurred while connecting to Redis
     err_redis("redis conn")
     goto script_end
   end
 
-  -- TODO: Error handling for each command? Maybe overkill
-
-  -- Fetch all token data from the Redis store and subsequently delete it
-  local expiry = tonumber(red:hget("bento_ott:expiry", ott_header), 10) or nil
-  local scope = ngx_null_to_nil(red:hget("bento_ott:scope", ott_header))
-  user = cjson.decode(ngx_null_to_nil(red:hget("bento_ott:user", ott_header)) or "{}")
-  user_id = ngx_null_to_nil(red:hget("bento_ott:user_id", ott_header))
-  user_role = ngx_null_to_nil(red:hget("bento_ott:user_role", ott_header))
-
-  red:init_pipeline(5)
-  invalidate_ott(red, ott_header)  -- 5 pipeline actions
-  red:commit_pipeline()
+  -- Fetch all token data from the Redis store and delete it at the same time
+  local token_data
+  token_data, red_err = bento_ott.consume(red, ott_header)
+  if red_err then
+    err_redis("redis ott consume")
+    goto script_end
+  end
 
-  -- Update NGINX time (which is cached)
-  -- This is slow, so OTTs should not be over-used in situations where there's
-  -- a more performant way that likely makes more sense anyway.
-  ngx.update_time()
+  -- That's all we need from Redis, so put the connection back into the pool
+  red_ok, red_err = red:set_keepalive()
+  if red_err then
+    err_redis("redis keepalive failed")
+    goto script_end
+  end
 
   -- Check token validity
-  if expiry == nil then
-    -- Token cannot be found in the Redis store
+  if not token_data then
+    -- Token cannot be found in the Redis store, either because it never
+    -- existed, or because it has already been used or has expired
     uncached_response(ngx.HTTP_FORBIDDEN, "application/json",
       cjson.encode({message="Invalid one-time token", tag="ott invalid", user_role=nil}))
-  elseif expiry < ngx.time() then
-    -- Token expiry date is in the past, so it is no longer valid
-    uncached_response(ngx.HTTP_FORBIDDEN, "application/json",
-      cjson.encode({message="Expired one-time token", tag="ott expired", user_role=nil}))
-  elseif URI:sub(1, #scope) ~= scope then
+    goto script_end
+  end
+
+  local scope = token_data.scope
+  rate_limit_tier = "token"
+  user = token_data.user
+  user_id = token_data.user_id
+  user_role = token_data.user_role
+
+  if URI:sub(1, #scope) ~= scope then
     -- Invalid call made with the token (out of scope)
     -- We're harsh here and still delete the token out of security concerns
     uncached_response(ngx.HTTP_FORBIDDEN, "application/json",
@@ -302,37 +266,93 @@ if ott_header and not URI:match("^/api/auth") then
   end
 
   -- No nested auth header is set; OTTs cannot be used to bootstrap a full bearer token
-
-  -- Put Redis connection into a keepalive pool for 30 seconds
-  red_ok, red_err = red:set_keepalive(30000, 100)
-  if red_err then
-    err_redis("redis keepalive failed")
-    goto script_end
-  end
 else
   -- Check bearer token if set
   -- Adapted from https://github.com/zmartzone/lua-resty-openidc/issues/266#issuecomment-542771402
-  local auth_header = ngx.req.get_headers()["Authorization"]
+  local auth_header = req_headers["Authorization"]
   if auth_header and auth_header:match("^Bearer .+") then
     -- A Bearer auth header is set, use it instead of session through introspection
-    local res, err = openidc.introspect(opts)
-    if err == nil and res.active then
-      -- If we have a valid access token, try to get the user info
-      --   - Slice out the token from the Authorization header
-      user, err = openidc.call_userinfo_endpoint(
-        opts, auth_header:sub(auth_header:find(" ") + 1))
-      if err == nil then
-        -- User profile fetch was successful, grab the values
+    --   - Slice out the token from the Authorization header
+    local bearer_token = auth_header:sub(auth_header:find(" ") + 1)
+
+    -- Check the cache first, to avoid round trips to the OP for introspection
+    -- and user info. Tokens themselves aren't stored; only a hash of them.
+    local cache_key = get_cache_key("bearer:", bearer_token)
+
+    local cached = bearer_cache:get(cache_key)
+    if cached then
+      cached = cjson.decode(cached)
+      if cached.user then
+        incr_stat("bearer_cache:hits")
+        rate_limit_tier = "token"
+        user = cached.user
         user_id = user.sub
-        user_role = get_user_role(user_id)
+        user_role = cached.user_role
         nested_auth_header = auth_header
+      else
+        -- Cached as invalid
+        incr_stat("bearer_cache:negative_hits")
+      end
+    else
+      incr_stat("bearer_cache:misses")
+
+      local res, err = openidc.introspect(opts)
+      if err == nil and res.active then
+        -- If we have a valid access token, try to get the user info
+        user, err = openidc.call_userinfo_endpoint(opts, bearer_token)
+        if err == nil then
+          -- User profile fetch was successful, grab the values
+          rate_limit_tier = "token"
+          user_id = user.sub
+          user_role = get_user_role(user_id)
+          nested_auth_header = auth_header
+
+          -- Cache the user info and role, but never past the token's expiry
+          local ttl = BEARER_CACHE_TTL
+          if tonumber(res.exp) then ttl = math.min(ttl, tonumber(res.exp) - ngx.time()) end
+          if ttl > 0 then
+            bearer_cache:set(cache_key, cjson.encode({user=user, user_role=user_role}), ttl)
+          end
+        end
+      elseif err == nil then
+        -- The OP says the token isn't valid (as opposed to an error occurring
+        -- while checking it, which isn't cached)
+        bearer_cache:set(cache_key, cjson.encode({active=false}), BEARER_CACHE_NEGATIVE_TTL)
       end
-    end
 
-    -- Log any errors that occurred above
-    if err then ngx.log(ngx.ERR, err) end
+      -- Log any errors that occurred above
+      if err then ngx.log(ngx.ERR, err) end
+    end
   else
     -- If no Bearer token is set, use session cookie to get authentication information
+
+    -- Check the session cache first, so that most requests made with a session
+    -- (e.g. the many requests made by the front end on each page load) don't
+    -- need to load the session from Redis. Entries only last until the
+    -- session's access token is due to be refreshed, and the OIDC callback and
+    -- sign-out always go through the OIDC library, since they change the
+    -- session.
+    local session_cookie = ngx.var["cookie_" .. SESSION_NAME]
+    local session_cache_key
+    if session_cookie and URI ~= OIDC_CALLBACK_PATH and URI ~= SIGN_OUT_PATH then
+      session_cache_key = get_cache_key("session:", session_cookie)
+    elseif session_cookie and URI == SIGN_OUT_PATH then
+      session_cache:delete(get_cache_key("session:", session_cookie))
+    end
+
+    local cached = session_cache_key and session_cache:get(session_cache_key)
+    if cached then
+      incr_stat("session_cache:hits")
+      cached = cjson.decode(cached)
+      user = cached.user
+      user_id = cached.user_id
+      user_role = cached.user_role
+      nested_auth_header = cached.nested_auth_header
+      goto session_end
+    end
+
+    if session_cache_key then incr_stat("session_cache:misses") end
+
     local res, err, _, session = openidc.authenticate(
       opts, auth_target_uri, auth_mode)
     if res == nil or err then  -- Authentication wasn't successful
@@ -359,9 +379,7 @@ else
       -- Set user_id from response (either new, or from session data)
       user_id = res.id_token.sub
 
-      -- This used to be cached in session, but for easier debugging this
-      -- cache was removed. It was probably premature optimization; if
-      -- requests are all slow then maybe it's time to add that back.
+      -- Cached (along with the user) in the session cache below
       user_role = get_user_role(user_id)
 
       -- Set user object for possible /api/auth/user response
@@ -386,15 +404,66 @@ else
       -- Close the session, since we don't need it anymore
       session:close()
     end
+
+    if res ~= nil and session_cache_key then
+      -- Cache the user and role until the access token is due to be refreshed,
+      -- so that the next request which needs the session (for the refresh)
+      -- goes through the OIDC library again.
+      local ttl = SESSION_CACHE_TTL
+      local access_token_expiration = tonumber(session and session.data.access_token_expiration)
+      if access_token_expiration then
+        ttl = math.min(ttl, access_token_expiration - opts.access_token_expires_leeway - ngx.time())
+      end
+
+      -- If the session was rotated (e.g. the access token was just refreshed),
+      -- the old cookie's entry is dropped and the new cookie's is cached.
+      local response_cookie = get_response_session_cookie()
+      if response_cookie and response_cookie ~= session_cookie then
+        session_cache:delete(session_cache_key)
+        session_cache_key = response_cookie ~= "" and get_cache_key("session:", response_cookie)
+      end
+
+      if session_cache_key and ttl > 0 then
+        session_cache:set(session_cache_key, cjson.encode({
+          user=user,
+          user_id=user_id,
+          user_role=user_role,
+          nested_auth_header=nested_auth_header,
+        }), ttl)
+      end
+    end
+
+    ::session_end::
   end
 end
 
 -- Either authenticated or not, so from hereon out we:
+--  - Rate limit the request, per user if authenticated
 --  - Handle scripted virtual endpoints (user info, sign in, OTT stuff)
 --  - Check access given the URL
 --  - Set proxy-internal headers
 
-if URI == USER_INFO_PATH then
+if user_id ~= nil then
+  if not bento_limits.limit(rate_limit_tier, user_id, route.service) then
+    err_rate_limited()
+    goto script_end
+  end
+elseif has_credentials then
+  -- Credentials were given but didn't authenticate; limit per IP address, as
+  -- NGINX would have without the credentials
+  if not bento_limits.limit("anonymous", ngx.var.remote_addr, route.service) then
+    err_rate_limited()
+    goto script_end
+  end
+end
+
+if not route.endpoint then
+  if is_private_uri and user_role ~= "owner" then
+    -- Check owner status before allowing through the proxy
+    -- TODO: Check ownership / grants?
+    err_user_not_owner()
+  end
+elseif URI == USER_INFO_PATH then
   -- Endpoint: /api/auth/user
   --   Generates a JSON response with user data if the user is authenticated;
   --   otherwise returns a 401 Forbidden error.
@@ -465,45 +534,39 @@ elseif URI == ONE_TIME_TOKENS_GENERATE_PATH then
     goto script_end
   end
 
-  local n_tokens = math.max(req_body["number"] or 1, 1)
+  local n_tokens = req_body["number"] or 1
+  if type(n_tokens) ~= "number" then
+    uncached_response(ngx.HTTP_BAD_REQUEST, "application/json",
+      cjson.encode({message="Invalid number of OTTs", tag="invalid number", user_role=user_role}))
+    goto script_end
+  end
+  n_tokens = math.max(math.floor(n_tokens), 1)
 
-  -- Don't let a user request more than 30 OTTs at a time
-  if n_tokens > 30 then
+  -- Don't let a user request too many OTTs at a time
+  if n_tokens > config.OTT_MAX_TOKENS then
     uncached_response(ngx.HTTP_BAD_REQUEST, "application/json",
-      cjson.encode({message="Too many OTTs requested", tag="too many tokens", user_role=user_role}))
+      cjson.encode({message="Too many OTTs requested (maximum: " .. config.OTT_MAX_TOKENS .. ")",
+                    tag="too many tokens", user_role=user_role}))
     goto script_end
   end
 
-  red_ok, red_err = redis_connect()
+  red_ok, red_err = red:connect()
   if red_err then
     err_redis("redis conn")
     goto script_end
   end
 
-  -- Update NGINX internal time cache
-  ngx.update_time()
-
-  local new_token
-  local new_tokens = {}
-
-  -- Generate n_tokens new tokens
-  red:init_pipeline(5 * n_tokens)
-  for _ = 1, n_tokens do
-    -- Generate a new token (using OpenSSL via lua-resty-random), 128 characters long
-    -- Does not use the token method, since that does not use OpenSSL
-    new_token = str.to_hex(random.bytes(64))
-    -- TODO: RANDOM CAN RETURN NIL, HANDLE THIS
-    table.insert(new_tokens, new_token)
-    red:hset("bento_ott:expiry", new_token, ngx.time() + 604800)  -- Set expiry to current time + 7 days
-    red:hset("bento_ott:scope", new_token, scope)
-    red:hset("bento_ott:user", new_token, cjson.encode(user))
-    red:hset("bento_ott:user_id", new_token, user_id)
-    red:hset("bento_ott:user_role", new_token, user_role)
+  -- Generate n_tokens new tokens, which all share a single copy of the user's
+  -- data in the Redis store
+  local new_tokens
+  new_tokens, red_err = bento_ott.generate(red, scope, n_tokens, user, user_id, user_role)
+  if red_err then
+    err_redis("ott generate")
+    goto script_end
   end
-  red:commit_pipeline()
 
-  -- Put Redis connection into a keepalive pool for 30 seconds
-  red_ok, red_err = red:set_keepalive(30000, 100)
+  -- Put Redis connection back into the pool
+  red_ok, red_err = red:set_keepalive()
   if red_err then
     err_redis("redis keepalive failed")
     -- TODO: Do we need to invalidate the tokens here? They aren't really guessable anyway
@@ -514,10 +577,12 @@ elseif URI == ONE_TIME_TOKENS_GENERATE_PATH then
   uncached_response(ngx.HTTP_OK, "application/json", cjson.encode(new_tokens))
 elseif URI == ONE_TIME_TOKENS_INVALIDATE_PATH then
   -- Endpoint: DELETE /api/auth/ott/invalidate
-  --   Invalidates a token passed in the request body (format: {"token": "..."}) if the
-  --   supplied token exists. This endpoint is idempotent, and will return 204 (assuming
-  --   nothing went wrong on the server) even if the token did not exist. Regardless, the
-  --   end state is that the supplied token is guaranteed not to be valid anymore.
+  --   Invalidates a token passed in the request body, either itself (format:
+  --   {"token": "..."}) or by its ID from /api/auth/ott/list (format:
+  --   {"id": "..."}), if the token exists. This endpoint is idempotent, and
+  --   will return 204 (assuming nothing went wrong on the server) even if the
+  --   token did not exist. Regardless, the end state is that the supplied
+  --   token is guaranteed not to be valid anymore.
 
   if REQUEST_METHOD ~= "DELETE" then
     err_invalid_method()
@@ -536,23 +601,30 @@ elseif URI == ONE_TIME_TOKENS_INVALIDATE_PATH then
     goto script_end
   end
 
-  local token = req_body["token"]
-  if not token or type(token) ~= "string" then
+  local token_id = req_body["id"]
+  if type(req_body["token"]) == "string" then
+    token_id = bento_ott.get_token_id(req_body["token"])
+  end
+  if not token_id or type(token_id) ~= "string" then
     uncached_response(ngx.HTTP_BAD_REQUEST, "application/json",
       cjson.encode({message="Missing or invalid token", tag="invalid token", user_role=user_role}))
     goto script_end
   end
 
-  red_ok, red_err = redis_connect()
+  red_ok, red_err = red:connect()
   if red_err then
     err_redis("redis conn")
     goto script_end
   end
 
-  invalidate_ott(red, token)
+  red_ok, red_err = bento_ott.revoke(red, {}, {token_id})
+  if red_err then
+    err_redis("ott invalidate")
+    goto script_end
+  end
 
-  -- Put Redis connection into a keepalive pool for 30 seconds
-  red_ok, red_err = red:set_keepalive(30000, 100)
+  -- Put Redis connection back into the pool
+  red_ok, red_err = red:set_keepalive()
   if red_err then
     err_redis("redis keepalive failed")
     goto script_end
@@ -577,22 +649,30 @@ elseif URI == ONE_TIME_TOKENS_INVALIDATE_ALL_PATH then
     goto script_end
   end
 
-  red_ok, red_err = redis_connect()
+  red_ok, red_err = red:connect()
   if red_err then
     err_redis("redis conn")
     goto script_end
   end
 
-  red:init_pipeline(5)
-  red:del("bento_ott:expiry")
-  red:del("bento_ott:scope")
-  red:del("bento_ott:user")
-  red:del("bento_ott:user_id")
-  red:del("bento_ott:user_role")
-  red:commit_pipeline()
+  -- Delete tokens in batches as they're found, rather than all at once
+  -- with KEYS, which would block Redis while searching every key
+  local cursor = "0"
+  repeat
+    local scan_res
+    scan_res, red_err = red:scan(cursor, "MATCH", bento_ott.KEY_PATTERN, "COUNT", 1000)
+    if red_err then
+      err_redis("redis ott scan")
+      goto script_end
+    end
+    cursor = scan_res[1]
+    if #scan_res[2] > 0 then
+      red:del(unpack(scan_res[2]))
+    end
+  until cursor == "0"
 
-  -- Put Redis connection into a keepalive pool for 30 seconds
-  red_ok, red_err = red:set_keepalive(30000, 100)
+  -- Put Redis connection back into the pool
+  red_ok, red_err = red:set_keepalive()
   if red_err then
     err_redis("redis keepalive failed")
     goto script_end
@@ -600,10 +680,182 @@ elseif URI == ONE_TIME_TOKENS_INVALIDATE_ALL_PATH then
 
   -- We're good to respond in the affirmative
   uncached_response(ngx.HTTP_NO_CONTENT)
-elseif is_private_uri and user_role ~= "owner" then
-  -- Check owner status before allowing through the proxy
-  -- TODO: Check ownership / grants?
-  err_user_not_owner()
+elseif URI == ONE_TIME_TOKENS_INVALIDATE_USER_PATH or URI == ONE_TIME_TOKENS_INVALIDATE_SCOPE_PATH then
+  -- Endpoints: DELETE /api/auth/ott/invalidate_user
+  --            DELETE /api/auth/ott/invalidate_scope
+  --   Invalidates all tokens generated by a user (format: {"user": "..."};
+  --   defaults to the current user) or for a scope (format: {"scope": "..."}.)
+  --   Users can invalidate their own tokens; otherwise, the user must be an
+  --   owner. These endpoints are idempotent, and respond with the number of
+  --   tokens invalidated.
+
+  if REQUEST_METHOD ~= "DELETE" then
+    err_invalid_method()
+    goto script_end
+  end
+
+  if user_role == nil then
+    err_user_nil()
+    goto script_end
+  end
+
+  ngx.req.read_body()  -- Read the request body into memory
+  local req_body = cjson.decode(ngx.req.get_body_data() or "{}")
+  if type(req_body) ~= "table" then
+    err_invalid_req_body()
+    goto script_end
+  end
+
+  local index_key
+  if URI == ONE_TIME_TOKENS_INVALIDATE_USER_PATH then
+    local target_user = req_body["user"] or user_id
+    if type(target_user) ~= "string" then
+      err_invalid_req_body()
+      goto script_end
+    end
+    if target_user ~= user_id and user_role ~= "owner" then
+      err_user_not_owner()
+      goto script_end
+    end
+    index_key = bento_ott.get_user_index_key(target_user)
+  else
+    if user_role ~= "owner" then
+      err_user_not_owner()
+      goto script_end
+    end
+    if type(req_body["scope"]) ~= "string" then
+      uncached_response(ngx.HTTP_BAD_REQUEST, "application/json",
+        cjson.encode({message="Missing or invalid token scope", tag="invalid scope", user_role=user_role}))
+      goto script_end
+    end
+    index_key = bento_ott.get_scope_index_key(req_body["scope"])
+  end
+
+  local n_invalidated
+  n_invalidated, red_err = bento_ott.revoke(red, {index_key}, {})
+  if red_err then
+    err_redis("ott invalidate")
+    goto script_end
+  end
+
+  red_ok, red_err = red:set_keepalive()
+  if red_err then
+    err_redis("redis keepalive failed")
+    goto script_end
+  end
+
+  uncached_response(ngx.HTTP_OK, "application/json", cjson.encode({invalidated=n_invalidated}))
+elseif URI == ONE_TIME_TOKENS_LIST_PATH then
+  -- Endpoint: GET /api/auth/ott/list[?user=...|?scope=...]
+  --   Lists unexpired, unused tokens generated by a user (defaults to the
+  --   current user) or for a scope. Users can list their own tokens (and only
+  --   see their own tokens when listing by scope); owners can list anyone's.
+
+  if REQUEST_METHOD ~= "GET" then
+    err_invalid_method()
+    goto script_end
+  end
+
+  if user_role == nil then
+    err_user_nil()
+    goto script_end
+  end
+
+  local args = ngx.req.get_uri_args()
+  local index_key
+  if type(args.scope) == "string" then
+    index_key = bento_ott.get_scope_index_key(args.scope)
+  else
+    local target_user = type(args.user) == "string" and args.user or user_id
+    if target_user ~= user_id and user_role ~= "owner" then
+      err_user_not_owner()
+      goto script_end
+    end
+    index_key = bento_ott.get_user_index_key(target_user)
+  end
+
+  local tokens
+  tokens, red_err = bento_ott.list(red, index_key)
+  if red_err then
+    err_redis("ott list")
+    goto script_end
+  end
+
+  red_ok, red_err = red:set_keepalive()
+  if red_err then
+    err_redis("redis keepalive failed")
+    goto script_end
+  end
+
+  local visible_tokens = {}
+  for _, t in ipairs(tokens) do
+    if user_role == "owner" or t.user_id == user_id then
+      table.insert(visible_tokens, t)
+    end
+  end
+
+  uncached_response(ngx.HTTP_OK, "application/json",
+    #visible_tokens > 0 and cjson.encode(visible_tokens) or "[]")
+elseif URI == STATS_PATH then
+  -- Endpoint: GET /api/auth/stats
+  --   Returns counters for the proxy's caches, Redis commands and rate limits
+  --   (shared by all NGINX workers) if the user is an owner.
+
+  if REQUEST_METHOD ~= "GET" then
+    err_invalid_method()
+    goto script_end
+  end
+
+  if user_role ~= "owner" then
+    err_user_not_owner()
+    goto script_end
+  end
+
+  uncached_response(ngx.HTTP_OK, "application/json", cjson.encode({
+    bearer_cache={
+      hits=stats:get("bearer_cache:hits") or 0,
+      negative_hits=stats:get("bearer_cache:negative_hits") or 0,
+      misses=stats:get("bearer_cache:misses") or 0,
+      capacity=bearer_cache:capacity(),
+      free_space=bearer_cache:free_space(),
+    },
+    session_cache={
+      hits=stats:get("session_cache:hits") or 0,
+      misses=stats:get("session_cache:misses") or 0,
+      capacity=session_cache:capacity(),
+      free_space=session_cache:free_space(),
+    },
+    redis=bento_redis.get_stats(),
+    rate_limits=bento_limits.get_stats(),
+  }))
+elseif URI == RELOAD_PATH then
+  -- Endpoint: POST /api/auth/reload
+  --   Re-loads auth and instance configuration from disk in all NGINX
+  --   workers if the user is an owner, e.g. after changing OWNER_IDS.
+
+  if REQUEST_METHOD ~= "POST" then
+    err_invalid_method()
+    goto script_end
+  end
+
+  if user_role ~= "owner" then
+    err_user_not_owner()
+    goto script_end
+  end
+
+  local reload_ok, reload_err = pcall(bento_config.reload)
+  if not reload_ok then
+    uncached_response(ngx.HTTP_INTERNAL_SERVER_ERROR, "application/json",
+      cjson.encode({message=tostring(reload_err), tag="config reload", user_role=user_role}))
+    goto script_end
+  end
+
+  -- Cached user roles were derived from the previous configuration (e.g. its
+  -- OWNER_IDS), so drop them; sessions and tokens are re-checked as needed
+  bearer_cache:flush_all()
+  session_cache:flush_all()
+
+  uncached_response(ngx.HTTP_NO_CONTENT)
 end
 
 -- Clear and possibly set internal headers to inform services of user identity
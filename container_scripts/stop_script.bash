@@ -10,25 +10,35 @@ wait_for_kill () {
 
 POSTGRES_VERSION="11"
 
+# Record how long each part of shutdown takes, for chord_container_timing
+source /chord/container_scripts/timing.bash
+timing_begin_run stop
+
 # Kill the proxy first
-killall nginx &> /dev/null
+timed nginx killall nginx &> /dev/null
+
+# Stop the metrics exporter, if it's running
+timed metrics kill "$(cat /chord/tmp/metrics.pid)" &> /dev/null
 
 # Kill all services (gracefully-ish) to prevent them from trying to write to
 # data storage systems (fs, Redis, Postgres.)
 
-kill -2 "$(cat /chord/tmp/uwsgi/uwsgi.pid)" &> /dev/null
-wait_for_kill "$(cat /chord/tmp/uwsgi/uwsgi.pid)"
+stop_uwsgi () {
+  kill -2 "$(cat /chord/tmp/uwsgi/uwsgi.pid)" &> /dev/null
+  wait_for_kill "$(cat /chord/tmp/uwsgi/uwsgi.pid)"
+}
+timed uwsgi stop_uwsgi
 
-chord_container_non_wsgi_stop
+timed non_wsgi chord_container_non_wsgi_stop
 
 # Kill Redis
-redis-cli -s /chord/tmp/redis.sock shutdown &> /dev/null
+timed redis redis-cli -s /chord/tmp/redis.sock shutdown &> /dev/null
 
 # Stop Postgres cluster
-pg_ctlcluster ${POSTGRES_VERSION} main stop &> /dev/null
+timed postgres pg_ctlcluster ${POSTGRES_VERSION} main stop &> /dev/null
 
 # Stop commands
-chord_container_post_stop
+timed post_stop chord_container_post_stop
 sleep 2  # Wait for kills
 
 # Remove any stray socket files
@@ -0,0 +1,44 @@
+#!/usr/bin/env bash
+
+# Helpers for recording timing spans from the start and stop scripts, in the
+# same JSONL format as chord_container_tools.timing. Summarize them with
+# chord_container_timing.
+#  - must be sourced after /chord/tmp/logs has been created
+
+CHORD_TIMING_LOG="${CHORD_TIMING_LOG:-/chord/tmp/logs/timing.jsonl}"
+
+# Starts a new run (boot or shutdown), which all spans recorded from here on -
+# including those recorded by chord_container_tools jobs - are grouped under.
+#  - $1: kind of run, e.g. start or stop
+timing_begin_run () {
+  export CHORD_TIMING_RUN="$1-$(date -u +%Y%m%dT%H%M%SZ)-$$"
+}
+
+# Runs a command, recording how long it took as a span. Any
+# chord_container_tools jobs run by the command record their spans as part of
+# this one. Returns the command's exit status.
+#  - $1: name of the span
+#  - the rest: command to run
+timed () {
+  local name="$1"
+  shift
+
+  local start
+  local end
+  local status
+  local ok="true"
+
+  start="$(date +%s.%N)"
+  CHORD_TIMING_PARENT="${name}" "$@"
+  status=$?
+  end="$(date +%s.%N)"
+
+  if [[ ${status} -ne 0 ]]; then
+    ok="false"
+  fi
+
+  printf '{"run": "%s", "name": "%s", "parent": null, "start": %s, "end": %s, "ok": %s}\n' \
+    "${CHORD_TIMING_RUN}" "${name}" "${start}" "${end}" "${ok}" >> "${CHORD_TIMING_LOG}" 2> /dev/null
+
+  return ${status}
+}
@@ -0,0 +1,48 @@
+#!/usr/bin/env bash
+
+# Script to update the CHORD services in an existing Singularity container,
+# only re-provisioning services which have changed since the image was built.
+#  - New files are staged in /chord/.update by the build definition
+
+# Avoid warnings about non-interactive shell
+export DEBIAN_FRONTEND=noninteractive
+
+export LANG="en_US.UTF-8"
+export LC_CTYPE="en_US.UTF-8"
+
+export HOME="/chord"
+
+# This export will only last until the end of the update
+export PATH=/usr/local/openresty/bin:/usr/local/openresty/nginx/sbin:$PATH
+
+echo "[CHORD] Replacing container scripts and service definitions"
+
+cd /chord || exit
+rm -rf /chord/container_scripts /chord/chord_container_tools
+mv /chord/.update/container_scripts /chord/container_scripts
+mv /chord/.update/chord_container_tools /chord/chord_container_tools
+mv -f /chord/.update/chord_services.json /chord/chord_services.json
+mv -f /chord/.update/chord_services.schema.json /chord/chord_services.schema.json
+mv -f /chord/.update/LICENSE /chord/LICENSE
+mv -f /chord/.update/README.md /chord/README.md
+rm -rf /chord/.update
+
+# Build dependencies are removed at the end of the original build, so they
+# need to be re-installed for any services which need to be compiled
+echo "[CHORD] Installing build dependencies"
+apt-get update > /dev/null
+apt-get install -y build-essential autoconf python3-virtualenv > /dev/null
+
+# Re-install chord_container_tools
+echo "[CHORD] Installing chord_container_tools Python package"
+python3.7 -m pip install --no-cache-dir --upgrade /chord/chord_container_tools > /dev/null
+
+# Run Python container setup script, only for changed services
+echo "[CHORD] Updating container"
+CHORD_SETUP_INCREMENTAL=True chord_container_setup || exit 1
+
+# Remove caches and build dependencies
+rm -rf /chord/.cache
+apt-get purge -y build-essential autoconf python3-virtualenv > /dev/null
+apt-get autoremove -y > /dev/null
+apt-get clean > /dev/null
@@ -2,6 +2,7 @@
 
 import argparse
 import subprocess
+import sys
 
 from pathlib import Path
 
@@ -9,6 +10,8 @@ BENTO_FOLDER = Path(__file__).parent.absolute()
 
 BENTO_SINGULARITY_TEMPLATE = BENTO_FOLDER / "bento.def.template"
 BENTO_DOCKER_TEMPLATE = BENTO_FOLDER / "Dockerfile.template"
+BENTO_SINGULARITY_INCREMENTAL_TEMPLATE = BENTO_FOLDER / "bento.incremental.def.template"
+BENTO_DOCKER_INCREMENTAL_TEMPLATE = BENTO_FOLDER / "Dockerfile.incremental.template"
 
 TEMPLATE_REPLACEMENTS = {
     "__BENTO_SERVICES_JSON_SCHEMA__": (BENTO_FOLDER / "chord_services.schema.json").resolve(),
@@ -21,15 +24,32 @@ TEMPLATE_REPLACEMENTS = {
 DEFAULT_BENTO_SERVICES_JSON = BENTO_FOLDER / "chord_services.json"
 
 
-def _edit_template(file_path: str, bento_services_path: str):
-    subprocess.run(("sed", "-i", f"s=__BENTO_SERVICES_JSON__={bento_services_path}=g", file_path))
-    for value, replacement in TEMPLATE_REPLACEMENTS.items():
+def _get_build_replacements(args) -> dict:
+    return {
+        "__BENTO_SERVICES_JSON__": args.bento_services_json.resolve(),
+        "__BENTO_SETUP_WORKERS__": args.setup_workers,
+        "__BENTO_SETUP_WHEELHOUSE__": not args.no_wheelhouse,
+        "__BENTO_SETUP_HARDLINK_VENVS__": args.hardlink_venvs,
+        "__BENTO_BASE_IMAGE__": args.base_image,
+    }
+
+
+def _edit_template(file_path: str, args):
+    for value, replacement in {**_get_build_replacements(args), **TEMPLATE_REPLACEMENTS}.items():
         subprocess.run(("sed", "-i", f"s={value}={replacement}=g", file_path))
 
 
+def _check_incremental_args(args):
+    if args.incremental and not args.base_image:
+        print("Error: --incremental requires --base-image", file=sys.stderr)
+        exit(1)
+
+
 def action_build(args):
-    subprocess.run(("cp", BENTO_SINGULARITY_TEMPLATE.resolve(), "./bento.def"))
-    _edit_template("./bento.def", args.bento_services_json.resolve())
+    _check_incremental_args(args)
+    template = BENTO_SINGULARITY_INCREMENTAL_TEMPLATE if args.incremental else BENTO_SINGULARITY_TEMPLATE
+    subprocess.run(("cp", template.resolve(), "./bento.def"))
+    _edit_template("./bento.def", args)
     subprocess.run((
         "sudo",
         "singularity",
@@ -42,8 +62,10 @@ def action_build(args):
 
 
 def action_build_docker(args):
-    subprocess.run(("cp", BENTO_DOCKER_TEMPLATE.resolve(), "./Dockerfile"))
-    _edit_template("./Dockerfile", args.bento_services_json.resolve())
+    _check_incremental_args(args)
+    template = BENTO_DOCKER_INCREMENTAL_TEMPLATE if args.incremental else BENTO_DOCKER_TEMPLATE
+    subprocess.run(("cp", template.resolve(), "./Dockerfile"))
+    _edit_template("./Dockerfile", args)
     subprocess.run(("docker", "build", "--no-cache", "."))
     subprocess.run(("rm", "./Dockerfile"))
 
@@ -64,6 +86,16 @@ def main():
                         default="bento.sif")
     parser.add_argument("--bento-services-json", dest="bento_services_json", type=lambda p: Path(p).absolute(),
                         default=DEFAULT_BENTO_SERVICES_JSON, help="path/to/bento_services.json")
+    parser.add_argument("--setup-workers", dest="setup_workers", type=int, default=0,
+                        help="maximum number of services to install at once (default: number of CPUs)")
+    parser.add_argument("--no-wheelhouse", dest="no_wheelhouse", action="store_true",
+                        help="install each service directly instead of from a shared, pre-built wheelhouse")
+    parser.add_argument("--hardlink-venvs", dest="hardlink_venvs", action="store_true",
+                        help="replace identical files across service virtual environments with hard links")
+    parser.add_argument("--incremental", dest="incremental", action="store_true",
+                        help="update an existing image, only re-installing services which have changed")
+    parser.add_argument("--base-image", dest="base_image", type=str, default="",
+                        help="[existing image to update when building incrementally (.sif file or Docker image)]")
     parser.add_argument(
         "action",
         metavar="action",
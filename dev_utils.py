@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
+import http.client
 import json
 import os
+import socket
 import subprocess
 import sys
+import threading
+import time
 
 from pathlib import Path
 
@@ -108,7 +112,83 @@ def action_update_web(args):
                     "bash", "/chord/container_scripts/install_web.bash"))
 
 
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = 30):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _percentile(sorted_values, p: float) -> float:
+    return sorted_values[min(int(len(sorted_values) * p), len(sorted_values) - 1)]
+
+
+def action_bench(args):
+    # Sends requests to an instance's gateway socket from several persistent (keep-alive) client connections at once,
+    # to measure the latency and throughput of the whole proxy chain (gateway -> internal server -> service.)
+    socket_path = os.path.join(CHORD_TEMP_DIRECTORY, str(args.node), "nginx.sock")
+    host = get_instance_url(args.node).split("/")[2]
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    requests_left = [args.bench_requests]
+
+    def _worker():
+        conn = UnixHTTPConnection(socket_path)
+        while True:
+            with lock:
+                if requests_left[0] <= 0:
+                    break
+                requests_left[0] -= 1
+
+            start = time.perf_counter()
+            try:
+                conn.request("GET", args.bench_path, headers={"Host": host})
+                res = conn.getresponse()
+                res.read()
+                if res.status >= 400:
+                    raise Exception(f"HTTP {res.status}")
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                conn.close()  # Reconnects on the next request
+                with lock:
+                    errors.append(str(e))
+
+        conn.close()
+
+    print(f"[CHORD DEV UTILS] Benchmarking GET {args.bench_path} on instance {args.node} "
+          f"({args.bench_requests} requests, {args.bench_concurrency} connections)...")
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=_worker) for _ in range(args.bench_concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        print(f"[CHORD DEV UTILS] {len(errors)} request(s) failed (first error: {errors[0]})", file=sys.stderr)
+
+    if not latencies:
+        exit(1)
+
+    latencies.sort()
+    print(f"  Throughput: {len(latencies) / elapsed:.1f} requests/s")
+    print(f"  Latency (ms): p50 {_percentile(latencies, 0.5) * 1000:.2f}, "
+          f"p90 {_percentile(latencies, 0.9) * 1000:.2f}, "
+          f"p99 {_percentile(latencies, 0.99) * 1000:.2f}, "
+          f"max {latencies[-1] * 1000:.2f}")
+
+
 ACTIONS = {
+    "bench": action_bench,
     "build": action_build,
     "build-docker": action_build_docker,
     "shell": action_shell,
@@ -129,6 +209,12 @@ def main():
     parser.add_argument("--node", dest="node", type=int, help="[node index]", default=1)
     parser.add_argument("--remote-build", dest="remote_build", action="store_true",
                         help="use Sylabs remote build service")
+    parser.add_argument("--bench-path", dest="bench_path", type=str, default="/api/service-registry/service-info",
+                        help="path to request when benchmarking")
+    parser.add_argument("--bench-requests", dest="bench_requests", type=int, default=2000,
+                        help="total number of requests to send when benchmarking")
+    parser.add_argument("--bench-concurrency", dest="bench_concurrency", type=int, default=8,
+                        help="number of connections to send requests from at once when benchmarking")
     parser.add_argument(
         "action",
         metavar="action",